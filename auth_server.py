@@ -1,48 +1,283 @@
-from flask import Flask, request, jsonify, session, render_template, redirect, url_for
+from flask import Flask, request, jsonify, session, render_template, redirect, url_for, g, Response, send_from_directory, has_app_context, abort
+from flask.json.provider import DefaultJSONProvider
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from markupsafe import Markup, escape
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import InternalServerError
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.serving import run_simple
+import base64
+import bisect
+import click
+import concurrent.futures
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
+import json
+import mimetypes
 import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE = os.path.join(BASE_DIR, 'transporte_aguila.db')
 import sqlite3
 import secrets
 import re
+import multiprocessing
+import queue
+import random
+import tempfile
+import threading
+import time
+import unicodedata
+import zlib
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 import os
 
 app = Flask(__name__)
-app.secret_key = secrets.token_hex(32)
 
-DATABASE = 'transporte_aguila.db' 
+def cargar_clave_secreta():
+    """Clave común a todos los workers: SECRET_KEY o un archivo de la carpeta instance
+
+    Si no hay ninguna, el primer proceso genera el archivo; se escribe aparte y se enlaza
+    con os.link para que un worker nunca lea un archivo a medio escribir.
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY']
+    ruta = os.environ.get('SECRET_KEY_ARCHIVO', os.path.join(app.instance_path, 'clave_secreta'))
+    if not os.path.exists(ruta):
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        temporal = f'{ruta}.{os.getpid()}'
+        with open(os.open(temporal, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as archivo:
+            archivo.write(secrets.token_hex(32))
+        try:
+            os.link(temporal, ruta)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temporal)
+    with open(ruta) as archivo:
+        return archivo.read().strip()
+
+app.secret_key = cargar_clave_secreta()
+
+# Proxies inversos de confianza delante de la aplicación (0 si se expone directamente). Con
+# ProxyFix request.remote_addr es la IP real del cliente según X-Forwarded-For; sin él todos
+# los clientes comparten la IP del proxy y, por ejemplo, el límite de logins por IP. Más saltos
+# de los que realmente hay permitirían a un cliente falsificar su IP con ese encabezado.
+PROXY_SALTOS = int(os.environ.get('PROXY_SALTOS', '1'))
+if PROXY_SALTOS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=PROXY_SALTOS, x_proto=PROXY_SALTOS)
+
+DATABASE = os.environ.get('TRANSPORTE_DB', 'transporte_aguila.db')
+
+# Tamaño máximo del pool de conexiones por proceso (cada worker de gunicorn tiene el suyo)
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '8'))
+
+# Perfil de almacenamiento aplicado a cada conexión nueva (el orden importa:
+# busy_timeout debe ir antes de journal_mode para esperar el cambio a WAL)
+DB_PRAGMAS = [
+    ('busy_timeout', int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))),
+    ('journal_mode', os.environ.get('DB_JOURNAL_MODE', 'WAL')),
+    ('synchronous', os.environ.get('DB_SYNCHRONOUS', 'NORMAL')),
+    ('cache_size', int(os.environ.get('DB_CACHE_SIZE_KB', '16000')) * -1),
+    ('mmap_size', int(os.environ.get('DB_MMAP_SIZE', str(128 * 1024 * 1024)))),
+    ('temp_store', 'MEMORY'),
+]
+
+# Reintentos de BEGIN IMMEDIATE cuando otro worker tiene el candado de escritura
+DB_WRITE_RETRIES = int(os.environ.get('DB_WRITE_RETRIES', '5'))
+DB_WRITE_BACKOFF = float(os.environ.get('DB_WRITE_BACKOFF', '0.05'))
+
+# ============================================
+# CONEXIONES A LA BASE DE DATOS
+# ============================================
+
+def configurar_conexion(conn):
+    """Aplica el perfil de almacenamiento y el modo de escritura a una conexión"""
+    for nombre, valor in DB_PRAGMAS:
+        conn.execute(f'PRAGMA {nombre} = {valor}')
+    # Las transacciones implícitas toman el candado de escritura desde el inicio,
+    # así un lector nunca falla al intentar promoverse a escritor en WAL
+    conn.isolation_level = 'IMMEDIATE'
+
+def comenzar_escritura(conn):
+    """Abre una transacción BEGIN IMMEDIATE reintentando con backoff si la base está ocupada"""
+    if conn.in_transaction:
+        return
+    espera = DB_WRITE_BACKOFF
+    for intento in range(DB_WRITE_RETRIES):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            return
+        except sqlite3.OperationalError as e:
+            bloqueada = 'locked' in str(e) or 'busy' in str(e)
+            if not bloqueada or intento == DB_WRITE_RETRIES - 1:
+                raise
+            time.sleep(espera + random.uniform(0, espera))
+            espera *= 2
+
+class PoolAgotado(TimeoutError):
+    """Ninguna conexión del pool se liberó dentro del tiempo de espera"""
+
+class PoolConexiones:
+    """Pool acotado de conexiones SQLite reutilizables entre peticiones"""
+
+    def __init__(self, database, tamano=DB_POOL_SIZE):
+        self.database = database
+        self.tamano = tamano
+        self._libres = queue.LifoQueue(maxsize=tamano)
+        self._lock = threading.Lock()
+        self._abiertas = 0
+
+    def _conectar(self):
+        conn = sqlite3.connect(self.database, check_same_thread=False)
+        try:
+            configurar_conexion(conn)
+        except Exception:
+            conn.close()
+            raise
+        return conn
+
+    def _esta_sana(self, conn):
+        try:
+            conn.execute('SELECT 1').fetchone()
+            return True
+        except sqlite3.Error:
+            return False
+
+    def obtener(self, timeout=10):
+        """Entrega una conexión sana del pool, abriendo una nueva si hay cupo"""
+        while True:
+            try:
+                conn = self._libres.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    if self._abiertas < self.tamano:
+                        self._abiertas += 1
+                        break
+                try:
+                    conn = self._libres.get(timeout=timeout)
+                except queue.Empty:
+                    print(f"✗ Pool de conexiones saturado: {self.tamano} ocupadas tras esperar {timeout}s")
+                    raise PoolAgotado(f'Pool de conexiones saturado ({self.tamano} conexiones ocupadas)') from None
+
+            if self._esta_sana(conn):
+                return conn
+            self._descartar(conn)
+
+        try:
+            return self._conectar()
+        except Exception:
+            with self._lock:
+                self._abiertas -= 1
+            raise
+
+    def devolver(self, conn):
+        """Regresa una conexión al pool descartando cualquier transacción pendiente"""
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            self._descartar(conn)
+            return
+        self._libres.put_nowait(conn)
+
+    def _descartar(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+        with self._lock:
+            self._abiertas -= 1
+
+    def cerrar_todas(self):
+        while True:
+            try:
+                conn = self._libres.get_nowait()
+            except queue.Empty:
+                break
+            self._descartar(conn)
+
+
+_pool = None
+_pool_pid = None
+
+def obtener_pool():
+    """Pool del proceso actual; se recrea tras un fork para no compartir conexiones"""
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        _pool = PoolConexiones(DATABASE)
+        _pool_pid = os.getpid()
+    return _pool
+
+def get_db():
+    """Devuelve la conexión ligada al contexto de aplicación actual"""
+    if 'db' not in g:
+        g.db = obtener_pool().obtener()
+    return g.db
+
+@contextmanager
+def conexion_actual():
+    """La conexión del contexto en curso; solo fuera de uno (hilos, streams SSE) abre uno propio
+
+    Un app_context anidado dentro de una petición tomaría una segunda conexión del pool
+    mientras la de la petición sigue ocupada.
+    """
+    if has_app_context():
+        yield get_db()
+    else:
+        with app.app_context():
+            yield get_db()
+
+@app.teardown_appcontext
+def cerrar_db(exception):
+    conn = g.pop('db', None)
+    if conn is not None:
+        obtener_pool().devolver(conn)
+
+@app.errorhandler(PoolAgotado)
+def pool_agotado(e):
+    """Un pool saturado es carga pasajera: 503 para que el cliente reintente"""
+    return jsonify({
+        'success': False,
+        'message': 'Servicio ocupado, intente de nuevo en unos segundos'
+    }), 503, {'Retry-After': '5'}
+
+@app.errorhandler(InternalServerError)
+def error_interno(e):
+    # Si el pool se satura al abrir la sesión, antes de la vista, Flask lo entrega como 500
+    if isinstance(e.original_exception, PoolAgotado):
+        return pool_agotado(e.original_exception)
+    return e
+
+# Esquema de usuarios; {tabla} permite reconstruirla en una tabla temporal
+ESQUEMA_USUARIOS = '''
+    CREATE TABLE IF NOT EXISTS {tabla} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        nombre TEXT NOT NULL,
+        apellido TEXT NOT NULL,
+        email TEXT UNIQUE NOT NULL,
+        telefono TEXT NOT NULL,
+        cedula TEXT UNIQUE NOT NULL,
+        password_hash TEXT NOT NULL,
+        tipo_usuario TEXT CHECK(tipo_usuario IN ('pasajero', 'conductor', 'administrador')) DEFAULT 'pasajero',
+        fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        ultimo_acceso TIMESTAMP
+    )
+'''
 
 def init_db():
-    """Inicializa la base de datos con las tablas necesarias"""
-    conn = sqlite3.connect(DATABASE)
+    """Crea las tablas base del sistema (se ejecuta dentro de la migración 1)"""
+    conn = get_db()
     cursor = conn.cursor()
     
-    # Verificar si la tabla usuarios existe y tiene la restricción correcta
-    cursor.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name='usuarios'")
-    result = cursor.fetchone()
-    
-    # Si existe pero no tiene 'administrador' en el CHECK, eliminarla
-    if result and 'administrador' not in result[0]:
-        print("⚠️  Recreando tabla usuarios con restricción correcta...")
-        cursor.execute('DROP TABLE IF EXISTS usuarios')
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS usuarios (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            apellido TEXT NOT NULL,
-            email TEXT UNIQUE NOT NULL,
-            telefono TEXT NOT NULL,
-            cedula TEXT UNIQUE NOT NULL,
-            password_hash TEXT NOT NULL,
-            tipo_usuario TEXT CHECK(tipo_usuario IN ('pasajero', 'conductor', 'administrador')) DEFAULT 'pasajero',
-            fecha_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            ultimo_acceso TIMESTAMP
-        )
-    ''')
+    cursor.execute(ESQUEMA_USUARIOS.format(tabla='usuarios'))
     
     # Tabla para mensajes del chat (soporte)
     cursor.execute('''
@@ -262,10 +497,10 @@ def init_db():
             INSERT INTO vehiculos (placa, tipo_vehiculo, capacidad_pasajeros, marca, modelo, year)
             VALUES (?, ?, ?, ?, ?, ?)
         ''', vehiculos_ejemplo)
-    
+
 def actualizar_db_conversaciones():
     """Actualiza la base de datos con las nuevas tablas para conversaciones"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     # Tabla de conversaciones (hilos de chat)
@@ -314,9 +549,1110 @@ def actualizar_db_conversaciones():
         )
     ''')
 
+# ============================================
+# MIGRACIONES E ÍNDICES
+# ============================================
+
+# Índices secundarios para los predicados WHERE / ORDER BY de los endpoints
+INDICES_CONSULTAS = [
+    'CREATE INDEX IF NOT EXISTS idx_usuarios_tipo ON usuarios (tipo_usuario)',
+    'CREATE INDEX IF NOT EXISTS idx_solicitudes_estado ON solicitudes_servicio (estado, conductor_id, fecha_solicitud)',
+    'CREATE INDEX IF NOT EXISTS idx_solicitudes_conductor ON solicitudes_servicio (conductor_id, fecha_solicitud)',
+    'CREATE INDEX IF NOT EXISTS idx_solicitudes_usuario ON solicitudes_servicio (usuario_id, fecha_solicitud)',
+    'CREATE INDEX IF NOT EXISTS idx_mensajes_soporte_estado ON mensajes_soporte (estado, fecha_mensaje)',
+    'CREATE INDEX IF NOT EXISTS idx_notificaciones_admin ON notificaciones_admin (admin_id, leida)',
+    'CREATE INDEX IF NOT EXISTS idx_horarios_ruta_salida ON horarios (ruta_id, fecha_salida)',
+    'CREATE INDEX IF NOT EXISTS idx_reservas_usuario ON reservas (usuario_id, fecha_reserva)',
+    'CREATE INDEX IF NOT EXISTS idx_rutas_activa ON rutas (activa, origen, destino)',
+    'CREATE INDEX IF NOT EXISTS idx_conversaciones_usuario ON conversaciones (usuario_id, fecha_ultima_actividad)',
+    'CREATE INDEX IF NOT EXISTS idx_conversaciones_actividad ON conversaciones (fecha_ultima_actividad)',
+    'CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion ON mensajes_conversacion (conversacion_id, fecha_mensaje)',
+    'CREATE INDEX IF NOT EXISTS idx_participantes_usuario ON participantes_conversacion (usuario_id, mensajes_no_leidos)',
+]
+
+def _reconstruir_tabla(conn, tabla, esquema):
+    """Reemplaza una tabla por una con otro esquema conservando filas e índices"""
+    temporal = f'{tabla}_nueva'
+    indices = [fila[0] for fila in conn.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (tabla,)
+    )]
+    columnas_viejas = {fila[1] for fila in conn.execute(f'PRAGMA table_info({tabla})')}
+    
+    conn.execute(f'DROP TABLE IF EXISTS {temporal}')
+    conn.execute(esquema.format(tabla=temporal))
+    columnas = ', '.join(
+        fila[1] for fila in conn.execute(f'PRAGMA table_info({temporal})')
+        if fila[1] in columnas_viejas
+    )
+    conn.execute(f'INSERT INTO {temporal} ({columnas}) SELECT {columnas} FROM {tabla}')
+    conn.execute(f'DROP TABLE {tabla}')
+    conn.execute(f'ALTER TABLE {temporal} RENAME TO {tabla}')
+    
+    for sql in indices:
+        conn.execute(sql)
+
+def _migracion_esquema_base(conn):
+    init_db()
+    actualizar_db_conversaciones()
+
+def _migracion_indices(conn):
+    for sentencia in INDICES_CONSULTAS:
+        conn.execute(sentencia)
+
+def _migracion_indice_horarios(conn):
+    # Reemplaza (ruta_id, fecha_salida): estado y asientos se filtran dentro del índice
+    conn.execute('DROP INDEX IF EXISTS idx_horarios_ruta_salida')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_horarios_ruta_salida_estado
+        ON horarios (ruta_id, fecha_salida, estado, asientos_disponibles)
+    ''')
+
+def _migracion_mapa_asientos(conn):
+    # Un asiento solo puede estar en una reserva vigente por horario
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_reservas_asiento
+        ON reservas (horario_id, numero_asiento)
+        WHERE estado != 'cancelada' AND numero_asiento IS NOT NULL
+    ''')
+
+def _migracion_indice_vencimiento(conn):
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_reservas_vencimiento
+        ON reservas (estado, fecha_vencimiento)
+    ''')
+
+def _migracion_eventos_chat(conn):
+    # Bitácora de eventos de chat que comparten todos los workers
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS eventos_chat (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            conversacion_id INTEGER NOT NULL,
+            usuario_id INTEGER NOT NULL,
+            admin_id INTEGER,
+            remitente_id INTEGER NOT NULL,
+            datos TEXT NOT NULL,
+            fecha_evento TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_eventos_chat_fecha ON eventos_chat (fecha_evento)')
+
+def _migracion_cursor_mensajes(conn):
+    # (conversacion_id, id) sirve los cursores after_id/before_id; el índice parcial
+    # responde "¿hay algo sin leer?" sin recorrer el hilo
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion_id
+        ON mensajes_conversacion (conversacion_id, id)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_mensajes_conversacion_no_leidos
+        ON mensajes_conversacion (conversacion_id, remitente_id) WHERE leido = 0
+    ''')
+
+def recalcular_contadores_conversaciones(conn):
+    """Recalcula total_mensajes y último mensaje de cada conversación desde los mensajes"""
+    conn.execute('''
+        UPDATE conversaciones
+        SET total_mensajes = (
+                SELECT COUNT(*) FROM mensajes_conversacion m WHERE m.conversacion_id = conversaciones.id
+            ),
+            ultimo_mensaje_id = (
+                SELECT MAX(m.id) FROM mensajes_conversacion m WHERE m.conversacion_id = conversaciones.id
+            )
+    ''')
+    conn.execute('''
+        UPDATE conversaciones
+        SET ultimo_mensaje = (
+            SELECT substr(m.mensaje, 1, 100) FROM mensajes_conversacion m WHERE m.id = conversaciones.ultimo_mensaje_id
+        )
+    ''')
+
+def _migracion_contadores_conversaciones(conn):
+    columnas = {fila[1] for fila in conn.execute('PRAGMA table_info(conversaciones)')}
+    if 'total_mensajes' not in columnas:
+        conn.execute('ALTER TABLE conversaciones ADD COLUMN total_mensajes INTEGER NOT NULL DEFAULT 0')
+    if 'ultimo_mensaje_id' not in columnas:
+        conn.execute('ALTER TABLE conversaciones ADD COLUMN ultimo_mensaje_id INTEGER')
+    if 'ultimo_mensaje' not in columnas:
+        conn.execute('ALTER TABLE conversaciones ADD COLUMN ultimo_mensaje TEXT')
+    
+    # Los triggers mantienen los contadores sin importar qué endpoint escriba
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_mensajes_conversacion_insert
+        AFTER INSERT ON mensajes_conversacion
+        BEGIN
+            UPDATE conversaciones
+            SET total_mensajes = total_mensajes + 1,
+                ultimo_mensaje_id = NEW.id,
+                ultimo_mensaje = substr(NEW.mensaje, 1, 100)
+            WHERE id = NEW.conversacion_id;
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_mensajes_conversacion_delete
+        AFTER DELETE ON mensajes_conversacion
+        BEGIN
+            UPDATE conversaciones
+            SET total_mensajes = total_mensajes - 1,
+                ultimo_mensaje_id = (
+                    SELECT MAX(id) FROM mensajes_conversacion WHERE conversacion_id = OLD.conversacion_id
+                ),
+                ultimo_mensaje = (
+                    SELECT substr(mensaje, 1, 100) FROM mensajes_conversacion
+                    WHERE conversacion_id = OLD.conversacion_id
+                    ORDER BY id DESC LIMIT 1
+                )
+            WHERE id = OLD.conversacion_id;
+        END
+    ''')
+    recalcular_contadores_conversaciones(conn)
+
+def _migracion_marcas_notificaciones(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS lecturas_notificaciones_admin (
+            admin_id INTEGER PRIMARY KEY,
+            ultimo_mensaje_id INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY (admin_id) REFERENCES usuarios (id)
+        )
+    ''')
+    # La marca inicial queda justo antes de la primera notificación sin leer de cada admin
+    conn.execute('''
+        INSERT OR IGNORE INTO lecturas_notificaciones_admin (admin_id, ultimo_mensaje_id)
+        SELECT u.id, COALESCE(
+            (SELECT MIN(n.mensaje_id) - 1 FROM notificaciones_admin n
+             WHERE n.admin_id = u.id AND n.leida = 0),
+            (SELECT MAX(m.id) FROM mensajes_soporte m),
+            0
+        )
+        FROM usuarios u
+        WHERE u.tipo_usuario = 'administrador'
+    ''')
 
+# Qué clave de versiones_datos sube cada escritura: (tabla, evento, expresión de la clave)
+TRIGGERS_VERSIONES = [
+    ('rutas', 'INSERT', "'rutas'"),
+    ('rutas', 'UPDATE', "'rutas'"),
+    ('rutas', 'DELETE', "'rutas'"),
+    ('vehiculos', 'INSERT', "'vehiculos'"),
+    ('vehiculos', 'UPDATE', "'vehiculos'"),
+    ('vehiculos', 'DELETE', "'vehiculos'"),
+    ('horarios', 'INSERT', "'horarios:' || NEW.ruta_id"),
+    ('horarios', 'UPDATE', "'horarios:' || NEW.ruta_id"),
+    ('horarios', 'DELETE', "'horarios:' || OLD.ruta_id"),
+    ('reservas', 'INSERT', "'horarios:' || (SELECT ruta_id FROM horarios WHERE id = NEW.horario_id)"),
+    ('reservas', 'UPDATE', "'horarios:' || (SELECT ruta_id FROM horarios WHERE id = NEW.horario_id)"),
+    ('reservas', 'DELETE', "'horarios:' || (SELECT ruta_id FROM horarios WHERE id = OLD.horario_id)"),
+]
+
+def _migracion_versiones_datos(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS versiones_datos (
+            clave TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    # Los triggers suben la versión en cualquier escritura, venga del endpoint, del barrido o de la consola
+    for tabla, evento, clave in TRIGGERS_VERSIONES:
+        conn.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_version_{tabla}_{evento.lower()}
+            AFTER {evento} ON {tabla}
+            BEGIN
+                INSERT INTO versiones_datos (clave, version) VALUES ({clave}, 1)
+                ON CONFLICT (clave) DO UPDATE SET version = version + 1;
+            END
+        ''')
+    # Si un horario cambia de ruta, la ruta anterior también debe invalidarse
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_version_horarios_cambio_ruta
+        AFTER UPDATE OF ruta_id ON horarios
+        WHEN OLD.ruta_id IS NOT NEW.ruta_id
+        BEGIN
+            INSERT INTO versiones_datos (clave, version) VALUES ('horarios:' || OLD.ruta_id, 1)
+            ON CONFLICT (clave) DO UPDATE SET version = version + 1;
+        END
+    ''')
+
+def _migracion_frecuencias_rutas(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS frecuencias_rutas (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ruta_id INTEGER NOT NULL,
+            hora_salida TEXT NOT NULL,
+            dias_semana TEXT NOT NULL DEFAULT '0123456',
+            activa BOOLEAN DEFAULT TRUE,
+            UNIQUE (ruta_id, hora_salida),
+            FOREIGN KEY (ruta_id) REFERENCES rutas (id)
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS horizonte_horarios (
+            ruta_id INTEGER PRIMARY KEY,
+            hasta DATE NOT NULL,
+            FOREIGN KEY (ruta_id) REFERENCES rutas (id)
+        )
+    ''')
+    # Lo ya generado por la versión anterior cuenta como horizonte para no duplicar salidas
+    conn.execute('''
+        INSERT OR IGNORE INTO horizonte_horarios (ruta_id, hasta)
+        SELECT ruta_id, MAX(date(fecha_salida)) FROM horarios GROUP BY ruta_id
+    ''')
+    # capacidad_minima llega en la migración 13 y la 15 la siembra para estas filas
+    completar_frecuencias_defecto(conn, con_capacidad=False)
+
+def _migracion_asignacion_vehiculos(conn):
+    columnas = {fila[1] for fila in conn.execute('PRAGMA table_info(frecuencias_rutas)')}
+    if 'capacidad_minima' not in columnas:
+        conn.execute('ALTER TABLE frecuencias_rutas ADD COLUMN capacidad_minima INTEGER NOT NULL DEFAULT 1')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_horarios_vehiculo_salida ON horarios (vehiculo_id, fecha_salida)')
+
+def _migracion_capacidad_minima_rutas(conn):
+    # Las frecuencias que conservan el DEFAULT 1 de la migración 13 reciben la del tipo de ruta
+    capacidad, parametros = _capacidad_tipo_ruta('r.tipo_ruta')
+    conn.execute(f'''
+        UPDATE frecuencias_rutas
+        SET capacidad_minima = (SELECT {capacidad} FROM rutas r WHERE r.id = frecuencias_rutas.ruta_id)
+        WHERE capacidad_minima = 1
+    ''', parametros)
+
+def _migracion_salidas_sin_vehiculo(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS salidas_sin_vehiculo (
+            ruta_id INTEGER NOT NULL,
+            fecha_salida TEXT NOT NULL,
+            PRIMARY KEY (ruta_id, fecha_salida),
+            FOREIGN KEY (ruta_id) REFERENCES rutas (id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migracion_sesiones_servidor(conn):
+    columnas = {fila[1] for fila in conn.execute('PRAGMA table_info(sesiones)')}
+    if 'datos' not in columnas:
+        conn.execute("ALTER TABLE sesiones ADD COLUMN datos TEXT NOT NULL DEFAULT '{}'")
+    if 'ultimo_acceso' not in columnas:
+        conn.execute('ALTER TABLE sesiones ADD COLUMN ultimo_acceso TIMESTAMP')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_expiracion ON sesiones (fecha_expiracion)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sesiones_usuario ON sesiones (usuario_id)')
+
+def _migracion_usuarios_administrador(conn):
+    # Bases antiguas se crearon sin 'administrador' en el CHECK de tipo_usuario
+    fila = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'usuarios'").fetchone()
+    if fila and 'administrador' not in fila[0]:
+        _reconstruir_tabla(conn, 'usuarios', ESQUEMA_USUARIOS)
+
+# Migraciones ordenadas: (versión, descripción, función). Nunca renumerar ni editar
+# una migración ya publicada; agregar una nueva al final.
+MIGRACIONES = [
+    (1, 'esquema base', _migracion_esquema_base),
+    (2, 'índices para consultas frecuentes', _migracion_indices),
+    (3, 'tipo administrador en usuarios', _migracion_usuarios_administrador),
+    (4, 'índice compuesto de horarios por ruta, salida y estado', _migracion_indice_horarios),
+    (5, 'mapa de asientos por horario', _migracion_mapa_asientos),
+    (6, 'índice de vencimiento de reservas', _migracion_indice_vencimiento),
+    (7, 'bitácora de eventos de chat', _migracion_eventos_chat),
+    (8, 'cursor de mensajes por conversación', _migracion_cursor_mensajes),
+    (9, 'contadores de mensajes en conversaciones', _migracion_contadores_conversaciones),
+    (10, 'marcas de lectura de notificaciones de administradores', _migracion_marcas_notificaciones),
+    (11, 'versiones de datos para la caché de lecturas', _migracion_versiones_datos),
+    (12, 'frecuencias por ruta y horizonte de horarios', _migracion_frecuencias_rutas),
+    (13, 'asignación de vehículos sin solapes', _migracion_asignacion_vehiculos),
+    (14, 'sesiones guardadas en el servidor', _migracion_sesiones_servidor),
+    (15, 'capacidad mínima de vehículo por tipo de ruta', _migracion_capacidad_minima_rutas),
+    (16, 'salidas pendientes de vehículo', _migracion_salidas_sin_vehiculo),
+]
+
+def version_esquema(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def aplicar_migraciones():
+    """Aplica en orden las migraciones pendientes según PRAGMA user_version"""
+    conn = get_db()
+    if version_esquema(conn) >= MIGRACIONES[-1][0]:
+        return
+    
+    for numero, descripcion, migracion in MIGRACIONES:
+        # Cada migración corre en su propia transacción con el candado de escritura;
+        # la versión se relee adentro porque otro worker pudo aplicarla mientras esperábamos
+        comenzar_escritura(conn)
+        try:
+            if version_esquema(conn) >= numero:
+                conn.rollback()
+                continue
+            migracion(conn)
+            conn.execute(f'PRAGMA user_version = {numero}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"✓ Migración {numero} aplicada: {descripcion}")
+
+_esquema_listo = False
+
+@app.before_request
+def preparar_esquema():
+    """Garantiza una sola vez por proceso que el esquema esté al día"""
+    global _esquema_listo
+    if not _esquema_listo:
+        aplicar_migraciones()
+        iniciar_barrido_reservas()
+        _esquema_listo = True
+
+# Consultas calientes con parámetros de ejemplo; ninguna debe recorrer una tabla completa
+CONSULTAS_FRECUENTES = {
+    'usuarios_admin': ('SELECT id FROM usuarios WHERE tipo_usuario = "administrador"', ()),
+    'solicitudes_pendientes': ('''
+        SELECT s.id FROM solicitudes_servicio s
+        JOIN usuarios u ON s.usuario_id = u.id
+        WHERE s.estado = 'pendiente' AND s.conductor_id IS NULL
+        ORDER BY s.fecha_solicitud DESC
+    ''', ()),
+    'solicitudes_conductor': ('''
+        SELECT s.id FROM solicitudes_servicio s
+        JOIN usuarios u ON s.usuario_id = u.id
+        WHERE s.conductor_id = ?
+        ORDER BY s.fecha_solicitud DESC
+    ''', (1,)),
+    'solicitudes_usuario': ('''
+        SELECT s.id FROM solicitudes_servicio s
+        LEFT JOIN conductores c ON s.conductor_id = c.id
+        LEFT JOIN usuarios u ON c.usuario_id = u.id
+        WHERE s.usuario_id = ?
+        ORDER BY s.fecha_solicitud DESC
+    ''', (1,)),
+    'mensajes_soporte_estado': ('''
+        SELECT m.id FROM mensajes_soporte m
+        JOIN usuarios u ON m.usuario_id = u.id
+        WHERE m.estado = ?
+    ''', ('pendiente',)),
+    'notificaciones_admin': ('''
+        SELECT COUNT(*) FROM mensajes_soporte
+        WHERE id > COALESCE((
+            SELECT ultimo_mensaje_id FROM lecturas_notificaciones_admin WHERE admin_id = ?
+        ), 0)
+    ''', (1,)),
+    'horarios_ruta': ('''
+        SELECT h.id FROM horarios h
+        JOIN vehiculos v ON h.vehiculo_id = v.id
+        WHERE h.ruta_id = ? AND h.fecha_salida >= ? AND h.fecha_salida < ?
+        AND h.estado = 'programado' AND h.asientos_disponibles > 0
+        ORDER BY h.fecha_salida
+    ''', (1, '2025-01-01', '2025-01-02')),
+    'versiones_datos': (
+        'SELECT clave, version FROM versiones_datos WHERE clave IN (?, ?, ?)',
+        ('rutas', 'vehiculos', 'horarios:1')),
+    'rutas_activas': (
+        'SELECT id FROM rutas WHERE activa = 1 ORDER BY origen, destino', ()),
+    'reservas_usuario': ('''
+        SELECT r.id FROM reservas r
+        JOIN horarios h ON r.horario_id = h.id
+        JOIN rutas ru ON h.ruta_id = ru.id
+        JOIN vehiculos v ON h.vehiculo_id = v.id
+        WHERE r.usuario_id = ?
+        ORDER BY r.fecha_reserva DESC
+    ''', (1,)),
+    'conversaciones_admin': ('''
+        SELECT c.id, c.total_mensajes
+        FROM conversaciones c
+        JOIN usuarios u ON c.usuario_id = u.id
+        LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?
+        ORDER BY c.fecha_ultima_actividad DESC
+    ''', (1,)),
+    'conversaciones_usuario': ('''
+        SELECT c.id, c.total_mensajes
+        FROM conversaciones c
+        LEFT JOIN usuarios a ON c.admin_id = a.id
+        LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?
+        WHERE c.usuario_id = ?
+        ORDER BY c.fecha_ultima_actividad DESC
+    ''', (1, 1)),
+    'mensajes_conversacion': ('''
+        SELECT m.id FROM mensajes_conversacion m
+        JOIN usuarios u ON m.remitente_id = u.id
+        WHERE m.conversacion_id = ?
+        ORDER BY m.id ASC
+    ''', (1,)),
+    'mensajes_conversacion_cursor': ('''
+        SELECT m.id FROM mensajes_conversacion m
+        JOIN usuarios u ON m.remitente_id = u.id
+        WHERE m.conversacion_id = ? AND m.id > ?
+        ORDER BY m.id ASC LIMIT ?
+    ''', (1, 0, 50)),
+    'mensajes_sin_leer': ('''
+        SELECT EXISTS (
+            SELECT 1 FROM mensajes_conversacion
+            WHERE conversacion_id = ? AND leido = 0 AND remitente_id != ?
+        )
+    ''', (1, 1)),
+    'asientos_ocupados': ('''
+        SELECT numero_asiento FROM reservas
+        WHERE horario_id = ? AND estado != 'cancelada' AND numero_asiento IS NOT NULL
+    ''', (1,)),
+    'reservas_vencidas': ('''
+        SELECT id, horario_id FROM reservas
+        WHERE estado = 'pendiente' AND fecha_vencimiento < ?
+        ORDER BY fecha_vencimiento LIMIT ?
+    ''', ('2025-01-01 00:00:00', 100)),
+    'no_leidos_usuario': ('''
+        SELECT COALESCE(SUM(mensajes_no_leidos), 0)
+        FROM participantes_conversacion WHERE usuario_id = ?
+    ''', (1,)),
+    'sesion_por_token': ('''
+        SELECT datos, usuario_id FROM sesiones
+        WHERE token = ? AND activa = 1 AND fecha_expiracion > ?
+    ''', ('x', '2025-01-01 00:00:00')),
+    'sesiones_vencidas': ('''
+        DELETE FROM sesiones WHERE id IN (
+            SELECT id FROM sesiones WHERE fecha_expiracion < ? LIMIT ?
+        )
+    ''', ('2025-01-01 00:00:00', 500)),
+}
+
+def verificar_planes_consultas(conn):
+    """Devuelve las consultas frecuentes cuyo plan recorre una tabla completa"""
+    fallos = []
+    for nombre, (sql, parametros) in CONSULTAS_FRECUENTES.items():
+        plan = conn.execute('EXPLAIN QUERY PLAN ' + sql, parametros).fetchall()
+        for fila in plan:
+            detalle = fila[-1]
+            # "SCAN t USING INDEX ..." recorre un índice en orden y "SCAN CONSTANT ROW"
+            # no lee tablas; solo "SCAN t" es un full scan
+            if detalle.startswith('SCAN ') and ' USING ' not in detalle and detalle != 'SCAN CONSTANT ROW':
+                fallos.append((nombre, detalle))
+    return fallos
+
+@app.cli.command('verificar-indices')
+def comando_verificar_indices():
+    """Falla si alguna consulta frecuente cae en un SCAN completo"""
+    aplicar_migraciones()
+    fallos = verificar_planes_consultas(get_db())
+    for nombre, detalle in fallos:
+        print(f"✗ {nombre}: {detalle}")
+    if fallos:
+        raise SystemExit(1)
+    print(f"✓ {len(CONSULTAS_FRECUENTES)} consultas frecuentes usan índices")
+
+@app.cli.command('reparar-contadores')
+def comando_reparar_contadores():
+    """Recalcula los contadores desnormalizados de mensajes por conversación"""
+    aplicar_migraciones()
+    conn = get_db()
+    comenzar_escritura(conn)
+    recalcular_contadores_conversaciones(conn)
     conn.commit()
-    conn.close()
+    total = conn.execute('SELECT COUNT(*) FROM conversaciones').fetchone()[0]
+    print(f"✓ Contadores recalculados para {total} conversaciones")
+
+# ============================================
+# PAGINACIÓN Y FILTROS DE LISTADOS
+# ============================================
+
+LIMITE_PAGINA_DEFECTO = 50
+LIMITE_PAGINA_MAX = 200
+
+MENSAJE_PARAMETROS_INVALIDOS = 'Parámetros de paginación o filtro inválidos'
+
+def codificar_cursor(valores):
+    """Empaqueta las claves de orden de la última fila en un cursor opaco"""
+    datos = json.dumps(valores, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(datos).decode('ascii').rstrip('=')
+
+def decodificar_cursor(cursor):
+    """Claves de orden de un cursor; ValueError si no es una lista de valores SQL simples"""
+    relleno = '=' * (-len(cursor) % 4)
+    valores = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+    if not isinstance(valores, list) or not valores:
+        raise ValueError('Cursor inválido')
+    if not all(valor is None or (isinstance(valor, (str, int, float)) and not isinstance(valor, bool))
+               for valor in valores):
+        raise ValueError('Cursor inválido')
+    return valores
+
+def leer_pagina():
+    """Lee ?limit= y ?cursor=; sin ellos se entrega la primera página de LIMITE_PAGINA_DEFECTO filas"""
+    limite = request.args.get('limit', type=int)
+    cursor = request.args.get('cursor')
+    return {
+        'limite': max(1, min(limite or LIMITE_PAGINA_DEFECTO, LIMITE_PAGINA_MAX)),
+        'valores': decodificar_cursor(cursor) if cursor else None
+    }
+
+def leer_filtros(exactos=None, columna_fecha=None):
+    """Traduce los filtros de la URL a condiciones SQL; desde/hasta son fechas inclusivas"""
+    condiciones = []
+    parametros = []
+    
+    for nombre, columna in (exactos or {}).items():
+        valor = request.args.get(nombre)
+        if valor and valor != 'todos':
+            condiciones.append(f'{columna} = ?')
+            parametros.append(valor)
+    
+    if columna_fecha:
+        desde = request.args.get('desde')
+        hasta = request.args.get('hasta')
+        if desde:
+            condiciones.append(f'{columna_fecha} >= ?')
+            parametros.append(datetime.strptime(desde, '%Y-%m-%d').strftime('%Y-%m-%d'))
+        if hasta:
+            fin = datetime.strptime(hasta, '%Y-%m-%d') + timedelta(days=1)
+            condiciones.append(f'{columna_fecha} < ?')
+            parametros.append(fin.strftime('%Y-%m-%d'))
+    
+    return condiciones, parametros
+
+def _condicion_keyset(orden, valores):
+    # Filas estrictamente posteriores a (k1, k2, ..., id) según el orden de cada clave
+    alternativas = []
+    parametros = []
+    for i, (expresion, descendente) in enumerate(orden):
+        partes = [f'{orden[j][0]} = ?' for j in range(i)]
+        partes.append(f"{expresion} {'<' if descendente else '>'} ?")
+        alternativas.append('(' + ' AND '.join(partes) + ')')
+        parametros += valores[:i + 1]
+    
+    # Acotar también la primera clave sola permite al planificador buscar en su índice
+    primera, descendente = orden[0]
+    condicion = f"({primera} {'<=' if descendente else '>='} ? AND ({' OR '.join(alternativas)}))"
+    return condicion, [valores[0]] + parametros
+
+def consultar_listado(cursor, columnas, origen, filtros, orden, pagina, registro=None):
+    """Ejecuta un listado filtrado en SQL con orden keyset; devuelve (filas, siguiente_cursor)
+
+    orden es una lista de (expresión, descendente) que debe terminar en el id de la fila.
+    Las claves de orden se agregan al final de cada fila para construir el cursor; si se
+    indica un registro, las filas se entregan como ese registro y sin las claves de orden.
+    """
+    condiciones, parametros = list(filtros[0]), list(filtros[1])
+    
+    if pagina and pagina['valores'] is not None:
+        if len(pagina['valores']) != len(orden):
+            raise ValueError('Cursor inválido')
+        condicion, extra = _condicion_keyset(orden, pagina['valores'])
+        condiciones.append(condicion)
+        parametros += extra
+    
+    sql = f"SELECT {columnas}, {', '.join(expresion for expresion, _ in orden)} FROM {origen}"
+    if condiciones:
+        sql += ' WHERE ' + ' AND '.join(condiciones)
+    sql += ' ORDER BY ' + ', '.join(
+        f"{expresion} {'DESC' if descendente else 'ASC'}" for expresion, descendente in orden
+    )
+    if pagina:
+        sql += ' LIMIT ?'
+        parametros.append(pagina['limite'] + 1)
+    
+    cursor.execute(sql, parametros)
+    filas = cursor.fetchall()
+    
+    siguiente_cursor = None
+    if pagina and len(filas) > pagina['limite']:
+        filas = filas[:pagina['limite']]
+        siguiente_cursor = codificar_cursor(list(filas[-1][-len(orden):]))
+    if registro is not None:
+        campos = len(registro._fields)
+        filas = [registro._make(fila[:campos]) for fila in filas]
+    return filas, siguiente_cursor
+
+# ============================================
+# CACHÉ DE ROLES
+# ============================================
+
+# Segundos que un rol leído de la base se da por bueno; acota cuánto tarda en notarse una revocación
+CACHE_ROLES_TTL = float(os.environ.get('CACHE_ROLES_TTL', '30'))
+
+class CacheRoles:
+    """Roles de usuario y conjunto de administradores en memoria del proceso, con vencimiento"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._roles = {}
+        self._admins = None
+        self._lock = threading.Lock()
+
+    def tipo_usuario(self, usuario_id):
+        ahora = time.monotonic()
+        with self._lock:
+            guardado = self._roles.get(usuario_id)
+        if guardado and guardado[1] > ahora:
+            return guardado[0]
+        
+        with conexion_actual() as conn:
+            fila = conn.execute(
+                'SELECT tipo_usuario FROM usuarios WHERE id = ?', (usuario_id,)
+            ).fetchone()
+        tipo = fila[0] if fila else None
+        with self._lock:
+            self._roles[usuario_id] = (tipo, ahora + self.ttl)
+        return tipo
+
+    def ids_administradores(self):
+        ahora = time.monotonic()
+        with self._lock:
+            guardado = self._admins
+        if guardado and guardado[1] > ahora:
+            return guardado[0]
+        
+        with conexion_actual() as conn:
+            filas = conn.execute(
+                "SELECT id FROM usuarios WHERE tipo_usuario = 'administrador'"
+            ).fetchall()
+        ids = frozenset(f[0] for f in filas)
+        with self._lock:
+            self._admins = (ids, ahora + self.ttl)
+        return ids
+
+    def invalidar(self, usuario_id=None):
+        """Descarta el rol de un usuario (o todos) y el conjunto de administradores"""
+        with self._lock:
+            if usuario_id is None:
+                self._roles.clear()
+            else:
+                self._roles.pop(usuario_id, None)
+            self._admins = None
+
+cache_roles = CacheRoles(CACHE_ROLES_TTL)
+
+def es_administrador_sesion():
+    """Confirma que la sesión sea de un administrador que conserva ese rol en la base"""
+    if 'usuario_id' not in session or session.get('tipo_usuario') != 'administrador':
+        return False
+    return cache_roles.tipo_usuario(session['usuario_id']) == 'administrador'
+
+# ============================================
+# CREDENCIALES
+# ============================================
+
+# Método y costo de werkzeug para los hashes nuevos ('scrypt:32768:8:1', 'pbkdf2:sha256:600000', ...).
+# Al cambiarlo, cada usuario se migra al nuevo método en su siguiente inicio de sesión.
+PASSWORD_METODO = os.environ.get('PASSWORD_METODO', 'scrypt')
+# Procesos que calculan hashes (0 los calcula en el hilo de la petición) y trabajos en vuelo.
+# Son por worker web, no globales: con N workers de gunicorn hay hasta N * CREDENCIALES_PROCESOS
+# procesos calculando hashes, así que en producción conviene bajarlo a núcleos / workers.
+CREDENCIALES_PROCESOS = int(os.environ.get('CREDENCIALES_PROCESOS', str(os.cpu_count() or 1)))
+CREDENCIALES_EN_VUELO = int(os.environ.get('CREDENCIALES_EN_VUELO', str(4 * max(CREDENCIALES_PROCESOS, 1))))
+# Segundos que una petición espera turno y resultado antes de rendirse
+CREDENCIALES_ESPERA = float(os.environ.get('CREDENCIALES_ESPERA', '5'))
+
+# Ventana deslizante de intentos de inicio de sesión por IP (la real, vía ProxyFix) y por email.
+# Cada worker lleva su propia cuenta en memoria: el máximo efectivo es el límite por el número de workers
+LOGIN_VENTANA_SEGUNDOS = int(os.environ.get('LOGIN_VENTANA_SEGUNDOS', '300'))
+LOGIN_MAX_POR_IP = int(os.environ.get('LOGIN_MAX_POR_IP', '30'))
+LOGIN_MAX_POR_EMAIL = int(os.environ.get('LOGIN_MAX_POR_EMAIL', '10'))
+
+class ServicioCredenciales:
+    """Calcula y verifica hashes de contraseñas en un pool acotado de procesos
+
+    El KDF ocupa la CPU a propósito; fuera del worker web no retiene el GIL y el semáforo
+    limita cuántos cálculos puede encolar cada proceso. El pool usa forkserver para no
+    heredar los hilos del servidor y se crea de nuevo en cada proceso hijo tras un fork.
+    """
+
+    def __init__(self, metodo, procesos, en_vuelo, espera):
+        self.metodo = metodo
+        self.procesos = procesos
+        self.espera = espera
+        self._en_vuelo = threading.BoundedSemaphore(en_vuelo)
+        self._prefijo = None
+        self._pool = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _ejecutor(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    contexto = multiprocessing.get_context('forkserver')
+                    contexto.set_forkserver_preload(['werkzeug.security'])
+                    self._pool = concurrent.futures.ProcessPoolExecutor(self.procesos, mp_context=contexto)
+        return self._pool
+
+    def _ejecutar(self, funcion, *argumentos):
+        if self.procesos <= 0:
+            return funcion(*argumentos)
+        if not self._en_vuelo.acquire(timeout=self.espera):
+            raise TimeoutError('El servicio de credenciales está saturado, intente de nuevo')
+        try:
+            return self._ejecutor().submit(funcion, *argumentos).result(timeout=self.espera)
+        finally:
+            self._en_vuelo.release()
+
+    def generar(self, password):
+        """Hash de la contraseña con el método configurado"""
+        return self._ejecutar(generate_password_hash, password, self.metodo)
+
+    def verificar(self, password_hash, password):
+        return self._ejecutar(check_password_hash, password_hash, password)
+
+    def necesita_rehash(self, password_hash):
+        """True si el hash guardado no usa el método y costo configurados"""
+        if self._prefijo is None:
+            # werkzeug completa los parámetros por defecto ('scrypt' -> 'scrypt:32768:8:1')
+            self._prefijo = generate_password_hash('', self.metodo).split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._prefijo
+
+    def cerrar(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
+
+credenciales = ServicioCredenciales(
+    PASSWORD_METODO, CREDENCIALES_PROCESOS, CREDENCIALES_EN_VUELO, CREDENCIALES_ESPERA
+)
+
+class LimitadorIntentos:
+    """Ventana deslizante por clave: recuerda la hora de los últimos intentos de cada una
+
+    Guarda como mucho maximo marcas por clave, así que el rechazo cuesta lo mismo sin importar
+    cuántos intentos lleguen. Es por proceso, como la caché de roles.
+    """
+
+    def __init__(self, ventana, maximo):
+        self.ventana = ventana
+        self.maximo = maximo
+        self._intentos = {}
+        self._lock = threading.Lock()
+        self._ultima_poda = time.monotonic()
+
+    def consumir(self, clave):
+        """Registra un intento si hay cupo; si no, devuelve los segundos que faltan para tenerlo"""
+        ahora = time.monotonic()
+        with self._lock:
+            if ahora - self._ultima_poda > self.ventana:
+                self._podar(ahora)
+            marcas = self._intentos.get(clave)
+            if marcas is None:
+                marcas = self._intentos[clave] = deque(maxlen=self.maximo)
+            elif len(marcas) == self.maximo and marcas[0] > ahora - self.ventana:
+                return marcas[0] + self.ventana - ahora
+            marcas.append(ahora)
+            return 0
+
+    def limpiar(self, clave):
+        with self._lock:
+            self._intentos.pop(clave, None)
+
+    def _podar(self, ahora):
+        limite = ahora - self.ventana
+        for clave in [clave for clave, marcas in self._intentos.items() if marcas[-1] <= limite]:
+            del self._intentos[clave]
+        self._ultima_poda = ahora
+
+limitador_login_ip = LimitadorIntentos(LOGIN_VENTANA_SEGUNDOS, LOGIN_MAX_POR_IP)
+limitador_login_email = LimitadorIntentos(LOGIN_VENTANA_SEGUNDOS, LOGIN_MAX_POR_EMAIL)
+
+def respuesta_demasiados_intentos(espera):
+    respuesta = jsonify({
+        'success': False,
+        'message': 'Demasiados intentos, intente de nuevo más tarde'
+    })
+    respuesta.headers['Retry-After'] = str(int(espera) + 1)
+    return respuesta, 429
+
+def actualizar_hash_password(usuario_id, hash_anterior, password):
+    """Guarda la contraseña con el método actual si nadie la cambió desde que se leyó"""
+    try:
+        nuevo_hash = credenciales.generar(password)
+        conn = get_db()
+        conn.execute(
+            'UPDATE usuarios SET password_hash = ? WHERE id = ? AND password_hash = ?',
+            (nuevo_hash, usuario_id, hash_anterior)
+        )
+        conn.commit()
+    except Exception as e:
+        print(f"Error actualizando hash de contraseña: {e}")
+
+@app.cli.command('rendimiento-credenciales')
+@click.option('--logins', default=40, help='Verificaciones por medición')
+@click.option('--procesos', default=os.cpu_count() or 1, help='Procesos del pool de credenciales')
+@click.option('--metodo', default=PASSWORD_METODO, help='Método de hash a medir')
+def comando_rendimiento_credenciales(logins, procesos, metodo):
+    """Mide inicios de sesión por segundo y por núcleo, en línea y a través del pool"""
+    password_hash = generate_password_hash('Clave-de-prueba-1', metodo)
+    print(f"Método {password_hash.split('$', 1)[0]}")
+    
+    inicio = time.perf_counter()
+    for _ in range(logins):
+        check_password_hash(password_hash, 'Clave-de-prueba-1')
+    duracion = time.perf_counter() - inicio
+    print(f"En línea: {logins / duracion:.1f} logins/s en un núcleo")
+    
+    servicio = ServicioCredenciales(metodo, procesos, 2 * procesos, 60)
+    try:
+        servicio.verificar(password_hash, 'Clave-de-prueba-1')  # arranca los procesos fuera de la medición
+        with concurrent.futures.ThreadPoolExecutor(2 * procesos) as hilos:
+            inicio = time.perf_counter()
+            resultados = list(hilos.map(
+                lambda _: servicio.verificar(password_hash, 'Clave-de-prueba-1'), range(logins)
+            ))
+            duracion = time.perf_counter() - inicio
+    finally:
+        servicio.cerrar()
+    nucleos = min(procesos, os.cpu_count() or 1)
+    print(f"Pool de {procesos} procesos: {logins / duracion:.1f} logins/s "
+          f"({logins / duracion / nucleos:.1f} por núcleo)")
+    
+    limitador = LimitadorIntentos(60, 10)
+    inicio = time.perf_counter()
+    rechazados = sum(1 for _ in range(100000) if limitador.consumir('203.0.113.7'))
+    duracion = time.perf_counter() - inicio
+    print(f"Limitador: {rechazados} de 100000 intentos rechazados a {100000 / duracion:,.0f} por segundo")
+    
+    if not all(resultados) or rechazados != 100000 - 10:
+        print("✗ Resultados inesperados")
+        raise SystemExit(1)
+    print("✓ Verificaciones correctas")
+
+# ============================================
+# SESIONES EN EL SERVIDOR
+# ============================================
+
+# Horas sin actividad tras las cuales una sesión vence
+SESIONES_DURACION_HORAS = int(os.environ.get('SESIONES_DURACION_HORAS', '12'))
+# Sesiones que cada proceso mantiene en memoria y segundos que una copia se da por buena
+# (acota cuánto tarda otro worker en notar un cierre de sesión)
+SESIONES_CACHE_MAX = int(os.environ.get('SESIONES_CACHE_MAX', '4096'))
+SESIONES_CACHE_TTL = float(os.environ.get('SESIONES_CACHE_TTL', '10'))
+# Cada cuánto se escriben juntos los últimos accesos y se borran las sesiones vencidas
+SESIONES_ACCESOS_SEGUNDOS = float(os.environ.get('SESIONES_ACCESOS_SEGUNDOS', '30'))
+SESIONES_LIMPIEZA_SEGUNDOS = float(os.environ.get('SESIONES_LIMPIEZA_SEGUNDOS', '3600'))
+SESIONES_LIMPIEZA_LOTE = 500
+
+def _hora_sql(instante):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(instante))
+
+def _conexion_sesiones():
+    """Conexión de la petición sin transacción abierta para escribir sesiones
+
+    save_session corre después de la vista: lo que esta dejó sin confirmar (por ejemplo al
+    devolver un 500 a mitad de camino) se descarta, igual que al devolver la conexión al pool,
+    en vez de confirmarse junto con la sesión.
+    """
+    conn = get_db()
+    if conn.in_transaction:
+        conn.rollback()
+    return conn
+
+class SesionServidor(CallbackDict, SessionMixin):
+    """Datos de la sesión; la cookie solo lleva el token firmado que la identifica"""
+
+    def __init__(self, datos=None, token=None, usuario_id=None):
+        def al_cambiar(sesion):
+            sesion.modified = True
+        super().__init__(datos, al_cambiar)
+        self.token = token
+        self.usuario_id = usuario_id
+        self.modified = False
+
+class AlmacenSesiones:
+    """Sesiones en la tabla sesiones con una LRU por proceso delante
+
+    En la base se guarda el sha256 del token, no el token. Los accesos de sesiones que no
+    cambiaron se acumulan en memoria y se escriben en una sola transacción cada
+    SESIONES_ACCESOS_SEGUNDOS, extendiendo de paso su vencimiento.
+    """
+
+    def __init__(self, maximo, ttl):
+        self.maximo = maximo
+        self.ttl = ttl
+        self._entradas = OrderedDict()
+        self._accesos = {}
+        self._lock = threading.Lock()
+        self._ultima_escritura = self._ultima_limpieza = time.monotonic()
+
+    def cargar(self, clave):
+        """(datos, usuario_id) de una sesión vigente, o None"""
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None and ahora - entrada[2] < self.ttl:
+                self._entradas.move_to_end(clave)
+                return entrada[0], entrada[1]
+        
+        fila = get_db().execute('''
+            SELECT datos, usuario_id FROM sesiones
+            WHERE token = ? AND activa = 1 AND fecha_expiracion > ?
+        ''', (clave, _hora_sql(time.time()))).fetchone()
+        if fila is None:
+            self._olvidar(clave)
+            return None
+        self._recordar(clave, fila[0], fila[1], ahora)
+        return fila[0], fila[1]
+
+    def guardar(self, clave, datos, usuario_id):
+        ahora = time.time()
+        conn = _conexion_sesiones()
+        conn.execute('''
+            INSERT INTO sesiones (usuario_id, token, datos, ultimo_acceso, fecha_expiracion, activa)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (token) DO UPDATE SET
+                usuario_id = excluded.usuario_id, datos = excluded.datos,
+                ultimo_acceso = excluded.ultimo_acceso, fecha_expiracion = excluded.fecha_expiracion
+        ''', (usuario_id, clave, datos, _hora_sql(ahora),
+              _hora_sql(ahora + SESIONES_DURACION_HORAS * 3600)))
+        conn.commit()
+        self._recordar(clave, datos, usuario_id, time.monotonic())
+
+    def eliminar(self, clave):
+        conn = _conexion_sesiones()
+        conn.execute('DELETE FROM sesiones WHERE token = ?', (clave,))
+        conn.commit()
+        self._olvidar(clave)
+
+    def registrar_acceso(self, clave):
+        """Anota el acceso y, si toca, escribe los pendientes y limpia las vencidas"""
+        ahora = time.monotonic()
+        with self._lock:
+            self._accesos[clave] = time.time()
+            if ahora - self._ultima_escritura < SESIONES_ACCESOS_SEGUNDOS:
+                return
+            accesos, self._accesos = self._accesos, {}
+            self._ultima_escritura = ahora
+            limpiar = ahora - self._ultima_limpieza >= SESIONES_LIMPIEZA_SEGUNDOS
+            if limpiar:
+                self._ultima_limpieza = ahora
+        
+        try:
+            self.escribir_accesos(accesos)
+            if limpiar:
+                limpiar_sesiones_vencidas()
+        except Exception as e:
+            print(f"Error actualizando accesos de sesiones: {e}")
+
+    def escribir_accesos(self, accesos):
+        conn = _conexion_sesiones()
+        conn.executemany('''
+            UPDATE sesiones SET ultimo_acceso = ?, fecha_expiracion = ?
+            WHERE token = ? AND activa = 1
+        ''', [(_hora_sql(instante), _hora_sql(instante + SESIONES_DURACION_HORAS * 3600), clave)
+              for clave, instante in accesos.items()])
+        conn.commit()
+
+    def _recordar(self, clave, datos, usuario_id, instante):
+        with self._lock:
+            self._entradas[clave] = (datos, usuario_id, instante)
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.maximo:
+                self._entradas.popitem(last=False)
+
+    def _olvidar(self, clave):
+        with self._lock:
+            self._entradas.pop(clave, None)
+            self._accesos.pop(clave, None)
+
+almacen_sesiones = AlmacenSesiones(SESIONES_CACHE_MAX, SESIONES_CACHE_TTL)
+
+def limpiar_sesiones_vencidas():
+    """Borra por lotes las sesiones vencidas usando idx_sesiones_expiracion"""
+    conn = _conexion_sesiones()
+    ahora = _hora_sql(time.time())
+    borradas = 0
+    while True:
+        cursor = conn.execute('''
+            DELETE FROM sesiones WHERE id IN (
+                SELECT id FROM sesiones WHERE fecha_expiracion < ? LIMIT ?
+            )
+        ''', (ahora, SESIONES_LIMPIEZA_LOTE))
+        conn.commit()
+        borradas += cursor.rowcount
+        if cursor.rowcount < SESIONES_LIMPIEZA_LOTE:
+            return borradas
+
+class InterfazSesiones(SessionInterface):
+    """Sesiones de Flask guardadas en el servidor: cualquier worker atiende cualquier petición"""
+
+    serializador = TaggedJSONSerializer()
+
+    def _firmador(self, app):
+        return Signer(app.secret_key, salt='sesion-servidor')
+
+    def open_session(self, app, request):
+        valor = request.cookies.get(self.get_cookie_name(app))
+        if not valor:
+            return SesionServidor()
+        try:
+            token = self._firmador(app).unsign(valor).decode()
+        except BadSignature:
+            return SesionServidor()
+        
+        guardada = almacen_sesiones.cargar(hashlib.sha256(token.encode()).hexdigest())
+        if guardada is None:
+            return SesionServidor()
+        datos, usuario_id = guardada
+        return SesionServidor(self.serializador.loads(datos), token, usuario_id)
+
+    def save_session(self, app, session, response):
+        # Sin sesión si open_session falló (por ejemplo con el pool saturado): no hay nada que guardar
+        if session is None:
+            return
+        nombre = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        ruta = self.get_cookie_path(app)
+        clave = hashlib.sha256(session.token.encode()).hexdigest() if session.token else None
+        
+        if not session:
+            if session.modified and clave:
+                almacen_sesiones.eliminar(clave)
+                response.delete_cookie(nombre, domain=dominio, path=ruta)
+            return
+        
+        if not session.modified:
+            if clave:
+                almacen_sesiones.registrar_acceso(clave)
+            return
+        
+        usuario_id = session.get('usuario_id')
+        # Un token nuevo en cada cambio de usuario evita fijar la sesión antes del login
+        if clave is None or usuario_id != session.usuario_id:
+            if clave:
+                almacen_sesiones.eliminar(clave)
+            session.token = secrets.token_urlsafe(32)
+            clave = hashlib.sha256(session.token.encode()).hexdigest()
+        almacen_sesiones.guardar(clave, self.serializador.dumps(dict(session)), usuario_id)
+        
+        response.vary.add('Cookie')
+        response.set_cookie(
+            nombre,
+            self._firmador(app).sign(session.token).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=dominio,
+            path=ruta,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+app.session_interface = InterfazSesiones()
+
+@app.cli.command('limpiar-sesiones')
+def comando_limpiar_sesiones():
+    """Borra las sesiones vencidas; los workers también lo hacen cada SESIONES_LIMPIEZA_SEGUNDOS"""
+    borradas = limpiar_sesiones_vencidas()
+    print(f"✓ {borradas} sesiones vencidas eliminadas")
+
+# ============================================
+# REGISTROS DE DATOS
+# ============================================
+
+# Cada consulta del repositorio proyecta exactamente estas columnas, en este orden
+Usuario = namedtuple('Usuario', 'id nombre apellido email password_hash tipo_usuario')
+Conductor = namedtuple('Conductor', 'id usuario_id estado disponible')
+Solicitud = namedtuple('Solicitud', '''id codigo_solicitud tipo_vehiculo origen destino
+    fecha_servicio hora_servicio numero_pasajeros precio_estimado precio_final estado
+    fecha_solicitud observaciones telefono_contacto contacto_nombre contacto_telefono''')
+Reserva = namedtuple('Reserva', '''id codigo_reserva nombre_pasajero cedula_pasajero
+    telefono_pasajero precio_total estado fecha_reserva fecha_vencimiento notas
+    fecha_salida fecha_llegada origen destino tipo_vehiculo placa''')
+Conversacion = namedtuple('Conversacion', '''id asunto tipo estado prioridad fecha_creacion
+    fecha_ultima_actividad otro_participante mensajes_no_leidos total_mensajes
+    ultimo_mensaje_id ultimo_mensaje''')
+Mensaje = namedtuple('Mensaje', 'id mensaje fecha_mensaje leido remitente_nombre remitente_tipo remitente_id')
+Administrador = namedtuple('Administrador', 'id nombre apellido')
+ResumenConversacion = namedtuple('ResumenConversacion', '''id asunto tipo estado prioridad usuario admin
+    total_mensajes fecha_creacion fecha_ultima_actividad''')
 
 def validar_email(email):
     patron = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -332,40 +1668,52 @@ def validar_password(password):
     return True, "Contraseña válida"
 
 def obtener_usuario_por_email(email):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM usuarios WHERE email = ?', (email,))
+    cursor.execute('''
+        SELECT id, nombre, apellido, email, password_hash, tipo_usuario
+        FROM usuarios WHERE email = ?
+    ''', (email,))
     usuario = cursor.fetchone()
-    conn.close()
-    return usuario
+    return Usuario._make(usuario) if usuario else None
+
+def obtener_administrador(usuario_id):
+    fila = get_db().execute('''
+        SELECT id, nombre, apellido
+        FROM usuarios WHERE id = ? AND tipo_usuario = 'administrador'
+    ''', (usuario_id,)).fetchone()
+    return Administrador._make(fila) if fila else None
 
 def crear_usuario(nombre, apellido, email, telefono, cedula, password, tipo_usuario='pasajero'):
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('SELECT id FROM usuarios WHERE email = ? OR cedula = ?', (email, cedula))
         if cursor.fetchone():
-            conn.close()
             return False, "El email o cédula ya están registrados"
         
-        password_hash = generate_password_hash(password)
+        password_hash = credenciales.generar(password)
         
         cursor.execute('''
             INSERT INTO usuarios (nombre, apellido, email, telefono, cedula, password_hash, tipo_usuario)
             VALUES (?, ?, ?, ?, ?, ?, ?)
         ''', (nombre, apellido, email, telefono, cedula, password_hash, tipo_usuario))
+        usuario_id = cursor.lastrowid
+        
+        # Un administrador nuevo solo ve como pendientes los tickets posteriores a su alta
+        if tipo_usuario == 'administrador':
+            marcar_notificaciones_admin(cursor, usuario_id)
         
         conn.commit()
-        usuario_id = cursor.lastrowid
-        conn.close()
+        cache_roles.invalidar(usuario_id)
         return True, usuario_id
     except Exception as e:
         return False, str(e)
 
 def crear_conductor(usuario_id, datos_conductor):
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -384,27 +1732,117 @@ def crear_conductor(usuario_id, datos_conductor):
         
         conn.commit()
         conductor_id = cursor.lastrowid
-        conn.close()
         return True, conductor_id
     except Exception as e:
         return False, str(e)
 
+# ============================================
+# CÓDIGOS DE SEGUIMIENTO
+# ============================================
+
+# Segundo de referencia de los códigos (2024-01-01 UTC); 32 bits alcanzan para más de un siglo
+CODIGOS_EPOCA = 1704067200
+CODIGOS_BITS_CONTADOR = 18
+CODIGOS_BITS_PID = 22
+
+_ALFABETO_BASE32 = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
+# Tabla de 10 bits -> 2 caracteres: codificar de a pares evita la mitad de las búsquedas
+_PARES_BASE32 = [a + b for a in _ALFABETO_BASE32 for b in _ALFABETO_BASE32]
+
+class GeneradorCodigos:
+    """Códigos únicos sin consultar la base: (segundo de arranque, contador, pid) en base32
+
+    Cada campo tiene sus propios bits y los pid no se repiten entre procesos vivos del mismo
+    equipo, que es donde vive la base SQLite. Cuando el contador agota sus 18 bits el proceso
+    toma un segundo nuevo, esperando si hace falta a que el reloj lo alcance: nunca usa un
+    segundo en el que no estaba vivo, así que otro proceso que herede su pid más tarde no
+    puede repetir sus códigos. itertools.count avanza de forma atómica bajo el GIL; el lock
+    solo se toma al cambiar de segundo.
+    """
+
+    def __init__(self):
+        self._reiniciar()
+        os.register_at_fork(after_in_child=self._reiniciar)
+
+    def _reiniciar(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid() & ((1 << CODIGOS_BITS_PID) - 1)
+        self._estado = (self._base_actual(-1), itertools.count())
+
+    def _base_actual(self, anterior):
+        segundo = int(time.time()) - CODIGOS_EPOCA
+        while segundo <= anterior:
+            time.sleep(1 - time.time() % 1)
+            segundo = int(time.time()) - CODIGOS_EPOCA
+        return segundo << CODIGOS_BITS_CONTADOR
+
+    def _renovar(self, agotada):
+        with self._lock:
+            if self._estado[0] == agotada:
+                self._estado = (self._base_actual(agotada >> CODIGOS_BITS_CONTADOR), itertools.count())
+            return self._estado
+
+    def siguiente(self):
+        base, contador = self._estado
+        n = next(contador)
+        while n >> CODIGOS_BITS_CONTADOR:
+            base, contador = self._renovar(base)
+            n = next(contador)
+        # 72 bits corridos a 75 para que salgan 15 caracteres base32 justos (alfabeto RFC 4648)
+        valor = (((base | n) << CODIGOS_BITS_PID) | self._pid) << 3
+        p = _PARES_BASE32
+        return (p[valor >> 65] + p[(valor >> 55) & 1023] + p[(valor >> 45) & 1023]
+                + p[(valor >> 35) & 1023] + p[(valor >> 25) & 1023] + p[(valor >> 15) & 1023]
+                + p[(valor >> 5) & 1023] + _ALFABETO_BASE32[valor & 31])
+
+generador_codigos = GeneradorCodigos()
+
 def generar_codigo_solicitud():
-    import string
-    import random
-    codigo = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM solicitudes_servicio WHERE codigo_solicitud = ?', (codigo,))
-    if cursor.fetchone():
-        conn.close()
-        return generar_codigo_solicitud()
-    conn.close()
-    return codigo
+    return generador_codigos.siguiente()
+
+def _generar_codigos_prueba(cantidad):
+    inicio = time.perf_counter()
+    codigos = [generador_codigos.siguiente() for _ in range(cantidad)]
+    return time.perf_counter() - inicio, codigos
+
+@app.cli.command('rendimiento-codigos')
+@click.option('--codigos', default=1000000, help='Códigos generados en la prueba de un solo proceso')
+@click.option('--procesos', default=8, help='Procesos que generan en paralelo')
+@click.option('--por-proceso', default=200000, help='Códigos que genera cada proceso en paralelo')
+def comando_rendimiento_codigos(codigos, procesos, por_proceso):
+    """Mide cuántos códigos por segundo se generan y verifica que no se repitan entre procesos"""
+    siguiente = generador_codigos.siguiente
+    inicio = time.perf_counter()
+    for _ in range(codigos):
+        siguiente()
+    duracion = time.perf_counter() - inicio
+    print(f"{codigos} códigos en {duracion:.2f}s ({codigos / duracion:,.0f} por segundo en un proceso, "
+          f"tope {1 << CODIGOS_BITS_CONTADOR:,} por segundo de reloj)")
+    
+    with multiprocessing.get_context('fork').Pool(procesos) as grupo:
+        resultados = grupo.map(_generar_codigos_prueba, [por_proceso] * procesos)
+    # Solo cuenta la generación dentro de cada proceso, no el envío de las listas al padre
+    duracion = max(tiempo for tiempo, _ in resultados)
+    
+    total = sum(len(lista) for _, lista in resultados)
+    distintos = len({codigo for _, lista in resultados for codigo in lista})
+    print(f"{total} códigos en {duracion:.2f}s con {procesos} procesos ({total / duracion:,.0f} por segundo)")
+    if distintos != total:
+        print(f"✗ {total - distintos} códigos repetidos")
+        raise SystemExit(1)
+    
+    # Al agotar el contador el segundo nuevo nunca puede quedar por delante del reloj
+    generador = GeneradorCodigos()
+    vuelta = [generador.siguiente() for _ in range((1 << CODIGOS_BITS_CONTADOR) + 1000)]
+    segundo = generador._estado[0] >> CODIGOS_BITS_CONTADOR
+    if len(set(vuelta)) != len(vuelta) or segundo > int(time.time()) - CODIGOS_EPOCA:
+        print("✗ El contador invadió el campo del segundo al dar la vuelta")
+        raise SystemExit(1)
+    print("✓ Sin colisiones, también al agotar el contador")
 
 def crear_solicitud_servicio(usuario_id, datos_solicitud):
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         codigo_solicitud = generar_codigo_solicitud()
@@ -431,7 +1869,6 @@ def crear_solicitud_servicio(usuario_id, datos_solicitud):
         
         conn.commit()
         solicitud_id = cursor.lastrowid
-        conn.close()
         
         return True, {
             'solicitud_id': solicitud_id,
@@ -440,43 +1877,43 @@ def crear_solicitud_servicio(usuario_id, datos_solicitud):
     except Exception as e:
         return False, str(e)
 
-def obtener_solicitudes_pendientes():
-    conn = sqlite3.connect(DATABASE)
+ORDEN_SOLICITUDES = [('s.fecha_solicitud', True), ('s.id', True)]
+
+# Columnas de Solicitud; u es la otra parte (el conductor para el pasajero, el cliente para el conductor)
+COLUMNAS_SOLICITUD = '''s.id, s.codigo_solicitud, s.tipo_vehiculo, s.origen, s.destino,
+    s.fecha_servicio, s.hora_servicio, s.numero_pasajeros, s.precio_estimado,
+    s.precio_final, s.estado, s.fecha_solicitud, s.observaciones, s.telefono_contacto,
+    u.nombre || ' ' || u.apellido, u.telefono'''
+
+def obtener_solicitudes_pendientes(filtros=([], []), pagina=None):
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.codigo_solicitud, s.tipo_vehiculo, s.origen, s.destino,
-               s.fecha_servicio, s.hora_servicio, s.numero_pasajeros, s.precio_estimado,
-               s.observaciones, s.fecha_solicitud,
-               u.nombre, u.apellido, u.telefono
-        FROM solicitudes_servicio s
-        JOIN usuarios u ON s.usuario_id = u.id
-        WHERE s.estado = 'pendiente' AND s.conductor_id IS NULL
-        ORDER BY s.fecha_solicitud DESC
-    ''')
-    solicitudes = cursor.fetchall()
-    conn.close()
-    return solicitudes
+    return consultar_listado(
+        cursor,
+        COLUMNAS_SOLICITUD,
+        'solicitudes_servicio s JOIN usuarios u ON s.usuario_id = u.id',
+        (["s.estado = 'pendiente'", 's.conductor_id IS NULL'] + filtros[0], filtros[1]),
+        ORDEN_SOLICITUDES,
+        pagina,
+        Solicitud
+    )
 
-def obtener_solicitudes_conductor(conductor_id):
-    conn = sqlite3.connect(DATABASE)
+def obtener_solicitudes_conductor(conductor_id, filtros=([], []), pagina=None):
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.codigo_solicitud, s.tipo_vehiculo, s.origen, s.destino,
-               s.fecha_servicio, s.hora_servicio, s.numero_pasajeros, s.precio_estimado,
-               s.precio_final, s.estado, s.fecha_solicitud,
-               u.nombre, u.apellido, u.telefono
-        FROM solicitudes_servicio s
-        JOIN usuarios u ON s.usuario_id = u.id
-        WHERE s.conductor_id = ?
-        ORDER BY s.fecha_solicitud DESC
-    ''', (conductor_id,))
-    solicitudes = cursor.fetchall()
-    conn.close()
-    return solicitudes
+    return consultar_listado(
+        cursor,
+        COLUMNAS_SOLICITUD,
+        'solicitudes_servicio s JOIN usuarios u ON s.usuario_id = u.id',
+        (['s.conductor_id = ?'] + filtros[0], [conductor_id] + filtros[1]),
+        ORDEN_SOLICITUDES,
+        pagina,
+        Solicitud
+    )
 
 def aceptar_solicitud(solicitud_id, conductor_id, precio_final):
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -486,25 +1923,26 @@ def aceptar_solicitud(solicitud_id, conductor_id, precio_final):
         ''', (conductor_id, precio_final, solicitud_id))
         
         if cursor.rowcount == 0:
-            conn.close()
             return False, "La solicitud ya no está disponible"
         
         conn.commit()
-        conn.close()
         return True, "Solicitud aceptada exitosamente"
     except Exception as e:
         return False, str(e)
 
 def obtener_conductor_por_usuario(usuario_id):
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('SELECT * FROM conductores WHERE usuario_id = ?', (usuario_id,))
+    cursor.execute('''
+        SELECT id, usuario_id, estado, disponible
+        FROM conductores WHERE usuario_id = ?
+    ''', (usuario_id,))
     conductor = cursor.fetchone()
-    conn.close()
-    return conductor
+    return Conductor._make(conductor) if conductor else None
 
 def crear_administrador(nombre, apellido, email, telefono, cedula, password):
     """Crea un usuario administrador"""
+    # crear_usuario invalida la caché de roles, incluido el conjunto de administradores
     return crear_usuario(nombre, apellido, email, telefono, cedula, password, tipo_usuario='administrador')
 
 @app.route('/api/registro-admin', methods=['POST'])
@@ -573,6 +2011,116 @@ def api_registro_admin():
             'message': 'Error interno del servidor'
         }), 500
 
+# ============================================
+# CLASIFICACIÓN AUTOMÁTICA DE MENSAJES
+# ============================================
+
+# Reglas en orden de precedencia: gana la primera que tenga alguna coincidencia.
+# Las palabras se comparan completas y sin tildes; un '*' final acepta cualquier terminación.
+REGLAS_CLASIFICACION = [
+    {'tipo': 'queja', 'prioridad': 'alta',
+     'palabras': ['quej*', 'reclam*', 'problema*', 'mal', 'malo', 'mala', 'pesim*', 'molest*', 'terrible*']},
+    {'tipo': 'sugerencia', 'prioridad': 'baja',
+     'palabras': ['sugerencia*', 'sugiero', 'mejorar', 'propuesta*', 'recomiendo']},
+    {'tipo': 'consulta', 'prioridad': 'urgente',
+     'palabras': ['urgente*', 'emergencia*', 'ayuda', 'importante']},
+]
+CLASIFICACION_DEFECTO = ('consulta', 'media')
+
+# Archivo JSON opcional con una lista de reglas que reemplaza a la tabla anterior
+REGLAS_CLASIFICACION_ARCHIVO = os.environ.get('REGLAS_CLASIFICACION_ARCHIVO')
+
+def normalizar_texto(texto):
+    """Pasa a minúsculas y quita tildes para comparar sin importar la escritura"""
+    descompuesto = unicodedata.normalize('NFKD', texto.casefold())
+    return ''.join(c for c in descompuesto if not unicodedata.combining(c))
+
+class ClasificadorMensajes:
+    """Asigna tipo y prioridad con una sola expresión regular compilada para todas las reglas"""
+
+    def __init__(self, reglas, defecto=CLASIFICACION_DEFECTO):
+        self.reglas = reglas
+        self.defecto = defecto
+        alternativas = []
+        for indice, regla in enumerate(reglas):
+            terminos = []
+            for palabra in regla['palabras']:
+                palabra = normalizar_texto(palabra)
+                if palabra.endswith('*'):
+                    terminos.append(re.escape(palabra[:-1]) + r'\w*')
+                else:
+                    terminos.append(re.escape(palabra))
+            alternativas.append(f"(?P<r{indice}>{'|'.join(terminos)})")
+        self._patron = re.compile(r'\b(?:' + '|'.join(alternativas) + r')\b')
+
+    def clasificar(self, mensaje):
+        """Devuelve (tipo, prioridad) recorriendo el mensaje una sola vez"""
+        mejor = None
+        for coincidencia in self._patron.finditer(normalizar_texto(mensaje)):
+            indice = int(coincidencia.lastgroup[1:])
+            if mejor is None or indice < mejor:
+                mejor = indice
+                if mejor == 0:
+                    break
+        if mejor is None:
+            return self.defecto
+        regla = self.reglas[mejor]
+        return regla['tipo'], regla['prioridad']
+
+def cargar_reglas_clasificacion():
+    if REGLAS_CLASIFICACION_ARCHIVO:
+        with open(REGLAS_CLASIFICACION_ARCHIVO, encoding='utf-8') as archivo:
+            return json.load(archivo)
+    return REGLAS_CLASIFICACION
+
+clasificador_mensajes = ClasificadorMensajes(cargar_reglas_clasificacion())
+
+def _reclasificar_tabla(conn, consulta, actualizacion, lote):
+    """Recorre una tabla por id en lotes y corrige las filas cuya clasificación cambió"""
+    ultimo_id = 0
+    revisadas = cambiadas = 0
+    while True:
+        filas = conn.execute(consulta, (ultimo_id, lote)).fetchall()
+        if not filas:
+            break
+        cambios = []
+        for fila_id, texto, tipo, prioridad in filas:
+            nuevo = clasificador_mensajes.clasificar(texto or '')
+            if nuevo != (tipo, prioridad):
+                cambios.append((nuevo[0], nuevo[1], fila_id))
+        if cambios:
+            comenzar_escritura(conn)
+            conn.executemany(actualizacion, cambios)
+            conn.commit()
+        revisadas += len(filas)
+        cambiadas += len(cambios)
+        ultimo_id = filas[-1][0]
+    return revisadas, cambiadas
+
+@app.cli.command('reclasificar-mensajes')
+@click.option('--lote', default=500, help='Filas leídas y actualizadas por transacción')
+def comando_reclasificar_mensajes(lote):
+    """Vuelve a clasificar tickets y conversaciones históricas con las reglas actuales"""
+    aplicar_migraciones()
+    conn = get_db()
+    
+    revisadas, cambiadas = _reclasificar_tabla(conn, '''
+        SELECT id, mensaje, tipo, prioridad FROM mensajes_soporte
+        WHERE id > ? ORDER BY id LIMIT ?
+    ''', 'UPDATE mensajes_soporte SET tipo = ?, prioridad = ? WHERE id = ?', lote)
+    print(f"✓ Tickets de soporte: {cambiadas} de {revisadas} reclasificados")
+    
+    # Las conversaciones se clasificaron con su primer mensaje, no con el asunto truncado
+    revisadas, cambiadas = _reclasificar_tabla(conn, '''
+        SELECT c.id,
+               COALESCE((SELECT m.mensaje FROM mensajes_conversacion m
+                         WHERE m.conversacion_id = c.id ORDER BY m.id LIMIT 1), c.asunto),
+               c.tipo, c.prioridad
+        FROM conversaciones c
+        WHERE c.id > ? ORDER BY c.id LIMIT ?
+    ''', 'UPDATE conversaciones SET tipo = ?, prioridad = ? WHERE id = ?', lote)
+    print(f"✓ Conversaciones: {cambiadas} de {revisadas} reclasificadas")
+
 @app.route('/api/guardar-mensaje-chat', methods=['POST'])
 def api_guardar_mensaje_chat():
     """Guarda un mensaje del chat como ticket de soporte"""
@@ -588,21 +2136,11 @@ def api_guardar_mensaje_chat():
                 'message': 'El mensaje es obligatorio'
             }), 400
         
-        mensaje_lower = data['mensaje'].lower()
-        tipo = 'consulta'
-        prioridad = 'media'
-        
-        if any(palabra in mensaje_lower for palabra in ['queja', 'reclamo', 'problema', 'mal', 'pésimo', 'molesto', 'terrible']):
-            tipo = 'queja'
-            prioridad = 'alta'
-        elif any(palabra in mensaje_lower for palabra in ['sugerencia', 'mejorar', 'propuesta', 'recomiendo']):
-            tipo = 'sugerencia'
-            prioridad = 'baja'
-        elif any(palabra in mensaje_lower for palabra in ['urgente', 'emergencia', 'ayuda', 'importante']):
-            prioridad = 'urgente'
+        tipo, prioridad = clasificador_mensajes.clasificar(data['mensaje'])
         
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
+        comenzar_escritura(conn)
         
         cursor.execute('''
             INSERT INTO mensajes_soporte (usuario_id, mensaje, tipo, prioridad)
@@ -611,17 +2149,9 @@ def api_guardar_mensaje_chat():
         
         mensaje_id = cursor.lastrowid
         
-        cursor.execute('SELECT id FROM usuarios WHERE tipo_usuario = "administrador"')
-        admins = cursor.fetchall()
-        
-        for admin in admins:
-            cursor.execute('''
-                INSERT INTO notificaciones_admin (admin_id, mensaje_id)
-                VALUES (?, ?)
-            ''', (admin[0], mensaje_id))
-        
+        # Los administradores no reciben una fila por ticket: cada uno calcula sus
+        # pendientes contra su marca en lecturas_notificaciones_admin
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -638,6 +2168,15 @@ def api_guardar_mensaje_chat():
             'message': 'Error guardando mensaje'
         }), 500
 
+# Rango numérico de la prioridad para ordenar de urgente a baja
+ORDEN_PRIORIDAD_SQL = '''CASE {columna}
+    WHEN 'urgente' THEN 1
+    WHEN 'alta' THEN 2
+    WHEN 'media' THEN 3
+    WHEN 'baja' THEN 4
+    ELSE 5
+END'''
+
 @app.route('/api/mensajes-soporte', methods=['GET'])
 def api_mensajes_soporte():
     """Obtiene todos los mensajes de soporte - Solo para administradores"""
@@ -645,47 +2184,24 @@ def api_mensajes_soporte():
         return jsonify({'success': False, 'message': 'No autorizado'}), 403
     
     try:
-        estado = request.args.get('estado', 'todos')
-        
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
-        if estado == 'todos':
-            cursor.execute('''
-                SELECT m.id, m.mensaje, m.tipo, m.estado, m.prioridad, 
-                       m.fecha_mensaje, m.respuesta, m.fecha_respuesta,
-                       u.nombre, u.apellido, u.email, u.telefono
-                FROM mensajes_soporte m
-                JOIN usuarios u ON m.usuario_id = u.id
-                ORDER BY 
-                    CASE m.prioridad
-                        WHEN 'urgente' THEN 1
-                        WHEN 'alta' THEN 2
-                        WHEN 'media' THEN 3
-                        WHEN 'baja' THEN 4
-                    END,
-                    m.fecha_mensaje DESC
-            ''')
-        else:
-            cursor.execute('''
-                SELECT m.id, m.mensaje, m.tipo, m.estado, m.prioridad, 
-                       m.fecha_mensaje, m.respuesta, m.fecha_respuesta,
-                       u.nombre, u.apellido, u.email, u.telefono
-                FROM mensajes_soporte m
-                JOIN usuarios u ON m.usuario_id = u.id
-                WHERE m.estado = ?
-                ORDER BY 
-                    CASE m.prioridad
-                        WHEN 'urgente' THEN 1
-                        WHEN 'alta' THEN 2
-                        WHEN 'media' THEN 3
-                        WHEN 'baja' THEN 4
-                    END,
-                    m.fecha_mensaje DESC
-            ''', (estado,))
-        
-        mensajes = cursor.fetchall()
-        conn.close()
+        mensajes, siguiente_cursor = consultar_listado(
+            cursor,
+            '''m.id, m.mensaje, m.tipo, m.estado, m.prioridad, 
+               m.fecha_mensaje, m.respuesta, m.fecha_respuesta,
+               u.nombre, u.apellido, u.email, u.telefono''',
+            'mensajes_soporte m JOIN usuarios u ON m.usuario_id = u.id',
+            leer_filtros(
+                {'estado': 'm.estado', 'prioridad': 'm.prioridad', 'tipo': 'm.tipo'},
+                'm.fecha_mensaje'
+            ),
+            [(ORDEN_PRIORIDAD_SQL.format(columna='m.prioridad'), False),
+             ('m.fecha_mensaje', True),
+             ('m.id', True)],
+            leer_pagina()
+        )
         
         mensajes_list = []
         for m in mensajes:
@@ -707,9 +2223,15 @@ def api_mensajes_soporte():
         
         return jsonify({
             'success': True,
-            'mensajes': mensajes_list
+            'mensajes': mensajes_list,
+            'siguiente_cursor': siguiente_cursor
         })
         
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         print(f"Error obteniendo mensajes: {e}")
         return jsonify({
@@ -732,7 +2254,7 @@ def api_responder_mensaje():
                 'message': 'Mensaje ID y respuesta son obligatorios'
             }), 400
         
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -742,7 +2264,6 @@ def api_responder_mensaje():
         ''', (data['respuesta'], session['usuario_id'], data['mensaje_id']))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -763,17 +2284,18 @@ def api_notificaciones_admin():
         return jsonify({'success': False, 'message': 'No autorizado'}), 403
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
             SELECT COUNT(*) 
-            FROM notificaciones_admin 
-            WHERE admin_id = ? AND leida = 0
+            FROM mensajes_soporte 
+            WHERE id > COALESCE((
+                SELECT ultimo_mensaje_id FROM lecturas_notificaciones_admin WHERE admin_id = ?
+            ), 0)
         ''', (session['usuario_id'],))
         
         no_leidas = cursor.fetchone()[0]
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -794,17 +2316,12 @@ def api_marcar_notificaciones_leidas():
         return jsonify({'success': False, 'message': 'No autorizado'}), 403
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            UPDATE notificaciones_admin
-            SET leida = 1
-            WHERE admin_id = ?
-        ''', (session['usuario_id'],))
+        marcar_notificaciones_admin(cursor, session['usuario_id'])
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -818,25 +2335,32 @@ def api_marcar_notificaciones_leidas():
             'message': 'Error marcando notificaciones'
         }), 500
 
+def marcar_notificaciones_admin(cursor, admin_id):
+    """Mueve la marca de lectura del administrador hasta el último ticket existente"""
+    cursor.execute('''
+        INSERT OR REPLACE INTO lecturas_notificaciones_admin (admin_id, ultimo_mensaje_id)
+        SELECT ?, COALESCE(MAX(id), 0) FROM mensajes_soporte
+    ''', (admin_id,))
+
 def crear_primer_admin():
     """Crea el primer administrador del sistema"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     cursor = conn.cursor()
     
     cursor.execute('SELECT COUNT(*) FROM usuarios WHERE tipo_usuario = "administrador"')
     if cursor.fetchone()[0] > 0:
-        conn.close()
         return
     
-    password_hash = generate_password_hash('Admin123!')
+    password_hash = credenciales.generar('Admin123!')
     
     cursor.execute('''
         INSERT INTO usuarios (nombre, apellido, email, telefono, cedula, password_hash, tipo_usuario)
         VALUES (?, ?, ?, ?, ?, ?, ?)
     ''', ('Admin', 'Sistema', 'admin@transporteaguila.com', '3001234567', '00000000', password_hash, 'administrador'))
     
+    marcar_notificaciones_admin(cursor, cursor.lastrowid)
     conn.commit()
-    conn.close()
+    cache_roles.invalidar()
     
     print("✓ Administrador creado:")
     print("  Email: admin@transporteaguila.com")
@@ -919,6 +2443,11 @@ def api_registro():
                 'message': 'Tipo de usuario inválido'
             }), 400
         
+        # Cada registro calcula un hash; comparte el cupo por IP con el inicio de sesión
+        espera = limitador_login_ip.consumir(request.remote_addr)
+        if espera:
+            return respuesta_demasiados_intentos(espera)
+        
         exito, resultado = crear_usuario(
             data['nombre'].strip(),
             data['apellido'].strip(),
@@ -988,6 +2517,11 @@ def api_login():
                 'message': 'Email y contraseña son obligatorios'
             }), 400
         
+        # Se descuenta antes de calcular nada: un ataque de fuerza bruta no llega al KDF
+        espera = limitador_login_ip.consumir(request.remote_addr) or limitador_login_email.consumir(email)
+        if espera:
+            return respuesta_demasiados_intentos(espera)
+        
         usuario = obtener_usuario_por_email(email)
         
         if not usuario:
@@ -996,30 +2530,40 @@ def api_login():
                 'message': 'Credenciales incorrectas'
             }), 401
         
-        if not check_password_hash(usuario[6], password):
+        if not credenciales.verificar(usuario.password_hash, password):
             return jsonify({
                 'success': False,
                 'message': 'Credenciales incorrectas'
             }), 401
         
-        session['usuario_id'] = usuario[0]
-        session['nombre'] = usuario[1]
-        session['apellido'] = usuario[2]
-        session['email'] = usuario[3]
-        session['tipo_usuario'] = usuario[7]
+        limitador_login_email.limpiar(email)
+        if credenciales.necesita_rehash(usuario.password_hash):
+            actualizar_hash_password(usuario.id, usuario.password_hash, password)
+        
+        session['usuario_id'] = usuario.id
+        session['nombre'] = usuario.nombre
+        session['apellido'] = usuario.apellido
+        session['email'] = usuario.email
+        session['tipo_usuario'] = usuario.tipo_usuario
         
         return jsonify({
             'success': True,
             'message': 'Inicio de sesión exitoso',
             'usuario': {
-                'id': usuario[0],
-                'nombre': usuario[1],
-                'apellido': usuario[2],
-                'email': usuario[3],
-                'tipo_usuario': usuario[7]
+                'id': usuario.id,
+                'nombre': usuario.nombre,
+                'apellido': usuario.apellido,
+                'email': usuario.email,
+                'tipo_usuario': usuario.tipo_usuario
             }
         })
         
+    except TimeoutError as e:
+        print(f"Error en login: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Servicio ocupado, intente de nuevo en unos segundos'
+        }), 503
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1095,30 +2639,39 @@ def api_solicitudes_pendientes():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        solicitudes = obtener_solicitudes_pendientes()
+        solicitudes, siguiente_cursor = obtener_solicitudes_pendientes(
+            leer_filtros({'tipo_vehiculo': 's.tipo_vehiculo'}, 's.fecha_servicio'),
+            leer_pagina()
+        )
         
         solicitudes_list = []
         for s in solicitudes:
             solicitudes_list.append({
-                'id': s[0],
-                'codigo_solicitud': s[1],
-                'tipo_vehiculo': s[2],
-                'origen': s[3],
-                'destino': s[4],
-                'fecha_servicio': s[5],
-                'hora_servicio': s[6],
-                'numero_pasajeros': s[7],
-                'precio_estimado': s[8],
-                'observaciones': s[9],
-                'fecha_solicitud': s[10],
-                'cliente_nombre': f"{s[11]} {s[12]}",
-                'cliente_telefono': s[13]
+                'id': s.id,
+                'codigo_solicitud': s.codigo_solicitud,
+                'tipo_vehiculo': s.tipo_vehiculo,
+                'origen': s.origen,
+                'destino': s.destino,
+                'fecha_servicio': s.fecha_servicio,
+                'hora_servicio': s.hora_servicio,
+                'numero_pasajeros': s.numero_pasajeros,
+                'precio_estimado': s.precio_estimado,
+                'observaciones': s.observaciones,
+                'fecha_solicitud': s.fecha_solicitud,
+                'cliente_nombre': s.contacto_nombre,
+                'cliente_telefono': s.contacto_telefono
             })
         
         return jsonify({
             'success': True,
-            'solicitudes': solicitudes_list
+            'solicitudes': solicitudes_list,
+            'siguiente_cursor': siguiente_cursor
         })
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1138,31 +2691,41 @@ def api_mis_solicitudes_conductor():
                 'message': 'Conductor no encontrado'
             }), 404
         
-        solicitudes = obtener_solicitudes_conductor(conductor[0])
+        solicitudes, siguiente_cursor = obtener_solicitudes_conductor(
+            conductor.id,
+            leer_filtros({'estado': 's.estado', 'tipo_vehiculo': 's.tipo_vehiculo'}, 's.fecha_servicio'),
+            leer_pagina()
+        )
         
         solicitudes_list = []
         for s in solicitudes:
             solicitudes_list.append({
-                'id': s[0],
-                'codigo_solicitud': s[1],
-                'tipo_vehiculo': s[2],
-                'origen': s[3],
-                'destino': s[4],
-                'fecha_servicio': s[5],
-                'hora_servicio': s[6],
-                'numero_pasajeros': s[7],
-                'precio_estimado': s[8],
-                'precio_final': s[9],
-                'estado': s[10],
-                'fecha_solicitud': s[11],
-                'cliente_nombre': f"{s[12]} {s[13]}",
-                'cliente_telefono': s[14]
+                'id': s.id,
+                'codigo_solicitud': s.codigo_solicitud,
+                'tipo_vehiculo': s.tipo_vehiculo,
+                'origen': s.origen,
+                'destino': s.destino,
+                'fecha_servicio': s.fecha_servicio,
+                'hora_servicio': s.hora_servicio,
+                'numero_pasajeros': s.numero_pasajeros,
+                'precio_estimado': s.precio_estimado,
+                'precio_final': s.precio_final,
+                'estado': s.estado,
+                'fecha_solicitud': s.fecha_solicitud,
+                'cliente_nombre': s.contacto_nombre,
+                'cliente_telefono': s.contacto_telefono
             })
         
         return jsonify({
             'success': True,
-            'solicitudes': solicitudes_list
+            'solicitudes': solicitudes_list,
+            'siguiente_cursor': siguiente_cursor
         })
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -1192,7 +2755,7 @@ def api_aceptar_solicitud():
         
         exito, mensaje = aceptar_solicitud(
             data['solicitud_id'],
-            conductor[0],
+            conductor.id,
             data['precio_final']
         )
         
@@ -1220,14 +2783,13 @@ def crear_solicitud_prueba():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute("SELECT id FROM usuarios WHERE tipo_usuario = 'pasajero' LIMIT 1")
         pasajero = cursor.fetchone()
         
         if not pasajero:
-            conn.close()
             return jsonify({'success': False, 'message': 'No hay usuarios pasajeros'}), 400
         
         pasajero_id = pasajero[0]
@@ -1251,7 +2813,6 @@ def crear_solicitud_prueba():
                 continue
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -1271,7 +2832,7 @@ def debug_solicitudes():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -1292,7 +2853,6 @@ def debug_solicitudes():
         ''')
         pendientes = cursor.fetchall()
         
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -1323,6 +2883,9 @@ def rutas():
         return redirect(url_for('login'))
     return render_template('rutas.html')
 
+# Máximo de días que puede abarcar una consulta de horarios
+MAX_DIAS_HORARIOS = 31
+
 @app.route('/api/horarios/<int:ruta_id>', methods=['GET'])
 def api_horarios(ruta_id):
     """Obtiene los horarios disponibles para una ruta específica"""
@@ -1330,64 +2893,42 @@ def api_horarios(ruta_id):
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        fecha = request.args.get('fecha')
-        if not fecha:
+        # ?fecha=AAAA-MM-DD para un día, o ?desde=...&hasta=... (inclusive) para varios
+        desde = request.args.get('desde') or request.args.get('fecha')
+        hasta = request.args.get('hasta') or desde
+        if not desde:
             return jsonify({
                 'success': False,
                 'message': 'Fecha es requerida'
             }), 400
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT origen, destino, duracion_horas FROM rutas WHERE id = ?', (ruta_id,))
-        ruta = cursor.fetchone()
-        
-        if not ruta:
-            conn.close()
+        try:
+            fecha_desde = datetime.strptime(desde, '%Y-%m-%d')
+            fecha_hasta = datetime.strptime(hasta, '%Y-%m-%d')
+        except ValueError:
             return jsonify({
                 'success': False,
-                'message': 'Ruta no encontrada'
-            }), 404
+                'message': 'Formato de fecha inválido (AAAA-MM-DD)'
+            }), 400
         
-        cursor.execute('''
-            SELECT h.id, h.fecha_salida, h.fecha_llegada, h.precio, 
-                   h.asientos_disponibles, h.estado,
-                   v.placa, v.tipo_vehiculo, v.marca, v.modelo
-            FROM horarios h
-            JOIN vehiculos v ON h.vehiculo_id = v.id
-            WHERE h.ruta_id = ? 
-            AND DATE(h.fecha_salida) = ?
-            AND h.estado = 'programado'
-            AND h.asientos_disponibles > 0
-            ORDER BY h.fecha_salida
-        ''', (ruta_id, fecha))
-        
-        horarios = cursor.fetchall()
-        conn.close()
-        
-        horarios_list = []
-        for h in horarios:
-            horarios_list.append({
-                'id': h[0],
-                'fecha_salida': h[1],
-                'fecha_llegada': h[2],
-                'precio': h[3],
-                'asientos_disponibles': h[4],
-                'estado': h[5],
-                'placa': h[6],
-                'tipo_vehiculo': h[7],
-                'marca': h[8],
-                'modelo': h[9],
-                'origen': ruta[0],
-                'destino': ruta[1],
-                'duracion_horas': ruta[2]
-            })
+        if fecha_hasta < fecha_desde or (fecha_hasta - fecha_desde).days >= MAX_DIAS_HORARIOS:
+            return jsonify({
+                'success': False,
+                'message': f'El rango debe ser de 1 a {MAX_DIAS_HORARIOS} días'
+            }), 400
         
-        return jsonify({
-            'success': True,
-            'horarios': horarios_list
-        })
+        # Rango semiabierto [desde, hasta + 1 día) comparable contra el índice de fecha_salida
+        inicio = fecha_desde.strftime('%Y-%m-%d')
+        fin = (fecha_hasta + timedelta(days=1)).strftime('%Y-%m-%d')
+        
+        conn = get_db()
+        # Los horarios muestran datos de la ruta y del vehículo, así que dependen de las tres versiones
+        versiones = obtener_versiones(conn, ('rutas', 'vehiculos', f'horarios:{ruta_id}'))
+        return respuesta_cacheada(
+            ('horarios', ruta_id, inicio, fin, versiones),
+            lambda: _construir_horarios(conn, ruta_id, inicio, fin),
+            'private, no-cache'
+        )
     except Exception as e:
         print(f"Error obteniendo horarios: {e}")
         return jsonify({
@@ -1395,6 +2936,37 @@ def api_horarios(ruta_id):
             'message': 'Error obteniendo horarios'
         }), 500
 
+def _construir_horarios(conn, ruta_id, inicio, fin):
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT origen, destino, duracion_horas FROM rutas WHERE id = ?', (ruta_id,))
+    ruta = cursor.fetchone()
+    
+    if not ruta:
+        return jsonify({
+            'success': False,
+            'message': 'Ruta no encontrada'
+        }), 404
+    
+    cursor.execute('''
+        SELECT h.id, h.fecha_salida, h.fecha_llegada, h.precio, 
+               h.asientos_disponibles, h.estado,
+               v.placa, v.tipo_vehiculo, v.marca, v.modelo,
+               ?, ?, ?
+        FROM horarios h
+        JOIN vehiculos v ON h.vehiculo_id = v.id
+        WHERE h.ruta_id = ? 
+        AND h.fecha_salida >= ? AND h.fecha_salida < ?
+        AND h.estado = 'programado'
+        AND h.asientos_disponibles > 0
+        ORDER BY h.fecha_salida
+    ''', (ruta[0], ruta[1], ruta[2], ruta_id, inicio, fin))
+    
+    return {
+        'success': True,
+        'horarios': filas_como_dicts(CAMPOS_HORARIOS, cursor.fetchall())
+    }
+
 @app.route('/servicios')
 def servicios():
     if 'usuario_id' not in session:
@@ -1413,27 +2985,21 @@ def reservar():
         return redirect(url_for('login'))
     return render_template('reservas.html')
 
-def obtener_solicitudes_usuario(usuario_id):
-    """Obtiene todas las solicitudes de un usuario pasajero"""
-    conn = sqlite3.connect(DATABASE)
+def obtener_solicitudes_usuario(usuario_id, filtros=([], []), pagina=None):
+    """Obtiene las solicitudes de un usuario pasajero"""
+    conn = get_db()
     cursor = conn.cursor()
-    cursor.execute('''
-        SELECT s.id, s.codigo_solicitud, s.tipo_vehiculo, s.origen, s.destino,
-               s.fecha_servicio, s.hora_servicio, s.numero_pasajeros, 
-               s.precio_estimado, s.precio_final, s.estado, s.fecha_solicitud,
-               s.observaciones, s.telefono_contacto,
-               c.usuario_id as conductor_usuario_id,
-               u.nombre as conductor_nombre, u.apellido as conductor_apellido, 
-               u.telefono as conductor_telefono
-        FROM solicitudes_servicio s
-        LEFT JOIN conductores c ON s.conductor_id = c.id
-        LEFT JOIN usuarios u ON c.usuario_id = u.id
-        WHERE s.usuario_id = ?
-        ORDER BY s.fecha_solicitud DESC
-    ''', (usuario_id,))
-    solicitudes = cursor.fetchall()
-    conn.close()
-    return solicitudes
+    return consultar_listado(
+        cursor,
+        COLUMNAS_SOLICITUD,
+        '''solicitudes_servicio s
+           LEFT JOIN conductores c ON s.conductor_id = c.id
+           LEFT JOIN usuarios u ON c.usuario_id = u.id''',
+        (['s.usuario_id = ?'] + filtros[0], [usuario_id] + filtros[1]),
+        ORDEN_SOLICITUDES,
+        pagina,
+        Solicitud
+    )
 
 @app.route('/api/mis-solicitudes', methods=['GET'])
 def api_mis_solicitudes():
@@ -1442,39 +3008,49 @@ def api_mis_solicitudes():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        solicitudes = obtener_solicitudes_usuario(session['usuario_id'])
+        solicitudes, siguiente_cursor = obtener_solicitudes_usuario(
+            session['usuario_id'],
+            leer_filtros({'estado': 's.estado', 'tipo_vehiculo': 's.tipo_vehiculo'}, 's.fecha_servicio'),
+            leer_pagina()
+        )
         
         solicitudes_list = []
         for s in solicitudes:
             solicitud_data = {
-                'id': s[0],
-                'codigo_solicitud': s[1],
-                'tipo_vehiculo': s[2],
-                'origen': s[3],
-                'destino': s[4],
-                'fecha_servicio': s[5],
-                'hora_servicio': s[6],
-                'numero_pasajeros': s[7],
-                'precio_estimado': s[8],
-                'precio_final': s[9],
-                'estado': s[10],
-                'fecha_solicitud': s[11],
-                'observaciones': s[12],
-                'telefono_contacto': s[13]
+                'id': s.id,
+                'codigo_solicitud': s.codigo_solicitud,
+                'tipo_vehiculo': s.tipo_vehiculo,
+                'origen': s.origen,
+                'destino': s.destino,
+                'fecha_servicio': s.fecha_servicio,
+                'hora_servicio': s.hora_servicio,
+                'numero_pasajeros': s.numero_pasajeros,
+                'precio_estimado': s.precio_estimado,
+                'precio_final': s.precio_final,
+                'estado': s.estado,
+                'fecha_solicitud': s.fecha_solicitud,
+                'observaciones': s.observaciones,
+                'telefono_contacto': s.telefono_contacto
             }
             
-            if s[14]: 
+            if s.contacto_nombre is not None:
                 solicitud_data['conductor'] = {
-                    'nombre': f"{s[15]} {s[16]}",
-                    'telefono': s[17]
+                    'nombre': s.contacto_nombre,
+                    'telefono': s.contacto_telefono
                 }
             
             solicitudes_list.append(solicitud_data)
         
         return jsonify({
             'success': True,
-            'solicitudes': solicitudes_list
+            'solicitudes': solicitudes_list,
+            'siguiente_cursor': siguiente_cursor
         })
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         print(f"Error obteniendo solicitudes: {e}")
         return jsonify({
@@ -1487,82 +3063,589 @@ def mis_viajes():
     if 'usuario_id' not in session or session.get('tipo_usuario') != 'pasajero':
         return redirect(url_for('login'))
 
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    viajes = []
+    # La página carga sus listas desde /api/mis-solicitudes y /api/mis-reservas
+    return render_template('mis-viajes.html')
+
+def generar_codigo_reserva():
+    return 'RES-' + generador_codigos.siguiente()
+
+# ============================================
+# RECURSOS ESTÁTICOS VERSIONADOS
+# ============================================
+
+try:
+    from PIL import Image, features as funciones_imagen
+except ImportError:
+    Image = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+ESTATICOS_DESTINO = os.path.join(app.static_folder, 'dist')
+ESTATICOS_MANIFIESTO = os.path.join(ESTATICOS_DESTINO, 'manifiesto.json')
+ESTATICOS_MAX_AGE = 365 * 24 * 3600
+
+# Hojas de estilo de cada página en el orden original de sus <link>, que define la cascada
+PAQUETES_CSS = {
+    'inicio': ['transporte-mejorado', 'registro'],
+    'pasajero': ['transporte-mejorado', 'area-usuario', 'chat-conversaciones'],
+    'conductor': ['transporte-mejorado', 'area-usuario', 'dashboard-conductor', 'chat-conversaciones'],
+    'admin': ['transporte-mejorado', 'area-usuario', 'dashboard-conductor', 'admin-conversaciones'],
+    'mis-viajes': ['transporte-mejorado', 'area-usuario', 'mis-viajes', 'chat-conversaciones'],
+    'nosotros': ['transporte-mejorado', 'nosotros', 'area-usuario', 'chat-conversaciones'],
+    'perfil': ['transporte-mejorado', 'area-usuario', 'perfil', 'chat-conversaciones'],
+    'reservas': ['transporte-mejorado', 'area-usuario', 'reservas', 'chat-conversaciones'],
+    'rutas': ['transporte-mejorado', 'rutas', 'area-usuario', 'chat-conversaciones'],
+    'servicios': ['transporte-mejorado', 'servicios', 'area-usuario', 'chat-conversaciones'],
+}
 
+# Anchos (px) de las variantes de cada imagen; el logo se muestra a 40px, de ahí 1x, 2x y 4x
+ANCHOS_IMAGENES = {'images/logo-liberty.png': (40, 80, 160)}
+ANCHOS_IMAGENES_DEFECTO = (320, 640, 1280)
+
+# Cadenas, comentarios y espacios; en la segunda pasada, espacios junto a delimitadores
+_CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|(/\*.*?\*/)|(\s+)', re.S)
+_CSS_DELIMITADORES = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')| ?([{};,>]) ?|(:) ')
+
+def minificar_css(texto):
+    """Quita comentarios y espacios sobrantes sin tocar el contenido de las cadenas"""
+    texto = _CSS_TOKENS.sub(lambda m: m.group(1) or ('' if m.group(2) else ' '), texto)
+    texto = _CSS_DELIMITADORES.sub(lambda m: m.group(1) or m.group(2) or m.group(3), texto)
+    return texto.replace(';}', '}').strip()
+
+def cargar_manifiesto():
     try:
-        cursor.execute('''
-            SELECT codigo_solicitud, origen, destino, fecha_servicio, hora_servicio,
-                   tipo_vehiculo, precio_estimado, precio_final, estado
-            FROM solicitudes_servicio
-            WHERE usuario_id = ?
-            ORDER BY fecha_servicio DESC
-        ''', (session['usuario_id'],))
-        for r in cursor.fetchall():
-            viajes.append({
-                'codigo_solicitud': r[0],
-                'origen': r[1],
-                'destino': r[2],
-                'fecha_servicio': r[3],
-                'hora_servicio': r[4],
-                'tipo_vehiculo': r[5],
-                'precio_estimado': r[6],
-                'precio_final': r[7],
-                'estado': r[8]
-            })
+        with open(ESTATICOS_MANIFIESTO, encoding='utf-8') as archivo:
+            return json.load(archivo)
+    except FileNotFoundError:
+        return {'archivos': {}, 'imagenes': {}, 'comprimidos': {}}
+
+def nombres_versionados(manifiesto):
+    """Rutas con huella que el manifiesto publica: copias versionadas y variantes de imágenes"""
+    nombres = set(manifiesto['archivos'].values())
+    for variantes in manifiesto['imagenes'].values():
+        nombres.update(ruta for lista in variantes.values() for _, ruta in lista)
+    return frozenset(nombres)
+
+# Se lee al arrancar: después de construir-estaticos hay que reiniciar los workers
+manifiesto_estaticos = cargar_manifiesto()
+versionados_estaticos = nombres_versionados(manifiesto_estaticos)
+
+def _escribir_versionado(relativo, contenido, comprimir=False):
+    """Guarda contenido como nombre.<hash>.ext bajo dist/ y devuelve la ruta relativa"""
+    base, extension = os.path.splitext(relativo)
+    huella = hashlib.sha256(contenido).hexdigest()[:12]
+    destino = f'{base}.{huella}{extension}'
+    ruta = os.path.join(ESTATICOS_DESTINO, destino)
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    with open(ruta, 'wb') as archivo:
+        archivo.write(contenido)
+    if comprimir:
+        with open(ruta + '.gz', 'wb') as archivo:
+            archivo.write(gzip.compress(contenido, 9, mtime=0))
+        if brotli is not None:
+            with open(ruta + '.br', 'wb') as archivo:
+                archivo.write(brotli.compress(contenido, quality=11))
+    return destino
+
+def _variantes_imagen(relativo, original):
+    """Variantes redimensionadas por formato: {'avif': [[ancho, ruta], ...], 'webp': ..., 'png': ...}"""
+    formatos = [('webp', 'WEBP', {'quality': 80, 'method': 6})]
+    if funciones_imagen.check('avif'):
+        formatos.insert(0, ('avif', 'AVIF', {'quality': 50}))
+    extension = os.path.splitext(relativo)[1].lstrip('.').lower()
+    formatos.append(('png', 'PNG', {'optimize': True}) if extension == 'png'
+                    else ('jpeg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}))
+    
+    variantes = {}
+    with Image.open(original) as imagen:
+        anchos = [a for a in ANCHOS_IMAGENES.get(relativo, ANCHOS_IMAGENES_DEFECTO) if a < imagen.width]
+        for ancho in anchos or [imagen.width]:
+            alto = round(imagen.height * ancho / imagen.width)
+            reducida = imagen.resize((ancho, alto), Image.LANCZOS)
+            if extension != 'png':
+                reducida = reducida.convert('RGB')
+            for clave, formato, opciones in formatos:
+                salida = io.BytesIO()
+                reducida.save(salida, formato, **opciones)
+                nombre = f'{os.path.splitext(relativo)[0]}-{ancho}.{clave.replace("jpeg", "jpg")}'
+                variantes.setdefault(clave, []).append([ancho, _escribir_versionado(nombre, salida.getvalue())])
+    return variantes
+
+def construir_estaticos():
+    """Genera dist/ y su manifiesto; devuelve (manifiesto, bytes originales, bytes generados)"""
+    manifiesto = {'archivos': {}, 'imagenes': {}, 'comprimidos': {}}
+    originales = generados = 0
+    
+    for paquete, hojas in PAQUETES_CSS.items():
+        partes = []
+        for hoja in hojas:
+            with open(os.path.join(app.static_folder, 'css', f'{hoja}.css'), encoding='utf-8') as archivo:
+                texto = archivo.read()
+            originales += len(texto.encode())
+            partes.append(minificar_css(texto))
+        contenido = '\n'.join(partes).encode()
+        destino = _escribir_versionado(f'paquetes/{paquete}.css', contenido, comprimir=True)
+        manifiesto['archivos'][f'paquetes/{paquete}.css'] = destino
+        manifiesto['comprimidos'][destino] = ['br', 'gzip'] if brotli is not None else ['gzip']
+        generados += os.path.getsize(os.path.join(
+            ESTATICOS_DESTINO, destino + ('.br' if brotli is not None else '.gz')
+        ))
+    
+    # Los scripts ya se escriben legibles y sin dependencias: solo se versionan y precomprimen
+    carpeta_scripts = os.path.join(app.static_folder, 'js')
+    for nombre in sorted(os.listdir(carpeta_scripts)) if os.path.isdir(carpeta_scripts) else []:
+        if not nombre.endswith('.js'):
+            continue
+        with open(os.path.join(carpeta_scripts, nombre), 'rb') as archivo:
+            contenido = archivo.read()
+        originales += len(contenido)
+        destino = _escribir_versionado(f'js/{nombre}', contenido, comprimir=True)
+        manifiesto['archivos'][f'js/{nombre}'] = destino
+        manifiesto['comprimidos'][destino] = ['br', 'gzip'] if brotli is not None else ['gzip']
+        generados += os.path.getsize(os.path.join(
+            ESTATICOS_DESTINO, destino + ('.br' if brotli is not None else '.gz')
+        ))
+    
+    carpeta_imagenes = os.path.join(app.static_folder, 'images')
+    for nombre in sorted(os.listdir(carpeta_imagenes)):
+        if os.path.splitext(nombre)[1].lower() not in ('.png', '.jpg', '.jpeg'):
+            continue
+        relativo = f'images/{nombre}'
+        original = os.path.join(carpeta_imagenes, nombre)
+        with open(original, 'rb') as archivo:
+            contenido = archivo.read()
+        originales += len(contenido)
+        manifiesto['archivos'][relativo] = _escribir_versionado(relativo, contenido)
+        if Image is not None:
+            manifiesto['imagenes'][relativo] = _variantes_imagen(relativo, original)
+            generados += min(
+                os.path.getsize(os.path.join(ESTATICOS_DESTINO, lista[0][1]))
+                for lista in manifiesto['imagenes'][relativo].values()
+            )
+        else:
+            generados += len(contenido)
+    
+    temporal = f'{ESTATICOS_MANIFIESTO}.{os.getpid()}'
+    with open(temporal, 'w', encoding='utf-8') as archivo:
+        json.dump(manifiesto, archivo, indent=2, sort_keys=True)
+    os.replace(temporal, ESTATICOS_MANIFIESTO)
+    return manifiesto, originales, generados
+
+def url_estatico(nombre):
+    """url_for('static') que prefiere la copia versionada cuando existe en el manifiesto"""
+    versionado = manifiesto_estaticos['archivos'].get(nombre)
+    if versionado is None:
+        return url_for('static', filename=nombre)
+    return url_for('estatico_versionado', nombre=versionado)
+
+def hojas_estilo(paquete):
+    """Un <link> al paquete minificado, o las hojas sueltas si no se construyó"""
+    nombre = f'paquetes/{paquete}.css'
+    if nombre in manifiesto_estaticos['archivos']:
+        hrefs = [url_estatico(nombre)]
+    else:
+        hrefs = [url_for('static', filename=f'css/{hoja}.css') for hoja in PAQUETES_CSS[paquete]]
+    return Markup('\n    '.join(f'<link rel="stylesheet" href="{escape(href)}">' for href in hrefs))
+
+def imagen(nombre, alt, ancho, alto, **atributos):
+    """<picture> con las variantes AVIF/WebP del manifiesto y el formato original de respaldo"""
+    extra = ''.join(f' {clave}="{escape(valor)}"' for clave, valor in atributos.items())
+    variantes = manifiesto_estaticos['imagenes'].get(nombre)
+    if not variantes:
+        return Markup(f'<img src="{escape(url_estatico(nombre))}" alt="{escape(alt)}" '
+                      f'width="{ancho}" height="{alto}"{extra}>')
+    
+    def srcset(lista):
+        return ', '.join(f'{url_for("estatico_versionado", nombre=ruta)} {a}w' for a, ruta in lista)
+    
+    fuentes = ''.join(
+        f'<source type="image/{formato}" srcset="{escape(srcset(variantes[formato]))}" sizes="{ancho}px">'
+        for formato in ('avif', 'webp') if formato in variantes
+    )
+    respaldo = variantes.get('png') or variantes['jpeg']
+    # El src de respaldo es la variante más chica que cubre el ancho mostrado
+    src = next((ruta for a, ruta in respaldo if a >= ancho), respaldo[-1][1])
+    return Markup(
+        f'<picture>{fuentes}<img src="{escape(url_for("estatico_versionado", nombre=src))}" '
+        f'srcset="{escape(srcset(respaldo))}" sizes="{ancho}px" alt="{escape(alt)}" '
+        f'width="{ancho}" height="{alto}"{extra}></picture>'
+    )
+
+app.jinja_env.globals.update(url_estatico=url_estatico, hojas_estilo=hojas_estilo, imagen=imagen)
+
+@app.route('/estaticos/<path:nombre>')
+def estatico_versionado(nombre):
+    """Archivos con huella en el nombre: nunca cambian, así que se cachean un año sin revalidar"""
+    # Solo lo que publica el manifiesto cargado: el propio manifiesto o un archivo sin huella
+    # quedarían fijados un año en navegadores y CDN
+    if nombre not in versionados_estaticos:
+        abort(404)
+    codificacion = None
+    for candidata in manifiesto_estaticos['comprimidos'].get(nombre, ()):
+        if request.accept_encodings.quality(candidata) > 0:
+            codificacion = candidata
+            break
+    sufijo = {'br': '.br', 'gzip': '.gz'}.get(codificacion, '')
+    
+    respuesta = send_from_directory(
+        ESTATICOS_DESTINO, nombre + sufijo,
+        mimetype=mimetypes.guess_type(nombre)[0], max_age=ESTATICOS_MAX_AGE
+    )
+    respuesta.cache_control.public = True
+    respuesta.cache_control.immutable = True
+    if manifiesto_estaticos['comprimidos'].get(nombre):
+        respuesta.vary.add('Accept-Encoding')
+    if codificacion:
+        respuesta.content_encoding = codificacion
+    return respuesta
+
+@app.cli.command('construir-estaticos')
+@click.option('--limpiar', is_flag=True, help='Borra de dist/ los archivos que ya no están en el manifiesto')
+def comando_construir_estaticos(limpiar):
+    """Minifica y agrupa el CSS, versiona los scripts, genera variantes de imágenes y escribe dist/manifiesto.json"""
+    if Image is None:
+        print("⚠️ Pillow no está instalado: las imágenes solo se copian con huella, sin variantes")
+    if brotli is None:
+        print("⚠️ brotli no está instalado: solo se generan copias .gz")
+    
+    manifiesto, originales, generados = construir_estaticos()
+    print(f"✓ {len(manifiesto['archivos'])} archivos versionados en {ESTATICOS_DESTINO}")
+    print(f"  {originales:,} bytes de origen -> {generados:,} bytes en la variante más liviana de cada recurso")
+    
+    if limpiar:
+        vigentes = {ESTATICOS_MANIFIESTO}
+        for destino in manifiesto['archivos'].values():
+            ruta = os.path.join(ESTATICOS_DESTINO, destino)
+            vigentes.update((ruta, ruta + '.gz', ruta + '.br'))
+        for variantes in manifiesto['imagenes'].values():
+            vigentes.update(os.path.join(ESTATICOS_DESTINO, r) for lista in variantes.values() for _, r in lista)
+        for carpeta, _, archivos in os.walk(ESTATICOS_DESTINO):
+            for nombre in archivos:
+                ruta = os.path.join(carpeta, nombre)
+                if ruta not in vigentes:
+                    os.remove(ruta)
+    print("Reinicie los workers para que tomen el manifiesto nuevo")
+
+# ============================================
+# SERIALIZACIÓN JSON
+# ============================================
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class ProveedorJSON(DefaultJSONProvider):
+    """jsonify con orjson cuando está instalado; si no, el json de la librería estándar"""
+
+    # Las fechas pasan por el mismo default de Flask para no cambiar su formato
+    OPCIONES_ORJSON = (orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        if orjson is None or kwargs:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=self.OPCIONES_ORJSON).decode('utf-8')
+
+    @staticmethod
+    def _objeto_respuesta(args, kwargs):
+        # Lo mismo que acepta jsonify: nada, un valor, varios valores (lista) o claves (dict)
+        if args and kwargs:
+            raise TypeError('jsonify() no acepta argumentos posicionales y con nombre a la vez')
+        if len(args) == 1:
+            return args[0]
+        return args or kwargs or None
+
+    def response(self, *args, **kwargs):
+        if orjson is None or app.debug:
+            return super().response(*args, **kwargs)
+        obj = self._objeto_respuesta(args, kwargs)
+        cuerpo = orjson.dumps(obj, default=self.default, option=self.OPCIONES_ORJSON) + b'\n'
+        return self._app.response_class(cuerpo, mimetype=self.mimetype)
+
+app.json = ProveedorJSON(app)
+
+# Nombres de campo de las listas que la consulta ya proyecta en este orden y con su valor final
+CAMPOS_RUTAS = (
+    'id', 'origen', 'destino', 'distancia_km', 'duracion_horas',
+    'precio_base', 'tipo_ruta', 'descripcion', 'activa'
+)
+CAMPOS_HORARIOS = (
+    'id', 'fecha_salida', 'fecha_llegada', 'precio', 'asientos_disponibles', 'estado',
+    'placa', 'tipo_vehiculo', 'marca', 'modelo', 'origen', 'destino', 'duracion_horas'
+)
+
+def filas_como_dicts(campos, filas):
+    """dict(zip) de cada fila posicional; las columnas sobrantes al final (claves de paginación) se ignoran"""
+    return [dict(zip(campos, fila)) for fila in filas]
+
+def _horarios_sinteticos(cantidad):
+    return [
+        (i, '2025-06-01 08:00:00', '2025-06-01 14:00:00', 85000.0, 30 - i % 30, 'programado',
+         f'ABC{i % 1000:03d}', 'bus', 'Mercedes-Benz', 'Sprinter', 'Bogotá', 'Medellín', 6.0)
+        for i in range(cantidad)
+    ]
+
+@app.cli.command('rendimiento-json')
+@click.option('--filas', default=10000, help='Filas de la respuesta de prueba')
+@click.option('--repeticiones', default=20, help='Veces que se serializa cada variante')
+def comando_rendimiento_json(filas, repeticiones):
+    """Compara armar dicts a mano + json estándar contra filas_como_dicts + ProveedorJSON"""
+    datos = _horarios_sinteticos(filas)
+    
+    def camino_anterior():
+        lista = [{
+            'id': h[0], 'fecha_salida': h[1], 'fecha_llegada': h[2], 'precio': h[3],
+            'asientos_disponibles': h[4], 'estado': h[5], 'placa': h[6], 'tipo_vehiculo': h[7],
+            'marca': h[8], 'modelo': h[9], 'origen': h[10], 'destino': h[11], 'duracion_horas': h[12]
+        } for h in datos]
+        # Mismas opciones que el proveedor por defecto de Flask fuera de modo debug
+        return json.dumps({'success': True, 'horarios': lista}, sort_keys=True,
+                          ensure_ascii=True, separators=(',', ':')).encode('utf-8')
+    
+    def camino_nuevo():
+        return app.json.response({'success': True, 'horarios': filas_como_dicts(CAMPOS_HORARIOS, datos)}).get_data()
+    
+    variantes = [('dicts a mano + json', camino_anterior), ('filas_como_dicts + ' + ('orjson' if orjson else 'json'), camino_nuevo)]
+    tiempos = {}
+    for nombre, funcion in variantes:
+        inicio = time.perf_counter()
+        for _ in range(repeticiones):
+            cuerpo = funcion()
+        tiempos[nombre] = (time.perf_counter() - inicio) / repeticiones
+        print(f"{nombre}: {tiempos[nombre] * 1000:.1f} ms por respuesta, {len(cuerpo)} bytes")
+    
+    anterior, nuevo = tiempos.values()
+    print(f"✓ {anterior / nuevo:.1f}x más rápido con {filas} filas")
+
+# ============================================
+# CACHÉ DE LECTURAS CON ETAG
+# ============================================
+
+# Respuestas serializadas que guarda cada proceso antes de descartar las menos usadas
+CACHE_LECTURAS_MAX = int(os.environ.get('CACHE_LECTURAS_MAX', '512'))
+
+class CacheLecturas:
+    """LRU de respuestas JSON ya serializadas, indexadas por consulta y versión de los datos"""
+
+    def __init__(self, maximo):
+        self.maximo = maximo
+        self._entradas = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave):
+        with self._lock:
+            entrada = self._entradas.get(clave)
+            if entrada is not None:
+                self._entradas.move_to_end(clave)
+            return entrada
+
+    def guardar(self, clave, entrada):
+        with self._lock:
+            self._entradas[clave] = entrada
+            self._entradas.move_to_end(clave)
+            while len(self._entradas) > self.maximo:
+                self._entradas.popitem(last=False)
+
+cache_lecturas = CacheLecturas(CACHE_LECTURAS_MAX)
+
+def obtener_versiones(conn, claves):
+    """Versión actual de cada clave de versiones_datos (0 si nunca se escribió)"""
+    marcadores = ', '.join('?' for _ in claves)
+    versiones = dict(conn.execute(
+        f'SELECT clave, version FROM versiones_datos WHERE clave IN ({marcadores})', claves
+    ).fetchall())
+    return tuple(versiones.get(clave, 0) for clave in claves)
+
+def respuesta_cacheada(clave, construir, cache_control):
+    """Sirve desde la caché (o 304) si la versión no cambió; si no, construye y guarda
+
+    construir() devuelve el dict de la respuesta, o una respuesta ya armada (errores)
+    que se envía sin guardar.
+    """
+    entrada = cache_lecturas.obtener(clave)
+    if entrada is None:
+        datos = construir()
+        if not isinstance(datos, dict):
+            return datos
+        cuerpo = jsonify(datos).get_data()
+        entrada = (cuerpo, hashlib.sha256(cuerpo).hexdigest()[:32])
+        cache_lecturas.guardar(clave, entrada)
+    
+    cuerpo, etag = entrada
+    respuesta = Response(cuerpo, mimetype='application/json')
+    respuesta.set_etag(etag)
+    respuesta.headers['Cache-Control'] = cache_control
+    return respuesta.make_conditional(request)
+
+def clave_parametros():
+    return tuple(sorted(request.args.items(multi=True)))
+
+# ============================================
+# COMPRESIÓN DE RESPUESTAS
+# ============================================
+
+# Tipos que se comprimen y tamaño mínimo del cuerpo; por debajo, las cabeceras pesan más que el ahorro
+COMPRESION_TIPOS = {'text/html', 'application/json', 'text/css', 'text/javascript',
+                    'application/javascript', 'text/plain', 'text/event-stream'}
+COMPRESION_MINIMO = int(os.environ.get('COMPRESION_MINIMO', '1024'))
+# Niveles para respuestas de una sola vez: rápidos, porque se pagan en cada petición
+COMPRESION_NIVEL_GZIP = int(os.environ.get('COMPRESION_NIVEL_GZIP', '6'))
+COMPRESION_CALIDAD_BROTLI = int(os.environ.get('COMPRESION_CALIDAD_BROTLI', '5'))
+# Cuerpos comprimidos que guarda cada proceso (páginas renderizadas y respuestas con ETag)
+COMPRESION_CACHE_MAX = int(os.environ.get('COMPRESION_CACHE_MAX', '256'))
+
+cache_comprimidos = CacheLecturas(COMPRESION_CACHE_MAX)
+
+def elegir_codificacion():
+    """'br' o 'gzip' según Accept-Encoding, o None si el cliente no acepta ninguna"""
+    if brotli is not None and request.accept_encodings.quality('br') > 0:
+        return 'br'
+    if request.accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+def comprimir(datos, codificacion, maximo=False):
+    if codificacion == 'br':
+        return brotli.compress(datos, quality=11 if maximo else COMPRESION_CALIDAD_BROTLI)
+    return gzip.compress(datos, 9 if maximo else COMPRESION_NIVEL_GZIP, mtime=0)
+
+def _comprimir_flujo(partes, codificacion):
+    """Comprime un cuerpo en streaming vaciando el compresor tras cada parte (eventos SSE)"""
+    if codificacion == 'br':
+        compresor = brotli.Compressor(quality=COMPRESION_CALIDAD_BROTLI)
+        vaciar, terminar = compresor.flush, compresor.finish
+        procesar = compresor.process
+    else:
+        compresor = zlib.compressobj(COMPRESION_NIVEL_GZIP, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        vaciar = lambda: compresor.flush(zlib.Z_SYNC_FLUSH)
+        terminar = compresor.flush
+        procesar = compresor.compress
+    try:
+        for parte in partes:
+            if isinstance(parte, str):
+                parte = parte.encode()
+            bloque = procesar(parte) + vaciar()
+            if bloque:
+                yield bloque
+        yield terminar()
     finally:
-        conn.close()
+        if hasattr(partes, 'close'):
+            partes.close()
 
-    return render_template('mis-viajes.html', viajes=viajes)
+@app.after_request
+def comprimir_respuesta(respuesta):
+    """Comprime HTML, JSON y flujos SSE con gzip o brotli según lo que acepte el cliente"""
+    if respuesta.mimetype not in COMPRESION_TIPOS or respuesta.direct_passthrough or respuesta.content_encoding:
+        return respuesta
+    
+    # También en los 304: la respuesta que validan pudo llegar comprimida
+    respuesta.vary.add('Accept-Encoding')
+    if respuesta.status_code in (204, 206, 304) or respuesta.status_code < 200 or request.method == 'HEAD':
+        return respuesta
+    
+    codificacion = elegir_codificacion()
+    if codificacion is None:
+        return respuesta
+    
+    if respuesta.is_streamed:
+        respuesta.response = _comprimir_flujo(respuesta.response, codificacion)
+        respuesta.headers.pop('Content-Length', None)
+        respuesta.content_encoding = codificacion
+        return respuesta
+    
+    datos = respuesta.get_data()
+    if len(datos) < COMPRESION_MINIMO:
+        return respuesta
+    
+    etag, debil = respuesta.get_etag()
+    if etag or respuesta.mimetype == 'text/html':
+        # Las páginas renderizadas y las lecturas con ETag se repiten igual entre peticiones:
+        # se comprimen una vez al máximo nivel y se sirven desde la caché
+        clave = (etag or hashlib.sha256(datos).hexdigest(), codificacion)
+        comprimido = cache_comprimidos.obtener(clave)
+        if comprimido is None:
+            comprimido = comprimir(datos, codificacion, maximo=True)
+            cache_comprimidos.guardar(clave, comprimido)
+    else:
+        comprimido = comprimir(datos, codificacion)
+    
+    if len(comprimido) >= len(datos):
+        return respuesta
+    respuesta.set_data(comprimido)
+    respuesta.content_encoding = codificacion
+    # El ETag describe el cuerpo sin comprimir: como débil sigue validando If-None-Match
+    if etag and not debil:
+        respuesta.set_etag(etag, weak=True)
+    return respuesta
 
-def generar_codigo_reserva():
-    import string
-    import random
-    codigo = 'RES-' + ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT id FROM reservas WHERE codigo_reserva = ?', (codigo,))
-    if cursor.fetchone():
-        conn.close()
-        return generar_codigo_reserva()
-    conn.close()
-    return codigo
+@app.cli.command('rendimiento-compresion')
+@click.option('--conversaciones', default=30, help='Conversaciones sintéticas del usuario de prueba')
+def comando_rendimiento_compresion(conversaciones):
+    """Bytes transferidos por ruta sin comprimir, con gzip y con brotli, sobre una base temporal"""
+    global DATABASE, _pool
+    
+    with tempfile.TemporaryDirectory() as directorio:
+        DATABASE = os.path.join(directorio, 'compresion.db')
+        _pool = None
+        
+        with app.app_context():
+            aplicar_migraciones()
+            insertar_horarios_prueba()
+            crear_primer_admin()
+            ruta_id = get_db().execute('SELECT id FROM rutas WHERE activa = 1 LIMIT 1').fetchone()[0]
+        
+        cliente = app.test_client()
+        cliente.post('/api/login', json={'email': 'admin@transporteaguila.com', 'password': 'Admin123!'})
+        for numero in range(conversaciones):
+            cliente.post('/api/iniciar-conversacion', json={
+                'mensaje': f'Consulta {numero}: ¿a qué hora sale el bus de Quibdó hacia Tadó mañana?'
+            })
+        
+        hoy = datetime.now().date()
+        rutas = ['/login', '/dashboard-admin', '/servicios', '/rutas', '/nosotros', '/perfil',
+                 '/api/rutas', f'/api/horarios/{ruta_id}?desde={hoy}&hasta={hoy + timedelta(days=6)}',
+                 '/api/mis-conversaciones']
+        codificaciones = ['identity', 'gzip'] + (['br'] if brotli is not None else [])
+        
+        print(f"{'Ruta':<48}" + ''.join(f'{c:>10}' for c in codificaciones) + f"{'Ahorro':>9}{'ms':>8}")
+        totales = dict.fromkeys(codificaciones, 0)
+        for ruta in rutas:
+            tamanos = {}
+            for codificacion in codificaciones:
+                respuesta = cliente.get(ruta, headers={'Accept-Encoding': codificacion})
+                tamanos[codificacion] = len(respuesta.get_data())
+                totales[codificacion] += tamanos[codificacion]
+            # Tiempo de una petición repetida con la mejor codificación (caché caliente en páginas)
+            inicio = time.perf_counter()
+            cliente.get(ruta, headers={'Accept-Encoding': codificaciones[-1]})
+            duracion = (time.perf_counter() - inicio) * 1000
+            ahorro = 1 - tamanos[codificaciones[-1]] / tamanos['identity']
+            print(f'{ruta[:47]:<48}' + ''.join(f'{tamanos[c]:>10,}' for c in codificaciones)
+                  + f'{ahorro:>9.0%}{duracion:>8.1f}')
+        ahorro = 1 - totales[codificaciones[-1]] / totales['identity']
+        print(f"{'Total':<48}" + ''.join(f'{totales[c]:>10,}' for c in codificaciones) + f'{ahorro:>9.0%}')
+        credenciales.cerrar()
+        _pool = None
 
 @app.route('/api/rutas', methods=['GET'])
 def api_rutas():
     """Obtiene todas las rutas disponibles"""
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT id, origen, destino, distancia_km, duracion_horas, 
-                   precio_base, tipo_ruta, descripcion, activa
-            FROM rutas
-            WHERE activa = 1
-            ORDER BY origen, destino
-        ''')
-        rutas = cursor.fetchall()
-        conn.close()
-        
-        rutas_list = []
-        for r in rutas:
-            rutas_list.append({
-                'id': r[0],
-                'origen': r[1],
-                'destino': r[2],
-                'distancia_km': r[3],
-                'duracion_horas': r[4],
-                'precio_base': r[5],
-                'tipo_ruta': r[6],
-                'descripcion': r[7],
-                'activa': r[8]
-            })
-        
+        conn = get_db()
+        versiones = obtener_versiones(conn, ('rutas',))
+        return respuesta_cacheada(
+            ('rutas', versiones, clave_parametros()),
+            lambda: _construir_rutas(conn),
+            'public, max-age=60, must-revalidate'
+        )
+    except ValueError:
         return jsonify({
-            'success': True,
-            'rutas': rutas_list
-        })
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         print(f"Error obteniendo rutas: {e}")
         return jsonify({
@@ -1570,9 +3653,125 @@ def api_rutas():
             'message': 'Error obteniendo rutas'
         }), 500
 
+def _construir_rutas(conn):
+    cursor = conn.cursor()
+    condiciones, parametros = leer_filtros({'tipo': 'tipo_ruta', 'origen': 'origen', 'destino': 'destino'})
+    rutas, siguiente_cursor = consultar_listado(
+        cursor,
+        '''id, origen, destino, distancia_km, duracion_horas, 
+           precio_base, tipo_ruta, descripcion, activa''',
+        'rutas',
+        (['activa = 1'] + condiciones, parametros),
+        [('origen', False), ('destino', False), ('id', False)],
+        leer_pagina()
+    )
+    
+    return {
+        'success': True,
+        'rutas': filas_como_dicts(CAMPOS_RUTAS, rutas),
+        'siguiente_cursor': siguiente_cursor
+    }
+
+# Máximo de asientos que se pueden apartar en una sola reserva
+MAX_ASIENTOS_POR_RESERVA = 10
+
+def reservar_asientos(usuario_id, horario_id, pasajero, cantidad=1, asientos=None):
+    """Descuenta y asigna asientos de un horario en una única transacción de escritura"""
+    conn = get_db()
+    cursor = conn.cursor()
+    comenzar_escritura(conn)
+    
+    try:
+        # El descuento condicional es la garantía contra sobreventa: si no alcanzan
+        # los asientos no se modifica ninguna fila
+        cursor.execute('''
+            UPDATE horarios
+            SET asientos_disponibles = asientos_disponibles - ?
+            WHERE id = ? AND estado = 'programado' AND asientos_disponibles >= ?
+        ''', (cantidad, horario_id, cantidad))
+        
+        if cursor.rowcount == 0:
+            cursor.execute('''
+                SELECT asientos_disponibles FROM horarios
+                WHERE id = ? AND estado = 'programado'
+            ''', (horario_id,))
+            horario = cursor.fetchone()
+            conn.rollback()
+            if not horario:
+                return False, 'Horario no disponible'
+            if horario[0] <= 0:
+                return False, 'No hay asientos disponibles'
+            return False, f'Solo quedan {horario[0]} asientos disponibles'
+        
+        cursor.execute('''
+            SELECT h.precio, v.capacidad_pasajeros
+            FROM horarios h
+            JOIN vehiculos v ON h.vehiculo_id = v.id
+            WHERE h.id = ?
+        ''', (horario_id,))
+        precio, capacidad = cursor.fetchone()
+        
+        cursor.execute('''
+            SELECT numero_asiento FROM reservas
+            WHERE horario_id = ? AND estado != 'cancelada' AND numero_asiento IS NOT NULL
+        ''', (horario_id,))
+        ocupados = {fila[0] for fila in cursor.fetchall()}
+        
+        if asientos:
+            if len(set(asientos)) != cantidad:
+                conn.rollback()
+                return False, 'La lista de asientos no coincide con la cantidad solicitada'
+            for numero in asientos:
+                if numero < 1 or numero > capacidad or numero in ocupados:
+                    conn.rollback()
+                    return False, f'El asiento {numero} no está disponible'
+            elegidos = sorted(asientos)
+        else:
+            elegidos = [n for n in range(1, capacidad + 1) if n not in ocupados][:cantidad]
+            if len(elegidos) < cantidad:
+                conn.rollback()
+                return False, 'No hay asientos disponibles'
+        
+        fecha_vencimiento = (datetime.now() + timedelta(hours=2)).strftime('%Y-%m-%d %H:%M:%S')
+        reservas = []
+        
+        for numero_asiento in elegidos:
+            codigo_reserva = generar_codigo_reserva()
+            cursor.execute('''
+                INSERT INTO reservas (
+                    codigo_reserva, usuario_id, horario_id, numero_asiento, nombre_pasajero,
+                    cedula_pasajero, telefono_pasajero, email_pasajero,
+                    precio_total, estado, fecha_vencimiento, notas
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pendiente', ?, ?)
+            ''', (
+                codigo_reserva,
+                usuario_id,
+                horario_id,
+                numero_asiento,
+                pasajero['nombre'],
+                pasajero['cedula'],
+                pasajero['telefono'],
+                pasajero['email'],
+                precio,
+                fecha_vencimiento,
+                pasajero.get('notas', '')
+            ))
+            reservas.append({
+                'id': cursor.lastrowid,
+                'codigo_reserva': codigo_reserva,
+                'numero_asiento': numero_asiento,
+                'fecha_vencimiento': fecha_vencimiento
+            })
+        
+        conn.commit()
+        return True, reservas
+    except Exception:
+        conn.rollback()
+        raise
+
 @app.route('/api/reservar', methods=['POST'])
 def api_reservar():
-    """Crea una nueva reserva"""
+    """Crea una nueva reserva de uno o varios asientos"""
     if 'usuario_id' not in session:
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
@@ -1587,81 +3786,432 @@ def api_reservar():
                     'message': f'El campo {campo} es obligatorio'
                 }), 400
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT asientos_disponibles, precio 
-            FROM horarios 
-            WHERE id = ? AND estado = 'programado'
-        ''', (data['horario_id'],))
-        
-        horario = cursor.fetchone()
-        
-        if not horario:
-            conn.close()
+        asientos = data.get('asientos') or None
+        try:
+            cantidad = int(data.get('cantidad') or (len(asientos) if asientos else 1))
+            if asientos:
+                asientos = [int(numero) for numero in asientos]
+        except (TypeError, ValueError):
             return jsonify({
                 'success': False,
-                'message': 'Horario no disponible'
+                'message': 'Cantidad o asientos inválidos'
             }), 400
         
-        if horario[0] <= 0:
-            conn.close()
+        if cantidad < 1 or cantidad > MAX_ASIENTOS_POR_RESERVA:
             return jsonify({
                 'success': False,
-                'message': 'No hay asientos disponibles'
+                'message': f'Se pueden reservar entre 1 y {MAX_ASIENTOS_POR_RESERVA} asientos'
             }), 400
         
-        codigo_reserva = generar_codigo_reserva()
-        
-        from datetime import datetime, timedelta
-        fecha_vencimiento = datetime.now() + timedelta(hours=2)
-        
-        cursor.execute('''
-            INSERT INTO reservas (
-                codigo_reserva, usuario_id, horario_id, nombre_pasajero,
-                cedula_pasajero, telefono_pasajero, email_pasajero,
-                precio_total, estado, fecha_vencimiento, notas
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'pendiente', ?, ?)
-        ''', (
-            codigo_reserva,
+        exito, resultado = reservar_asientos(
             session['usuario_id'],
             data['horario_id'],
-            data['nombre'],
-            data['cedula'],
-            data['telefono'],
-            data['email'],
-            horario[1],
-            fecha_vencimiento.strftime('%Y-%m-%d %H:%M:%S'),
-            data.get('notas', '')
-        ))
+            data,
+            cantidad,
+            asientos
+        )
         
-        cursor.execute('''
-            UPDATE horarios 
-            SET asientos_disponibles = asientos_disponibles - 1
-            WHERE id = ?
-        ''', (data['horario_id'],))
+        if not exito:
+            return jsonify({
+                'success': False,
+                'message': resultado
+            }), 400
         
-        conn.commit()
-        reserva_id = cursor.lastrowid
-        conn.close()
+        return jsonify({
+            'success': True,
+            'reserva': resultado[0],
+            'reservas': resultado,
+            'message': 'Reserva creada exitosamente'
+        })
         
+    except Exception as e:
+        print(f"Error creando reserva: {e}")
+        return jsonify({
+            'success': False,
+            'message': 'Error procesando la reserva'
+        }), 500
+
+def _estres_reservar(args):
+    usuario_id, horario_id, cantidad = args
+    pasajero = {'nombre': 'Prueba', 'cedula': '0', 'telefono': '0', 'email': 'prueba@carga.local'}
+    with app.app_context():
+        exito, resultado = reservar_asientos(usuario_id, horario_id, pasajero, cantidad)
+    return cantidad if exito else 0
+
+@app.cli.command('estres-reservas')
+@click.option('--reservas', default=500, help='Número de reservas concurrentes')
+@click.option('--procesos', default=8, help='Procesos que reservan en paralelo')
+def comando_estres_reservas(reservas, procesos):
+    """Lanza reservas concurrentes sobre una base temporal y verifica que no haya sobreventa"""
+    global DATABASE, _pool
+    
+    with tempfile.TemporaryDirectory() as directorio:
+        DATABASE = os.path.join(directorio, 'estres.db')
+        _pool = None
+        
+        with app.app_context():
+            aplicar_migraciones()
+            conn = get_db()
+            conn.execute('''
+                INSERT INTO usuarios (nombre, apellido, email, telefono, cedula, password_hash)
+                VALUES ('Carga', 'Prueba', 'carga@prueba.local', '0', '0', '-')
+            ''')
+            usuario_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            ruta_id, precio = conn.execute('SELECT id, precio_base FROM rutas LIMIT 1').fetchone()
+            vehiculo_id, capacidad = conn.execute(
+                'SELECT id, capacidad_pasajeros FROM vehiculos ORDER BY capacidad_pasajeros DESC LIMIT 1'
+            ).fetchone()
+            conn.execute('''
+                INSERT INTO horarios (ruta_id, vehiculo_id, fecha_salida, precio, asientos_disponibles)
+                VALUES (?, ?, datetime('now', '+1 day'), ?, ?)
+            ''', (ruta_id, vehiculo_id, precio, capacidad))
+            horario_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            conn.commit()
+        
+        trabajos = [(usuario_id, horario_id, random.randint(1, 3)) for _ in range(reservas)]
+        inicio = time.perf_counter()
+        with multiprocessing.get_context('fork').Pool(procesos) as grupo:
+            vendidos = sum(grupo.map(_estres_reservar, trabajos, chunksize=1))
+        duracion = time.perf_counter() - inicio
+        
+        with app.app_context():
+            conn = get_db()
+            restantes = conn.execute(
+                'SELECT asientos_disponibles FROM horarios WHERE id = ?', (horario_id,)
+            ).fetchone()[0]
+            filas, distintos = conn.execute('''
+                SELECT COUNT(*), COUNT(DISTINCT numero_asiento) FROM reservas WHERE horario_id = ?
+            ''', (horario_id,)).fetchone()
+        _pool = None
+    
+    print(f"{reservas} intentos en {duracion:.2f}s con {procesos} procesos")
+    print(f"Capacidad {capacidad}, vendidos {vendidos}, restantes {restantes}, filas {filas}")
+    
+    if restantes < 0 or vendidos > capacidad or filas != vendidos or distintos != filas \
+            or restantes != capacidad - vendidos:
+        print("✗ Sobreventa o asientos duplicados detectados")
+        raise SystemExit(1)
+    print("✓ Sin sobreventa ni asientos duplicados")
+
+# ============================================
+# VENCIMIENTO DE RESERVAS PENDIENTES
+# ============================================
+
+# Segundos entre barridos (0 desactiva el hilo) y reservas liberadas por transacción
+RESERVAS_BARRIDO_SEGUNDOS = int(os.environ.get('RESERVAS_BARRIDO_SEGUNDOS', '60'))
+RESERVAS_BARRIDO_LOTE = int(os.environ.get('RESERVAS_BARRIDO_LOTE', '200'))
+
+METRICAS_BARRIDO = {
+    'barridos': 0,
+    'reservas_vencidas': 0,
+    'asientos_liberados': 0,
+    'ultimo_barrido': None,
+}
+_metricas_barrido_lock = threading.Lock()
+_hilo_barrido = None
+
+def liberar_reservas_vencidas(lote=RESERVAS_BARRIDO_LOTE):
+    """Cancela las reservas pendientes vencidas y devuelve sus asientos, por lotes"""
+    conn = get_db()
+    cursor = conn.cursor()
+    ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    total = 0
+    
+    while True:
+        # Con el candado de escritura tomado ningún otro worker puede cancelar
+        # las mismas filas, así que cada asiento se devuelve una sola vez
+        comenzar_escritura(conn)
+        try:
+            cursor.execute('''
+                SELECT id, horario_id FROM reservas
+                WHERE estado = 'pendiente' AND fecha_vencimiento < ?
+                ORDER BY fecha_vencimiento
+                LIMIT ?
+            ''', (ahora, lote))
+            vencidas = cursor.fetchall()
+            
+            if not vencidas:
+                conn.rollback()
+                break
+            
+            cursor.executemany(
+                "UPDATE reservas SET estado = 'cancelada' WHERE id = ? AND estado = 'pendiente'",
+                [(reserva_id,) for reserva_id, _ in vencidas]
+            )
+            
+            por_horario = {}
+            for _, horario_id in vencidas:
+                por_horario[horario_id] = por_horario.get(horario_id, 0) + 1
+            cursor.executemany('''
+                UPDATE horarios
+                SET asientos_disponibles = asientos_disponibles + ?
+                WHERE id = ?
+            ''', [(cantidad, horario_id) for horario_id, cantidad in por_horario.items()])
+            
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        
+        total += len(vencidas)
+        if len(vencidas) < lote:
+            break
+    
+    with _metricas_barrido_lock:
+        METRICAS_BARRIDO['barridos'] += 1
+        METRICAS_BARRIDO['reservas_vencidas'] += total
+        METRICAS_BARRIDO['asientos_liberados'] += total
+        METRICAS_BARRIDO['ultimo_barrido'] = ahora
+    
+    return total
+
+def _ciclo_barrido_reservas():
+    while True:
+        time.sleep(RESERVAS_BARRIDO_SEGUNDOS)
+        try:
+            with app.app_context():
+                liberadas = liberar_reservas_vencidas()
+            if liberadas:
+                print(f"✓ {liberadas} reservas vencidas liberadas")
+        except Exception as e:
+            print(f"Error liberando reservas vencidas: {e}")
+
+def iniciar_barrido_reservas():
+    """Arranca (una vez por proceso) el hilo que libera reservas vencidas"""
+    global _hilo_barrido
+    if RESERVAS_BARRIDO_SEGUNDOS <= 0 or _hilo_barrido is not None:
+        return
+    _hilo_barrido = threading.Thread(target=_ciclo_barrido_reservas, name='barrido-reservas', daemon=True)
+    _hilo_barrido.start()
+
+@app.cli.command('barrer-reservas')
+def comando_barrer_reservas():
+    """Libera una vez las reservas pendientes vencidas (útil desde cron)"""
+    aplicar_migraciones()
+    print(f"✓ {liberar_reservas_vencidas()} reservas vencidas liberadas")
+
+@app.route('/api/metricas-barrido-reservas', methods=['GET'])
+def api_metricas_barrido_reservas():
+    """Métricas del barrido de reservas vencidas de este proceso - Solo administradores"""
+    if 'usuario_id' not in session or session.get('tipo_usuario') != 'administrador':
+        return jsonify({'success': False, 'message': 'No autorizado'}), 403
+    
+    with _metricas_barrido_lock:
+        metricas = dict(METRICAS_BARRIDO)
+    
+    return jsonify({
+        'success': True,
+        'metricas': metricas
+    })
+
+@app.route('/api/conflictos-vehiculos', methods=['GET'])
+def api_conflictos_vehiculos():
+    """Horarios vigentes con el mismo vehículo en viajes solapados - Solo administradores"""
+    if 'usuario_id' not in session or session.get('tipo_usuario') != 'administrador':
+        return jsonify({'success': False, 'message': 'No autorizado'}), 403
+    
+    try:
+        conflictos = detectar_conflictos_vehiculos(
+            get_db(), request.args.get('desde'), request.args.get('hasta')
+        )
         return jsonify({
             'success': True,
-            'reserva': {
-                'id': reserva_id,
-                'codigo_reserva': codigo_reserva,
-                'fecha_vencimiento': fecha_vencimiento.strftime('%Y-%m-%d %H:%M:%S')
-            },
-            'message': 'Reserva creada exitosamente'
+            'conflictos': [{
+                'vehiculo_id': vehiculo_id,
+                'placa': placa,
+                'horario': {'id': id_a, 'fecha_salida': salida_a, 'fecha_llegada': llegada_a},
+                'solapado_con': {'id': id_b, 'fecha_salida': salida_b, 'fecha_llegada': llegada_b}
+            } for vehiculo_id, placa, id_a, salida_a, llegada_a, id_b, salida_b, llegada_b in conflictos]
         })
-        
     except Exception as e:
-        print(f"Error creando reserva: {e}")
-        return jsonify({
-            'success': False,
-            'message': 'Error procesando la reserva'
-        }), 500
+        print(f"Error detectando conflictos de vehículos: {e}")
+        return jsonify({'success': False, 'message': 'Error del servidor'}), 500
+
+# ============================================
+# EVENTOS DE CHAT EN TIEMPO REAL (SSE)
+# ============================================
+
+# Cada cuánto el worker revisa la bitácora de eventos y cuánto se conserva
+EVENTOS_CHAT_INTERVALO = float(os.environ.get('EVENTOS_CHAT_INTERVALO', '1'))
+EVENTOS_CHAT_RETENCION_MIN = int(os.environ.get('EVENTOS_CHAT_RETENCION_MIN', '60'))
+# Segundos sin eventos tras los cuales se envía un comentario para mantener viva la conexión
+EVENTOS_CHAT_KEEPALIVE = 15
+# Cada conexión SSE ocupa un hilo del worker mientras está abierta: con los workers sync de
+# gunicorn unas pocas pestañas bloquean el sitio, por eso gunicorn.conf.py usa gthread
+
+class HubEventos:
+    """Distribuye en memoria los eventos del proceso a cada conexión suscrita"""
+
+    def __init__(self):
+        self._suscriptores = set()
+        self._lock = threading.Lock()
+
+    def suscribir(self):
+        cola = queue.Queue(maxsize=256)
+        with self._lock:
+            self._suscriptores.add(cola)
+        return cola
+
+    def desuscribir(self, cola):
+        with self._lock:
+            self._suscriptores.discard(cola)
+
+    def hay_suscriptores(self):
+        return bool(self._suscriptores)
+
+    def publicar(self, evento):
+        with self._lock:
+            suscriptores = list(self._suscriptores)
+        for cola in suscriptores:
+            try:
+                cola.put_nowait(evento)
+            except queue.Full:
+                # Un cliente lento pierde eventos; al reconectar se pone al día con Last-Event-ID
+                pass
+
+hub_eventos = HubEventos()
+_hilo_eventos = None
+_hilo_eventos_lock = threading.Lock()
+
+def registrar_evento_chat(cursor, tipo, conversacion_id, usuario_id, admin_id, mensaje_id, mensaje):
+    """Anota un evento en la bitácora dentro de la transacción de la escritura que lo origina"""
+    datos = {
+        'conversacion_id': conversacion_id,
+        'mensaje_id': mensaje_id,
+        'mensaje': mensaje,
+        'remitente_id': session['usuario_id'],
+        'remitente_nombre': f"{session.get('nombre', '')} {session.get('apellido', '')}".strip(),
+        'remitente_tipo': session.get('tipo_usuario'),
+    }
+    cursor.execute('''
+        INSERT INTO eventos_chat (tipo, conversacion_id, usuario_id, admin_id, remitente_id, datos)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (tipo, conversacion_id, usuario_id, admin_id, session['usuario_id'],
+          json.dumps(datos, ensure_ascii=False)))
+
+def _leer_eventos(conn, despues_de, limite=500):
+    filas = conn.execute('''
+        SELECT id, tipo, usuario_id, admin_id, remitente_id, datos
+        FROM eventos_chat
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    ''', (despues_de, limite)).fetchall()
+    return [{
+        'id': f[0],
+        'tipo': f[1],
+        'usuario_id': f[2],
+        'admin_id': f[3],
+        'remitente_id': f[4],
+        'datos': f[5],
+    } for f in filas]
+
+def _ciclo_eventos_chat():
+    with app.app_context():
+        ultimo_id = get_db().execute('SELECT COALESCE(MAX(id), 0) FROM eventos_chat').fetchone()[0]
+    ultima_limpieza = time.monotonic()
+    
+    while True:
+        time.sleep(EVENTOS_CHAT_INTERVALO)
+        try:
+            with app.app_context():
+                conn = get_db()
+                if hub_eventos.hay_suscriptores():
+                    for evento in _leer_eventos(conn, ultimo_id):
+                        ultimo_id = evento['id']
+                        hub_eventos.publicar(evento)
+                else:
+                    # Sin nadie escuchando solo se avanza la marca: lo ocurrido mientras tanto no se
+                    # difunde como nuevo, y quien reconecta lo recupera con Last-Event-ID
+                    ultimo_id = conn.execute(
+                        'SELECT COALESCE(MAX(id), ?) FROM eventos_chat', (ultimo_id,)
+                    ).fetchone()[0]
+                
+                if time.monotonic() - ultima_limpieza > 60:
+                    ultima_limpieza = time.monotonic()
+                    conn.execute(
+                        "DELETE FROM eventos_chat WHERE fecha_evento < datetime('now', ?)",
+                        (f'-{EVENTOS_CHAT_RETENCION_MIN} minutes',)
+                    )
+                    conn.commit()
+        except Exception as e:
+            print(f"Error leyendo eventos de chat: {e}")
+
+def iniciar_eventos_chat():
+    """Arranca (una vez por proceso) el hilo que sigue la bitácora de eventos"""
+    global _hilo_eventos
+    with _hilo_eventos_lock:
+        if _hilo_eventos is None:
+            _hilo_eventos = threading.Thread(target=_ciclo_eventos_chat, name='eventos-chat', daemon=True)
+            _hilo_eventos.start()
+
+def _mensajes_no_leidos(usuario_id):
+    with conexion_actual() as conn:
+        return conn.execute('''
+            SELECT COALESCE(SUM(mensajes_no_leidos), 0)
+            FROM participantes_conversacion
+            WHERE usuario_id = ?
+        ''', (usuario_id,)).fetchone()[0]
+
+def _formatear_sse(tipo, datos, evento_id=None):
+    lineas = []
+    if evento_id is not None:
+        lineas.append(f'id: {evento_id}')
+    lineas.append(f'event: {tipo}')
+    lineas.append(f'data: {datos}')
+    return '\n'.join(lineas) + '\n\n'
+
+@app.route('/api/eventos-chat', methods=['GET'])
+def api_eventos_chat():
+    """Canal SSE con mensajes nuevos y contador de no leídos del usuario"""
+    if 'usuario_id' not in session:
+        return jsonify({'success': False, 'message': 'No autorizado'}), 401
+    
+    usuario_id = session['usuario_id']
+    es_admin = session.get('tipo_usuario') == 'administrador'
+    ultimo_id = request.headers.get('Last-Event-ID', type=int)
+    iniciar_eventos_chat()
+    
+    def es_visible(evento):
+        # En una conexión larga el rol se revalida contra la caché para que una revocación se note
+        if es_admin and usuario_id in cache_roles.ids_administradores():
+            return True
+        return usuario_id in (evento['usuario_id'], evento['admin_id'])
+    
+    def generar():
+        cola = hub_eventos.suscribir()
+        try:
+            yield 'retry: 5000\n\n'
+            
+            # Reenviar lo que se perdió durante la reconexión
+            if ultimo_id is not None:
+                with app.app_context():
+                    perdidos = _leer_eventos(get_db(), ultimo_id)
+                for evento in perdidos:
+                    if es_visible(evento):
+                        yield _formatear_sse(evento['tipo'], evento['datos'], evento['id'])
+            
+            yield _formatear_sse('no_leidos', json.dumps({'mensajes_no_leidos': _mensajes_no_leidos(usuario_id)}))
+            
+            while True:
+                try:
+                    evento = cola.get(timeout=EVENTOS_CHAT_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                
+                if not es_visible(evento):
+                    continue
+                yield _formatear_sse(evento['tipo'], evento['datos'], evento['id'])
+                if evento['remitente_id'] != usuario_id:
+                    yield _formatear_sse('no_leidos', json.dumps({'mensajes_no_leidos': _mensajes_no_leidos(usuario_id)}))
+        finally:
+            hub_eventos.desuscribir(cola)
+    
+    return Response(generar(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/api/iniciar-conversacion', methods=['POST'])
 def api_iniciar_conversacion():
@@ -1679,21 +4229,11 @@ def api_iniciar_conversacion():
             }), 400
         
         # Detectar tipo y prioridad automáticamente
-        mensaje_lower = data['mensaje'].lower()
-        tipo = 'consulta'
-        prioridad = 'media'
-        
-        if any(palabra in mensaje_lower for palabra in ['queja', 'reclamo', 'problema', 'mal', 'pésimo']):
-            tipo = 'queja'
-            prioridad = 'alta'
-        elif any(palabra in mensaje_lower for palabra in ['sugerencia', 'mejorar', 'propuesta']):
-            tipo = 'sugerencia'
-            prioridad = 'baja'
-        elif any(palabra in mensaje_lower for palabra in ['urgente', 'emergencia', 'ayuda']):
-            prioridad = 'urgente'
-        
-        conn = sqlite3.connect(DATABASE)
+        tipo, prioridad = clasificador_mensajes.clasificar(data['mensaje'])
+        
+        conn = get_db()
         cursor = conn.cursor()
+        comenzar_escritura(conn)
         
         # Crear la conversación
         cursor.execute('''
@@ -1709,6 +4249,11 @@ def api_iniciar_conversacion():
             VALUES (?, ?, ?)
         ''', (conversacion_id, session['usuario_id'], data['mensaje']))
         
+        registrar_evento_chat(
+            cursor, 'conversacion', conversacion_id, session['usuario_id'], None,
+            cursor.lastrowid, data['mensaje']
+        )
+        
         # Agregar usuario como participante
         cursor.execute('''
             INSERT INTO participantes_conversacion (conversacion_id, usuario_id, ultima_lectura)
@@ -1716,18 +4261,13 @@ def api_iniciar_conversacion():
         ''', (conversacion_id, session['usuario_id']))
         
         # Notificar a todos los administradores
-        cursor.execute('SELECT id FROM usuarios WHERE tipo_usuario = "administrador"')
-        admins = cursor.fetchall()
-        
-        for admin in admins:
-            cursor.execute('''
-                INSERT OR IGNORE INTO participantes_conversacion 
-                (conversacion_id, usuario_id, mensajes_no_leidos)
-                VALUES (?, ?, 1)
-            ''', (conversacion_id, admin[0]))
+        cursor.execute('''
+            INSERT OR IGNORE INTO participantes_conversacion 
+            (conversacion_id, usuario_id, mensajes_no_leidos)
+            SELECT ?, id, 1 FROM usuarios WHERE tipo_usuario = 'administrador'
+        ''', (conversacion_id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -1757,7 +4297,7 @@ def api_enviar_mensaje_conversacion():
                 'message': 'Conversación ID y mensaje son obligatorios'
             }), 400
         
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         # Verificar que el usuario sea parte de la conversación
@@ -1770,7 +4310,6 @@ def api_enviar_mensaje_conversacion():
         conv = cursor.fetchone()
         
         if not conv:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'Conversación no encontrada'
@@ -1782,12 +4321,13 @@ def api_enviar_mensaje_conversacion():
         es_admin_asignado = conv[1] == session['usuario_id']
         
         if not (es_admin or es_usuario_original or es_admin_asignado):
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'No tienes permiso para enviar mensajes en esta conversación'
             }), 403
         
+        comenzar_escritura(conn)
+        
         # Si la conversación está cerrada, reabrirla
         if conv[2] == 'cerrada':
             cursor.execute('''
@@ -1802,6 +4342,12 @@ def api_enviar_mensaje_conversacion():
             VALUES (?, ?, ?)
         ''', (data['conversacion_id'], session['usuario_id'], data['mensaje']))
         
+        registrar_evento_chat(
+            cursor, 'mensaje', data['conversacion_id'], conv[0],
+            conv[1] or (session['usuario_id'] if es_admin else None),
+            cursor.lastrowid, data['mensaje']
+        )
+        
         # Actualizar fecha de última actividad
         cursor.execute('''
             UPDATE conversaciones
@@ -1832,7 +4378,6 @@ def api_enviar_mensaje_conversacion():
         ''', (data['conversacion_id'], session['usuario_id']))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -1847,6 +4392,40 @@ def api_enviar_mensaje_conversacion():
         }), 500
 
 
+def obtener_conversaciones_usuario(usuario_id, es_admin, filtros=([], []), pagina=None):
+    """Conversaciones visibles para el usuario con el nombre del otro participante"""
+    conn = get_db()
+    cursor = conn.cursor()
+    condiciones, parametros = list(filtros[0]), list(filtros[1])
+    
+    if es_admin:
+        # Admins ven todas las conversaciones; el otro participante es el usuario
+        origen = '''conversaciones c
+                    JOIN usuarios o ON c.usuario_id = o.id
+                    LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?'''
+        parametros = [usuario_id] + parametros
+    else:
+        # Usuarios ven solo sus conversaciones; el otro participante es el admin
+        origen = '''conversaciones c
+                    LEFT JOIN usuarios o ON c.admin_id = o.id
+                    LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?'''
+        condiciones = ['c.usuario_id = ?'] + condiciones
+        parametros = [usuario_id, usuario_id] + parametros
+    
+    return consultar_listado(
+        cursor,
+        '''c.id, c.asunto, c.tipo, c.estado, c.prioridad,
+           c.fecha_creacion, c.fecha_ultima_actividad,
+           CASE WHEN o.nombre <> '' THEN o.nombre || ' ' || o.apellido ELSE 'Sin asignar' END,
+           COALESCE(p.mensajes_no_leidos, 0),
+           c.total_mensajes, c.ultimo_mensaje_id, c.ultimo_mensaje''',
+        origen,
+        (condiciones, parametros),
+        [('c.fecha_ultima_actividad', True), ('c.id', True)],
+        pagina,
+        Conversacion
+    )
+
 @app.route('/api/mis-conversaciones', methods=['GET'])
 def api_mis_conversaciones():
     """Obtiene todas las conversaciones del usuario"""
@@ -1854,68 +4433,55 @@ def api_mis_conversaciones():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        es_admin = session.get('tipo_usuario') == 'administrador'
-        
-        if es_admin:
-            # Admins ven todas las conversaciones
-            cursor.execute('''
-                SELECT c.id, c.asunto, c.tipo, c.estado, c.prioridad,
-                       c.fecha_creacion, c.fecha_ultima_actividad,
-                       u.nombre, u.apellido,
-                       p.mensajes_no_leidos,
-                       (SELECT COUNT(*) FROM mensajes_conversacion WHERE conversacion_id = c.id) as total_mensajes
-                FROM conversaciones c
-                JOIN usuarios u ON c.usuario_id = u.id
-                LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?
-                ORDER BY c.fecha_ultima_actividad DESC
-            ''', (session['usuario_id'],))
-        else:
-            # Usuarios ven solo sus conversaciones
-            cursor.execute('''
-                SELECT c.id, c.asunto, c.tipo, c.estado, c.prioridad,
-                       c.fecha_creacion, c.fecha_ultima_actividad,
-                       a.nombre, a.apellido,
-                       p.mensajes_no_leidos,
-                       (SELECT COUNT(*) FROM mensajes_conversacion WHERE conversacion_id = c.id) as total_mensajes
-                FROM conversaciones c
-                LEFT JOIN usuarios a ON c.admin_id = a.id
-                LEFT JOIN participantes_conversacion p ON c.id = p.conversacion_id AND p.usuario_id = ?
-                WHERE c.usuario_id = ?
-                ORDER BY c.fecha_ultima_actividad DESC
-            ''', (session['usuario_id'], session['usuario_id']))
-        
-        conversaciones = cursor.fetchall()
-        conn.close()
-        
-        conversaciones_list = []
-        for c in conversaciones:
-            conversaciones_list.append({
-                'id': c[0],
-                'asunto': c[1],
-                'tipo': c[2],
-                'estado': c[3],
-                'prioridad': c[4],
-                'fecha_creacion': c[5],
-                'fecha_ultima_actividad': c[6],
-                'otro_participante': f"{c[7]} {c[8]}" if c[7] else 'Sin asignar',
-                'mensajes_no_leidos': c[9] or 0,
-                'total_mensajes': c[10]
-            })
+        conversaciones, siguiente_cursor = obtener_conversaciones_usuario(
+            session['usuario_id'],
+            session.get('tipo_usuario') == 'administrador',
+            leer_filtros(
+                {'estado': 'c.estado', 'prioridad': 'c.prioridad', 'tipo': 'c.tipo'},
+                'c.fecha_ultima_actividad'
+            ),
+            leer_pagina()
+        )
         
         return jsonify({
             'success': True,
-            'conversaciones': conversaciones_list
+            'conversaciones': filas_como_dicts(Conversacion._fields, conversaciones),
+            'siguiente_cursor': siguiente_cursor
         })
         
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         print(f"Error obteniendo conversaciones: {e}")
         return jsonify({
             'success': False,
             'message': 'Error obteniendo conversaciones'
         }), 500
+def obtener_reservas_usuario(usuario_id, filtros=([], []), pagina=None):
+    """Reservas de un usuario con los datos del viaje"""
+    conn = get_db()
+    cursor = conn.cursor()
+    return consultar_listado(
+        cursor,
+        '''r.id, r.codigo_reserva, r.nombre_pasajero, r.cedula_pasajero,
+           r.telefono_pasajero, r.precio_total, r.estado, r.fecha_reserva,
+           r.fecha_vencimiento, r.notas,
+           h.fecha_salida, h.fecha_llegada,
+           ru.origen, ru.destino,
+           v.tipo_vehiculo, v.placa''',
+        '''reservas r
+           JOIN horarios h ON r.horario_id = h.id
+           JOIN rutas ru ON h.ruta_id = ru.id
+           JOIN vehiculos v ON h.vehiculo_id = v.id''',
+        (['r.usuario_id = ?'] + filtros[0], [usuario_id] + filtros[1]),
+        [('r.fecha_reserva', True), ('r.id', True)],
+        pagina,
+        Reserva
+    )
+
 # Ruta para obtener mis reservas
 @app.route('/api/mis-reservas', methods=['GET'])
 def api_mis_reservas():
@@ -1924,53 +4490,23 @@ def api_mis_reservas():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT r.id, r.codigo_reserva, r.nombre_pasajero, r.cedula_pasajero,
-                   r.telefono_pasajero, r.precio_total, r.estado, r.fecha_reserva,
-                   r.fecha_vencimiento, r.notas,
-                   h.fecha_salida, h.fecha_llegada,
-                   ru.origen, ru.destino,
-                   v.tipo_vehiculo, v.placa
-            FROM reservas r
-            JOIN horarios h ON r.horario_id = h.id
-            JOIN rutas ru ON h.ruta_id = ru.id
-            JOIN vehiculos v ON h.vehiculo_id = v.id
-            WHERE r.usuario_id = ?
-            ORDER BY r.fecha_reserva DESC
-        ''', (session['usuario_id'],))
-        
-        reservas = cursor.fetchall()
-        conn.close()
-        
-        reservas_list = []
-        for r in reservas:
-            reservas_list.append({
-                'id': r[0],
-                'codigo_reserva': r[1],
-                'nombre_pasajero': r[2],
-                'cedula_pasajero': r[3],
-                'telefono_pasajero': r[4],
-                'precio_total': r[5],
-                'estado': r[6],
-                'fecha_reserva': r[7],
-                'fecha_vencimiento': r[8],
-                'notas': r[9],
-                'fecha_salida': r[10],
-                'fecha_llegada': r[11],
-                'origen': r[12],
-                'destino': r[13],
-                'tipo_vehiculo': r[14],
-                'placa': r[15]
-            })
+        reservas, siguiente_cursor = obtener_reservas_usuario(
+            session['usuario_id'],
+            leer_filtros({'estado': 'r.estado'}, 'r.fecha_reserva'),
+            leer_pagina()
+        )
         
         return jsonify({
             'success': True,
-            'reservas': reservas_list
+            'reservas': filas_como_dicts(Reserva._fields, reservas),
+            'siguiente_cursor': siguiente_cursor
         })
         
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': MENSAJE_PARAMETROS_INVALIDOS
+        }), 400
     except Exception as e:
         print(f"Error obteniendo reservas: {e}")
         return jsonify({
@@ -1978,27 +4514,75 @@ def api_mis_reservas():
             'message': 'Error obteniendo reservas'
         }), 500
 
+# Tamaño de página por defecto y máximo para los mensajes de una conversación
+MENSAJES_POR_PAGINA = 50
+MAX_MENSAJES_POR_PAGINA = 200
+
+def obtener_participantes_conversacion(conversacion_id):
+    """(usuario_id, admin_id) de una conversación, o None si no existe"""
+    conn = get_db()
+    return conn.execute(
+        'SELECT usuario_id, admin_id FROM conversaciones WHERE id = ?', (conversacion_id,)
+    ).fetchone()
+
+def obtener_mensajes_conversacion(conversacion_id, after_id=None, before_id=None, limite=None):
+    """Mensajes de una conversación en orden cronológico; devuelve (mensajes, hay_mas)"""
+    conn = get_db()
+    consulta = '''
+        SELECT m.id, m.mensaje, m.fecha_mensaje, m.leido,
+               u.nombre || ' ' || u.apellido, u.tipo_usuario,
+               m.remitente_id
+        FROM mensajes_conversacion m
+        JOIN usuarios u ON m.remitente_id = u.id
+        WHERE m.conversacion_id = ?
+    '''
+    parametros = [conversacion_id]
+    
+    if before_id is not None:
+        consulta += ' AND m.id < ? ORDER BY m.id DESC LIMIT ?'
+        parametros += [before_id, limite + 1]
+    elif after_id is not None:
+        consulta += ' AND m.id > ? ORDER BY m.id ASC LIMIT ?'
+        parametros += [after_id, limite + 1]
+    elif limite is not None:
+        consulta += ' ORDER BY m.id DESC LIMIT ?'
+        parametros += [limite + 1]
+    else:
+        consulta += ' ORDER BY m.id ASC'
+    
+    mensajes = [Mensaje._make(fila) for fila in conn.execute(consulta, parametros)]
+    
+    hay_mas = limite is not None and len(mensajes) > limite
+    if hay_mas:
+        mensajes = mensajes[:limite]
+    if before_id is not None or (after_id is None and limite is not None):
+        mensajes.reverse()
+    return mensajes, hay_mas
+
 @app.route('/api/mensajes-conversacion/<int:conversacion_id>', methods=['GET'])
 def api_mensajes_conversacion(conversacion_id):
-    """Obtiene todos los mensajes de una conversación"""
+    """Obtiene los mensajes de una conversación, completos o por cursor"""
     if 'usuario_id' not in session:
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        # ?after_id=N trae solo lo nuevo, ?before_id=N pagina hacia atrás en el historial
+        # y ?limit=N sin cursor trae los N más recientes. Sin parámetros se trae el hilo completo.
+        after_id = request.args.get('after_id', type=int)
+        before_id = request.args.get('before_id', type=int)
+        limite = request.args.get('limit', type=int)
+        if limite is None and (after_id is not None or before_id is not None):
+            limite = MENSAJES_POR_PAGINA
+        if limite is not None:
+            limite = max(1, min(limite, MAX_MENSAJES_POR_PAGINA))
+        
+        conn = get_db()
         cursor = conn.cursor()
         
         # Verificar permisos
-        cursor.execute('''
-            SELECT usuario_id, admin_id
-            FROM conversaciones
-            WHERE id = ?
-        ''', (conversacion_id,))
-        
-        conv = cursor.fetchone()
+        conv = obtener_participantes_conversacion(conversacion_id)
         
         if not conv:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'Conversación no encontrada'
@@ -2010,57 +4594,65 @@ def api_mensajes_conversacion(conversacion_id):
                         es_admin)
         
         if not tiene_permiso:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'No tienes permiso para ver esta conversación'
             }), 403
         
-        # Obtener mensajes
-        cursor.execute('''
-            SELECT m.id, m.mensaje, m.fecha_mensaje, m.leido,
-                   u.nombre, u.apellido, u.tipo_usuario,
-                   m.remitente_id
-            FROM mensajes_conversacion m
-            JOIN usuarios u ON m.remitente_id = u.id
-            WHERE m.conversacion_id = ?
-            ORDER BY m.fecha_mensaje ASC
-        ''', (conversacion_id,))
-        
-        mensajes = cursor.fetchall()
-        
-        # Marcar mensajes como leídos
-        cursor.execute('''
-            UPDATE mensajes_conversacion
-            SET leido = TRUE
-            WHERE conversacion_id = ? AND remitente_id != ?
-        ''', (conversacion_id, session['usuario_id']))
-        
-        # Actualizar contador de no leídos
-        cursor.execute('''
-            UPDATE participantes_conversacion
-            SET mensajes_no_leidos = 0, ultima_lectura = CURRENT_TIMESTAMP
-            WHERE conversacion_id = ? AND usuario_id = ?
-        ''', (conversacion_id, session['usuario_id']))
+        mensajes, hay_mas = obtener_mensajes_conversacion(conversacion_id, after_id, before_id, limite)
         
-        conn.commit()
-        conn.close()
+        # Marcar como leído solo al ver el final del hilo y si de verdad hay algo pendiente
+        viendo_final = before_id is None and not (after_id is not None and hay_mas)
+        if viendo_final:
+            cursor.execute('''
+                SELECT EXISTS (
+                           SELECT 1 FROM mensajes_conversacion
+                           WHERE conversacion_id = ? AND leido = 0 AND remitente_id != ?
+                       ),
+                       COALESCE((
+                           SELECT mensajes_no_leidos FROM participantes_conversacion
+                           WHERE conversacion_id = ? AND usuario_id = ?
+                       ), 0)
+            ''', (conversacion_id, session['usuario_id'], conversacion_id, session['usuario_id']))
+            hay_sin_leer, contador = cursor.fetchone()
+            
+            if hay_sin_leer or contador:
+                comenzar_escritura(conn)
+                
+                # Marcar mensajes como leídos
+                cursor.execute('''
+                    UPDATE mensajes_conversacion
+                    SET leido = TRUE
+                    WHERE conversacion_id = ? AND leido = 0 AND remitente_id != ?
+                ''', (conversacion_id, session['usuario_id']))
+                
+                # Actualizar contador de no leídos
+                cursor.execute('''
+                    UPDATE participantes_conversacion
+                    SET mensajes_no_leidos = 0, ultima_lectura = CURRENT_TIMESTAMP
+                    WHERE conversacion_id = ? AND usuario_id = ?
+                ''', (conversacion_id, session['usuario_id']))
+                
+                conn.commit()
         
         mensajes_list = []
         for m in mensajes:
             mensajes_list.append({
-                'id': m[0],
-                'mensaje': m[1],
-                'fecha_mensaje': m[2],
-                'leido': m[3],
-                'remitente_nombre': f"{m[4]} {m[5]}",
-                'remitente_tipo': m[6],
-                'es_mio': m[7] == session['usuario_id']
+                'id': m.id,
+                'mensaje': m.mensaje,
+                'fecha_mensaje': m.fecha_mensaje,
+                'leido': m.leido,
+                'remitente_nombre': m.remitente_nombre,
+                'remitente_tipo': m.remitente_tipo,
+                'es_mio': m.remitente_id == session['usuario_id']
             })
         
         return jsonify({
             'success': True,
-            'mensajes': mensajes_list
+            'mensajes': mensajes_list,
+            'primer_id': mensajes_list[0]['id'] if mensajes_list else before_id,
+            'ultimo_id': mensajes_list[-1]['id'] if mensajes_list else after_id,
+            'hay_mas': hay_mas
         })
         
     except Exception as e:
@@ -2078,7 +4670,7 @@ def api_notificaciones_chat():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
+        conn = get_db()
         cursor = conn.cursor()
         
         cursor.execute('''
@@ -2088,7 +4680,6 @@ def api_notificaciones_chat():
         ''', (session['usuario_id'],))
         
         total_no_leidos = cursor.fetchone()[0]
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -2105,93 +4696,509 @@ def api_notificaciones_chat():
 
 
 
-# Agregar esta función al archivo auth_server.py y llamarla después de init_db()
+# ============================================
+# GENERACIÓN DE HORARIOS
+# ============================================
+
+# Salidas que recibe una ruta activa que todavía no tiene plantilla en frecuencias_rutas
+HORAS_SALIDA_DEFECTO = ['06:00', '09:00', '14:00', '18:00']
+# Días que se generan por transacción al extender el horizonte
+HORARIOS_LOTE_DIAS = int(os.environ.get('HORARIOS_LOTE_DIAS', '31'))
+# Días pendientes a partir de los cuales la extensión es una carga masiva: una sola transacción
+# sin índices secundarios ni trigger de versión, que se recrean al final
+HORARIOS_MASIVO_DIAS = int(os.environ.get('HORARIOS_MASIVO_DIAS', '90'))
 
-def insertar_horarios_prueba():
-    """Inserta horarios de prueba para las próximas semanas"""
-    conn = sqlite3.connect(DATABASE)
-    cursor = conn.cursor()
+# Capacidad mínima con que se siembran las frecuencias de cada tipo de ruta. Sin ella el
+# planificador toma siempre el vehículo libre más pequeño, aunque sea una moto en un trayecto
+# intermunicipal. Para ajustar una ruta: flask capacidad-minima --ruta ID --capacidad N
+CAPACIDAD_MINIMA_TIPO_RUTA = {'urbana': 1, 'intermunicipal': 4, 'rural': 4}
+
+# Minutos que un vehículo queda fuera de servicio entre la llegada y su siguiente salida
+VEHICULOS_VUELTA_MINUTOS = int(os.environ.get('VEHICULOS_VUELTA_MINUTOS', '30'))
+
+# Cruza cada día del tramo con las frecuencias que aplican ese día de la semana (strftime %w);
+# solo genera días posteriores al horizonte de la ruta. Las plantillas y el calendario se
+# materializan para calcular una sola vez lo que no depende del par. Sale ordenado por hora de
+# salida porque así lo recorre el planificador de vehículos.
+SQL_SALIDAS_PENDIENTES = '''
+    WITH RECURSIVE dias (dia) AS (
+        SELECT date(?)
+        UNION ALL
+        SELECT date(dia, '+1 day') FROM dias WHERE dia < date(?)
+    ),
+    calendario AS MATERIALIZED (
+        SELECT dia, strftime('%w', dia) AS dia_semana FROM dias
+    ),
+    plantillas AS MATERIALIZED (
+        SELECT f.ruta_id, f.dias_semana, f.capacidad_minima, ' ' || f.hora_salida || ':00' AS hora,
+               printf('+%d minutes', CAST(round(r.duracion_horas * 60) AS INTEGER)) AS duracion,
+               printf('+%d minutes', CAST(round(r.duracion_horas * 60) AS INTEGER) + ?) AS ocupacion,
+               r.precio_base, COALESCE(hz.hasta, '') AS hasta
+        FROM frecuencias_rutas f
+        JOIN rutas r ON r.id = f.ruta_id AND r.activa = 1
+        LEFT JOIN horizonte_horarios hz ON hz.ruta_id = f.ruta_id
+        WHERE f.activa = 1
+    )
+    SELECT p.ruta_id, d.dia || p.hora, datetime(d.dia || p.hora, p.duracion),
+           datetime(d.dia || p.hora, p.ocupacion), p.precio_base, p.capacidad_minima
+    FROM plantillas p
+    JOIN calendario d ON d.dia > p.hasta AND instr(p.dias_semana, d.dia_semana) > 0
+    ORDER BY 2
+'''
+
+# Salidas que quedaron sin vehículo en una extensión anterior y todavía no han pasado, con los
+# mismos campos que SQL_SALIDAS_PENDIENTES. Las de rutas o frecuencias desactivadas no salen.
+SQL_SALIDAS_SIN_VEHICULO = '''
+    SELECT s.ruta_id, s.fecha_salida,
+           datetime(s.fecha_salida, printf('+%d minutes', CAST(round(r.duracion_horas * 60) AS INTEGER))),
+           datetime(s.fecha_salida, printf('+%d minutes', CAST(round(r.duracion_horas * 60) AS INTEGER) + ?)),
+           r.precio_base, f.capacidad_minima
+    FROM salidas_sin_vehiculo s
+    JOIN rutas r ON r.id = s.ruta_id AND r.activa = 1
+    JOIN frecuencias_rutas f ON f.ruta_id = s.ruta_id AND f.activa = 1
+        AND f.hora_salida = strftime('%H:%M', s.fecha_salida)
+    WHERE s.fecha_salida > ?
+    ORDER BY s.fecha_salida
+'''
+
+class PlanificadorVehiculos:
+    """Asigna vehículos a salidas con un barrido en orden de hora de salida
+
+    Los vehículos ocupados esperan en un heap por la hora en que vuelven a estar libres
+    (llegada + vuelta); los libres se agrupan por capacidad y se elige el más pequeño que
+    cumpla la capacidad mínima. Los viajes ya guardados en la base se respetan como
+    intervalos fijos por vehículo. Las horas se comparan como texto 'AAAA-MM-DD HH:MM:SS'.
+    """
+
+    def __init__(self, vehiculos):
+        self.capacidades = sorted({capacidad for _, capacidad in vehiculos})
+        self.libres = {capacidad: [] for capacidad in self.capacidades}
+        for vehiculo_id, capacidad in sorted(vehiculos, reverse=True):
+            self.libres[capacidad].append(vehiculo_id)
+        self.capacidad = dict(vehiculos)
+        self.ocupados = []
+        self.fijos = {}
+
+    def cargar_viajes(self, viajes):
+        """Registra viajes existentes (vehiculo_id, salida, libre_desde) que no se pueden pisar"""
+        por_vehiculo = {}
+        for vehiculo_id, salida, libre_desde in viajes:
+            if vehiculo_id in self.capacidad:
+                por_vehiculo.setdefault(vehiculo_id, []).append((salida, libre_desde))
+        for vehiculo_id, intervalos in por_vehiculo.items():
+            intervalos.sort()
+            # Máximo acumulado de libre_desde: basta mirarlo para saber si algo anterior se solapa
+            maximos = list(itertools.accumulate((fin for _, fin in intervalos), max))
+            self.fijos[vehiculo_id] = ([inicio for inicio, _ in intervalos], maximos)
+
+    def _choca_con_fijos(self, vehiculo_id, salida, libre_desde):
+        fijos = self.fijos.get(vehiculo_id)
+        if fijos is None:
+            return False
+        inicios, maximos = fijos
+        posicion = bisect.bisect_left(inicios, libre_desde)
+        return posicion > 0 and maximos[posicion - 1] > salida
+
+    def asignar(self, salida, libre_desde, capacidad_minima=1):
+        """Devuelve (vehiculo_id, capacidad) para la salida, o None si no hay vehículo disponible"""
+        ocupados = self.ocupados
+        while ocupados and ocupados[0][0] <= salida:
+            _, vehiculo_id = heapq.heappop(ocupados)
+            self.libres[self.capacidad[vehiculo_id]].append(vehiculo_id)
+        
+        for capacidad in self.capacidades[bisect.bisect_left(self.capacidades, capacidad_minima):]:
+            pila = self.libres[capacidad]
+            for posicion in range(len(pila) - 1, -1, -1):
+                vehiculo_id = pila[posicion]
+                if not self._choca_con_fijos(vehiculo_id, salida, libre_desde):
+                    del pila[posicion]
+                    heapq.heappush(ocupados, (libre_desde, vehiculo_id))
+                    return vehiculo_id, capacidad
+        return None
+
+def viajes_programados(conn, desde, hasta):
+    """Viajes guardados de vehículos activos que salen en [desde, hasta), con su fin de ocupación"""
+    return conn.execute('''
+        SELECT h.vehiculo_id, h.fecha_salida,
+               datetime(COALESCE(h.fecha_llegada, h.fecha_salida), ?)
+        FROM vehiculos v
+        JOIN horarios h ON h.vehiculo_id = v.id
+        WHERE v.activo = 1
+        AND h.fecha_salida >= ? AND h.fecha_salida < ?
+        AND h.estado IN ('programado', 'en_curso')
+    ''', (f'+{VEHICULOS_VUELTA_MINUTOS} minutes', desde, hasta)).fetchall()
+
+def detectar_conflictos_vehiculos(conn, desde=None, hasta=None):
+    """Pares de horarios vigentes del mismo vehículo que se solapan contando el tiempo de vuelta"""
+    # fecha_salida tiene afinidad NUMERIC: un centinela como '9999' se compararía como entero
+    # y quedaría por debajo de toda fecha en texto, así que los límites solo se agregan si existen
+    filtros, parametros = [], [f'+{VEHICULOS_VUELTA_MINUTOS} minutes']
+    if desde:
+        filtros.append('AND a.fecha_salida >= ?')
+        parametros.append(desde)
+    if hasta:
+        filtros.append('AND a.fecha_salida < ?')
+        parametros.append(hasta)
     
+    return conn.execute(f'''
+        SELECT a.vehiculo_id, v.placa,
+               a.id, a.fecha_salida, a.fecha_llegada,
+               b.id, b.fecha_salida, b.fecha_llegada
+        FROM horarios a
+        JOIN vehiculos v ON v.id = a.vehiculo_id
+        JOIN horarios b ON b.vehiculo_id = a.vehiculo_id
+            AND b.fecha_salida >= a.fecha_salida
+            AND b.fecha_salida < datetime(COALESCE(a.fecha_llegada, a.fecha_salida), ?)
+            AND (b.fecha_salida > a.fecha_salida OR b.id > a.id)
+        WHERE a.estado IN ('programado', 'en_curso')
+        AND b.estado IN ('programado', 'en_curso')
+        {' '.join(filtros)}
+        ORDER BY a.fecha_salida, a.vehiculo_id
+    ''', parametros).fetchall()
+
+def _capacidad_tipo_ruta(columna):
+    """Expresión SQL con la capacidad mínima de CAPACIDAD_MINIMA_TIPO_RUTA para la columna dada"""
+    casos = ' '.join('WHEN ? THEN ?' for _ in CAPACIDAD_MINIMA_TIPO_RUTA)
+    parametros = [valor for par in CAPACIDAD_MINIMA_TIPO_RUTA.items() for valor in par]
+    return f'CASE {columna} {casos} ELSE 1 END', parametros
+
+def completar_frecuencias_defecto(conn, con_capacidad=True):
+    """Da las salidas por defecto a las rutas activas que no tienen ninguna frecuencia"""
+    horas = ' UNION ALL '.join('SELECT ? AS hora' for _ in HORAS_SALIDA_DEFECTO)
+    columnas, valores, parametros = 'ruta_id, hora_salida', 'r.id, h.hora', []
+    if con_capacidad:
+        capacidad, parametros = _capacidad_tipo_ruta('r.tipo_ruta')
+        columnas, valores = f'{columnas}, capacidad_minima', f'{valores}, {capacidad}'
+    conn.execute(f'''
+        INSERT INTO frecuencias_rutas ({columnas})
+        SELECT {valores}
+        FROM rutas r, ({horas}) AS h
+        WHERE r.activa = 1
+        AND NOT EXISTS (SELECT 1 FROM frecuencias_rutas f WHERE f.ruta_id = r.id)
+    ''', parametros + HORAS_SALIDA_DEFECTO)
+
+def reintentar_salidas_sin_vehiculo(conn, vehiculos):
+    """Asigna vehículo a las salidas anotadas como pendientes; devuelve (insertados, pendientes)
+
+    El horizonte ya pasó por esas fechas, así que solo se reintentan desde esta tabla. Las que
+    ya salieron o cuya frecuencia dejó de existir se descartan.
+    """
+    ahora = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    comenzar_escritura(conn)
     try:
-        # Verificar si ya existen horarios
-        cursor.execute('SELECT COUNT(*) FROM horarios')
-        if cursor.fetchone()[0] > 0:
-            conn.close()
-            return  # Ya hay horarios, no insertar más
-        
-        from datetime import datetime, timedelta
-        
-        # Obtener IDs de rutas y vehículos
-        cursor.execute('SELECT id FROM rutas WHERE activa = 1')
-        rutas = [r[0] for r in cursor.fetchall()]
-        
-        cursor.execute('SELECT id, capacidad_pasajeros FROM vehiculos WHERE activo = 1')
-        vehiculos = cursor.fetchall()
-        
-        if not rutas or not vehiculos:
-            print("No hay rutas o vehículos disponibles")
-            conn.close()
-            return
-        
-        # Crear horarios para los próximos 30 días
-        fecha_inicio = datetime.now()
-        horarios_prueba = []
-        
-        for dia in range(30):
-            fecha = fecha_inicio + timedelta(days=dia)
-            
-            # Para cada ruta
-            for ruta_id in rutas:
-                # Obtener duración de la ruta
-                cursor.execute('SELECT duracion_horas, precio_base FROM rutas WHERE id = ?', (ruta_id,))
-                ruta_info = cursor.fetchone()
-                duracion_horas = ruta_info[0]
-                precio_base = ruta_info[1]
-                
-                # Crear varios horarios al día
-                horas_salida = ['06:00', '09:00', '14:00', '18:00']
-                
-                for hora_salida in horas_salida:
-                    # Seleccionar vehículo aleatorio
-                    import random
-                    vehiculo = random.choice(vehiculos)
-                    vehiculo_id = vehiculo[0]
-                    capacidad = vehiculo[1]
-                    
-                    # Calcular fecha/hora de salida y llegada
-                    hora, minuto = map(int, hora_salida.split(':'))
-                    fecha_salida = fecha.replace(hour=hora, minute=minuto, second=0, microsecond=0)
-                    fecha_llegada = fecha_salida + timedelta(hours=duracion_horas)
-                    
-                    horarios_prueba.append((
-                        ruta_id,
-                        vehiculo_id,
-                        fecha_salida.strftime('%Y-%m-%d %H:%M:%S'),
-                        fecha_llegada.strftime('%Y-%m-%d %H:%M:%S'),
-                        precio_base,
-                        capacidad,
-                        'programado'
-                    ))
-        
-        # Insertar todos los horarios
-        cursor.executemany('''
+        salidas = conn.execute(SQL_SALIDAS_SIN_VEHICULO, (VEHICULOS_VUELTA_MINUTOS, ahora)).fetchall()
+        conn.execute('DELETE FROM salidas_sin_vehiculo')
+        if not salidas:
+            conn.commit()
+            return 0, 0
+        
+        planificador = PlanificadorVehiculos(vehiculos)
+        desde = datetime.strptime(salidas[0][1][:10], '%Y-%m-%d').date() - timedelta(days=1)
+        hasta = datetime.strptime(salidas[-1][1][:10], '%Y-%m-%d').date() + timedelta(days=2)
+        planificador.cargar_viajes(viajes_programados(conn, desde.isoformat(), hasta.isoformat()))
+        
+        filas, pendientes = [], []
+        for ruta_id, salida, llegada, libre_desde, precio, capacidad_minima in salidas:
+            asignado = planificador.asignar(salida, libre_desde, capacidad_minima)
+            if asignado is None:
+                pendientes.append((ruta_id, salida))
+            else:
+                filas.append((ruta_id, asignado[0], salida, llegada, precio, asignado[1]))
+        
+        conn.executemany('''
             INSERT INTO horarios (
                 ruta_id, vehiculo_id, fecha_salida, fecha_llegada,
                 precio, asientos_disponibles, estado
-            ) VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', horarios_prueba)
-        
+            ) VALUES (?, ?, ?, ?, ?, ?, 'programado')
+        ''', filas)
+        conn.executemany('INSERT INTO salidas_sin_vehiculo (ruta_id, fecha_salida) VALUES (?, ?)', pendientes)
         conn.commit()
-        print(f"✅ Se insertaron {len(horarios_prueba)} horarios de prueba")
-        
+    except Exception:
+        conn.rollback()
+        raise
+    return len(filas), len(pendientes)
+
+def _suspender_mantenimiento_horarios(conn):
+    """Quita los índices secundarios y el trigger de versión por inserción de horarios
+
+    Devuelve el SQL con que estaban creados para recrearlos en la misma transacción.
+    """
+    objetos = conn.execute('''
+        SELECT type, name, sql FROM sqlite_master
+        WHERE tbl_name = 'horarios' AND sql IS NOT NULL
+        AND (type = 'index' OR name = 'trg_version_horarios_insert')
+    ''').fetchall()
+    for tipo, nombre, _ in objetos:
+        conn.execute(f'DROP {"INDEX" if tipo == "index" else "TRIGGER"} {nombre}')
+    return [sql for _, _, sql in objetos]
+
+def extender_horarios(hasta, lote_dias=HORARIOS_LOTE_DIAS):
+    """Genera los horarios de todas las rutas activas hasta la fecha indicada (inclusive)
+
+    Es idempotente: cada ruta recuerda hasta qué día ya tiene horarios y solo se completa lo
+    que falta. Cada tramo de lote_dias días va en su propia transacción. Devuelve
+    (insertados, sin_vehiculo). Las salidas sin vehículo libre se anotan en
+    salidas_sin_vehiculo y se reintentan al comienzo de cada extensión.
+    
+    Si faltan HORARIOS_MASIVO_DIAS días o más, todo va en una transacción: se quitan los
+    índices secundarios y el trigger de versión, se insertan los tramos, se recrean (ordenar
+    una vez es mucho más barato que mantenerlos fila a fila) y la versión de cada ruta sube
+    una sola vez. Los lectores siguen viendo la foto anterior; los escritores esperan.
+    """
+    conn = get_db()
+    comenzar_escritura(conn)
+    completar_frecuencias_defecto(conn)
+    conn.commit()
+    
+    vehiculos = conn.execute('SELECT id, capacidad_pasajeros FROM vehiculos WHERE activo = 1').fetchall()
+    insertados, sin_vehiculo = reintentar_salidas_sin_vehiculo(conn, vehiculos)
+    dia = datetime.now().date()
+    # Los días que todas las rutas activas ya tienen generados no necesitan recorrerse
+    cubierto = conn.execute('''
+        SELECT MIN(COALESCE(hz.hasta, '')) FROM rutas r
+        LEFT JOIN horizonte_horarios hz ON hz.ruta_id = r.id
+        WHERE r.activa = 1
+    ''').fetchone()[0]
+    if cubierto:
+        dia = max(dia, datetime.strptime(cubierto, '%Y-%m-%d').date() + timedelta(days=1))
+    planificador = PlanificadorVehiculos(vehiculos)
+    masivo = (hasta - dia).days + 1 >= HORARIOS_MASIVO_DIAS
+    recrear, rutas_generadas = [], set()
+    
+    try:
+        if masivo:
+            comenzar_escritura(conn)
+            # Los viajes ya guardados se leen antes de quitar el índice por vehículo
+            planificador.cargar_viajes(viajes_programados(
+                conn, (dia - timedelta(days=1)).isoformat(), (hasta + timedelta(days=1)).isoformat()
+            ))
+            recrear = _suspender_mantenimiento_horarios(conn)
+        
+        while dia <= hasta:
+            fin = min(dia + timedelta(days=lote_dias - 1), hasta)
+            if not masivo:
+                comenzar_escritura(conn)
+                # Un viaje que salió el día anterior puede seguir ocupando el vehículo al empezar el tramo
+                planificador.cargar_viajes(viajes_programados(
+                    conn, (dia - timedelta(days=1)).isoformat(), (fin + timedelta(days=1)).isoformat()
+                ))
+            
+            filas, pendientes = [], []
+            for ruta_id, salida, llegada, libre_desde, precio, capacidad_minima in conn.execute(
+                SQL_SALIDAS_PENDIENTES, (dia.isoformat(), fin.isoformat(), VEHICULOS_VUELTA_MINUTOS)
+            ):
+                asignado = planificador.asignar(salida, libre_desde, capacidad_minima)
+                if asignado is None:
+                    pendientes.append((ruta_id, salida))
+                    continue
+                filas.append((ruta_id, asignado[0], salida, llegada, precio, asignado[1]))
+            
+            if masivo:
+                rutas_generadas.update(fila[0] for fila in filas)
+            else:
+                # Insertar agrupado por ruta mantiene local la escritura en idx_horarios_ruta_salida_estado
+                filas.sort(key=lambda fila: fila[0])
+            conn.executemany('''
+                INSERT INTO horarios (
+                    ruta_id, vehiculo_id, fecha_salida, fecha_llegada,
+                    precio, asientos_disponibles, estado
+                ) VALUES (?, ?, ?, ?, ?, ?, 'programado')
+            ''', filas)
+            insertados += len(filas)
+            # El horizonte avanza igual; lo que no tuvo vehículo queda anotado para reintentarlo
+            conn.executemany('INSERT INTO salidas_sin_vehiculo (ruta_id, fecha_salida) VALUES (?, ?)', pendientes)
+            sin_vehiculo += len(pendientes)
+            conn.execute('''
+                INSERT INTO horizonte_horarios (ruta_id, hasta)
+                SELECT id, ? FROM rutas WHERE activa = 1
+                ON CONFLICT (ruta_id) DO UPDATE SET hasta = max(hasta, excluded.hasta)
+            ''', (fin.isoformat(),))
+            if not masivo:
+                conn.commit()
+            dia = fin + timedelta(days=1)
+        
+        if masivo:
+            for sql in recrear:
+                conn.execute(sql)
+            # Lo que el trigger habría hecho fila a fila: una subida de versión por ruta
+            conn.executemany('''
+                INSERT INTO versiones_datos (clave, version) VALUES (?, 1)
+                ON CONFLICT (clave) DO UPDATE SET version = version + 1
+            ''', [(f'horarios:{ruta_id}',) for ruta_id in sorted(rutas_generadas)])
+            conn.commit()
+    except Exception:
+        # También deshace el DROP de índices y trigger de una carga masiva a medias
+        conn.rollback()
+        raise
+    return insertados, sin_vehiculo
+
+def insertar_horarios_prueba():
+    """Asegura horarios para los próximos 30 días"""
+    try:
+        insertados, sin_vehiculo = extender_horarios(datetime.now().date() + timedelta(days=29))
+        if insertados:
+            print(f"✅ Se insertaron {insertados} horarios de prueba")
+        if sin_vehiculo:
+            print(f"⚠️ {sin_vehiculo} salidas quedaron sin vehículo disponible; se reintentan en la próxima extensión")
     except Exception as e:
         print(f"Error insertando horarios de prueba: {e}")
-        conn.rollback()
-    finally:
-        conn.close()
+        get_db().rollback()
+
+@app.cli.command('extender-horarios')
+@click.option('--dias', default=30, help='Días hacia adelante, contando hoy, que deben tener horarios')
+def comando_extender_horarios(dias):
+    """Completa los horarios de todas las rutas activas hasta el horizonte indicado"""
+    aplicar_migraciones()
+    hasta = datetime.now().date() + timedelta(days=dias - 1)
+    insertados, sin_vehiculo = extender_horarios(hasta)
+    print(f"✓ {insertados} horarios nuevos hasta {hasta.isoformat()}")
+    if sin_vehiculo:
+        print(f"⚠️ {sin_vehiculo} salidas siguen sin vehículo disponible; quedan pendientes para la próxima "
+              f"extensión (agregue vehículos o ajuste las frecuencias)")
+
+@app.cli.command('capacidad-minima')
+@click.option('--ruta', type=int, default=None, help='Ruta a ajustar; sin ella solo se listan las capacidades')
+@click.option('--capacidad', type=int, default=None, help='Pasajeros mínimos del vehículo asignado')
+@click.option('--hora', default=None, help='Solo la frecuencia de esta hora (HH:MM)')
+def comando_capacidad_minima(ruta, capacidad, hora):
+    """Muestra o ajusta la capacidad mínima de vehículo de las frecuencias de una ruta"""
+    aplicar_migraciones()
+    conn = get_db()
+    
+    if capacidad is not None:
+        if ruta is None:
+            print("✗ Indique con --ruta qué ruta ajustar")
+            raise SystemExit(1)
+        if capacidad < 1:
+            print("✗ La capacidad mínima debe ser al menos 1")
+            raise SystemExit(1)
+        comenzar_escritura(conn)
+        cambiadas = conn.execute('''
+            UPDATE frecuencias_rutas SET capacidad_minima = ?
+            WHERE ruta_id = ? AND (? IS NULL OR hora_salida = ?)
+        ''', (capacidad, ruta, hora, hora)).rowcount
+        conn.commit()
+        if not cambiadas:
+            print(f"✗ La ruta {ruta} no tiene frecuencias{f' a las {hora}' if hora else ''}")
+            raise SystemExit(1)
+        # Solo afecta las salidas que se generen de aquí en adelante
+        print(f"✓ {cambiadas} frecuencias de la ruta {ruta} piden al menos {capacidad} pasajeros")
+    
+    for ruta_id, origen, destino, hora_salida, minima in conn.execute('''
+        SELECT r.id, r.origen, r.destino, f.hora_salida, f.capacidad_minima
+        FROM frecuencias_rutas f
+        JOIN rutas r ON r.id = f.ruta_id
+        WHERE ? IS NULL OR r.id = ?
+        ORDER BY r.id, f.hora_salida
+    ''', (ruta, ruta)):
+        print(f"  Ruta {ruta_id} {origen} → {destino} {hora_salida}: {minima} pasajeros")
+
+@app.cli.command('rendimiento-horarios')
+@click.option('--rutas', default=300, help='Rutas sintéticas')
+@click.option('--salidas', default=9, help='Salidas diarias por ruta')
+@click.option('--dias', default=365, help='Días de horizonte')
+@click.option('--vehiculos', default=0, help='Vehículos sintéticos (por defecto cuatro por ruta)')
+def comando_rendimiento_horarios(rutas, salidas, dias, vehiculos):
+    """Mide la generación de un horizonte completo sobre una base temporal"""
+    global DATABASE, _pool
+    
+    with tempfile.TemporaryDirectory() as directorio:
+        DATABASE = os.path.join(directorio, 'horarios.db')
+        _pool = None
+        
+        with app.app_context():
+            aplicar_migraciones()
+            conn = get_db()
+            comenzar_escritura(conn)
+            conn.execute('DELETE FROM horarios')
+            conn.execute('DELETE FROM horizonte_horarios')
+            conn.execute('DELETE FROM frecuencias_rutas')
+            conn.execute('UPDATE rutas SET activa = 0')
+            conn.execute('UPDATE vehiculos SET activo = 0')
+            conn.executemany('''
+                INSERT INTO vehiculos (placa, tipo_vehiculo, capacidad_pasajeros)
+                VALUES (?, 'bus', ?)
+            ''', [(f'SIM{n:05d}', (20, 30, 40)[n % 3]) for n in range(vehiculos or rutas * 4)])
+            conn.executemany('''
+                INSERT INTO rutas (origen, destino, distancia_km, duracion_horas, precio_base, tipo_ruta)
+                VALUES (?, ?, 100, ?, 50000, 'intermunicipal')
+            ''', [(f'Origen {n}', f'Destino {n}', 1 + n % 8) for n in range(rutas)])
+            conn.execute('''
+                WITH RECURSIVE salidas (n) AS (SELECT 0 UNION ALL SELECT n + 1 FROM salidas WHERE n + 1 < ?)
+                INSERT INTO frecuencias_rutas (ruta_id, hora_salida)
+                SELECT r.id, printf('%02d:%02d', 5 + (s.n * 17) / 10, (s.n * 17 % 10) * 6)
+                FROM rutas r, salidas s
+                WHERE r.activa = 1
+            ''', (salidas,))
+            conn.commit()
+            
+            esquema = '''
+                SELECT type, name, sql FROM sqlite_master WHERE tbl_name = 'horarios' ORDER BY name
+            '''
+            objetos = conn.execute(esquema).fetchall()
+            
+            hasta = datetime.now().date() + timedelta(days=dias - 1)
+            inicio = time.perf_counter()
+            insertados, sin_vehiculo = extender_horarios(hasta)
+            duracion = time.perf_counter() - inicio
+            modo = 'carga masiva' if dias >= HORARIOS_MASIVO_DIAS else f'tramos de {HORARIOS_LOTE_DIAS} días'
+            print(f"{insertados} horarios en {duracion:.2f}s ({insertados / duracion:,.0f} filas por segundo, {modo})")
+            restaurado = conn.execute(esquema).fetchall() == objetos
+            versionadas = conn.execute(
+                "SELECT COUNT(*) FROM versiones_datos WHERE clave LIKE 'horarios:%'"
+            ).fetchone()[0]
+            print(f"{sin_vehiculo} salidas sin vehículo disponible")
+            
+            inicio = time.perf_counter()
+            repetidos, _ = extender_horarios(hasta)
+            print(f"Segunda pasada: {repetidos} horarios en {time.perf_counter() - inicio:.2f}s")
+            total = conn.execute('SELECT COUNT(*) FROM horarios').fetchone()[0]
+            
+            inicio = time.perf_counter()
+            conflictos = detectar_conflictos_vehiculos(conn)
+            print(f"Detección de conflictos: {len(conflictos)} en {time.perf_counter() - inicio:.2f}s")
+            
+            # Control del detector: un duplicado del primer viaje, cinco minutos después, debe aparecer
+            comenzar_escritura(conn)
+            conn.execute('''
+                INSERT INTO horarios (ruta_id, vehiculo_id, fecha_salida, fecha_llegada, precio, asientos_disponibles)
+                SELECT ruta_id, vehiculo_id, datetime(fecha_salida, '+5 minutes'),
+                       datetime(fecha_llegada, '+5 minutes'), precio, asientos_disponibles
+                FROM horarios ORDER BY id LIMIT 1
+            ''')
+            control_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            detectados = [c for c in detectar_conflictos_vehiculos(conn) if control_id in (c[2], c[5])]
+            conn.rollback()
+        _pool = None
+    
+    if repetidos or total != insertados:
+        print("✗ La extensión no fue idempotente")
+        raise SystemExit(1)
+    if not restaurado or versionadas < rutas:
+        print("✗ Los índices, el trigger o las versiones de horarios no quedaron como antes")
+        raise SystemExit(1)
+    if conflictos:
+        print("✗ Hay vehículos asignados a viajes que se solapan")
+        raise SystemExit(1)
+    if not detectados:
+        print("✗ El detector no encontró el solapamiento insertado a propósito")
+        raise SystemExit(1)
+    print(f"✓ {total} horarios sin duplicados ni vehículos solapados (el control solapado sí se detecta)")
+
+@app.cli.command('conflictos-vehiculos')
+@click.option('--desde', default=None, help='Fecha inicial (AAAA-MM-DD)')
+@click.option('--hasta', default=None, help='Fecha final exclusiva (AAAA-MM-DD)')
+def comando_conflictos_vehiculos(desde, hasta):
+    """Lista los horarios vigentes que asignan el mismo vehículo a viajes solapados"""
+    conflictos = detectar_conflictos_vehiculos(get_db(), desde, hasta)
+    for vehiculo_id, placa, id_a, salida_a, llegada_a, id_b, salida_b, _ in conflictos:
+        print(f"✗ {placa}: horario {id_a} ({salida_a} → {llegada_a}) choca con {id_b} ({salida_b})")
+    if conflictos:
+        raise SystemExit(1)
+    print("✓ Ningún vehículo tiene viajes solapados")
+
 # ============================================
-# REEMPLAZAR los endpoints al final de auth_server.py
-# (líneas después de api_notificaciones_chat)
+# ADMINISTRACIÓN DE CONVERSACIONES
 # ============================================
 
 @app.route('/api/cerrar-conversacion/<int:conversacion_id>', methods=['POST'])
@@ -2202,16 +5209,12 @@ def cerrar_conversacion(conversacion_id):
             return jsonify({'success': False, 'message': 'No autorizado'}), 401
         
         # Verificar que sea admin
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        cursor.execute("SELECT tipo_usuario FROM usuarios WHERE id = ?", (session['usuario_id'],))
-        usuario = cursor.fetchone()
-        
-        if not usuario or usuario[0] != 'administrador':
-            conn.close()
+        if not es_administrador_sesion():
             return jsonify({'success': False, 'message': 'No tienes permisos'}), 403
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
         # Actualizar el estado de la conversación a 'cerrada'
         cursor.execute("""
             UPDATE conversaciones 
@@ -2222,7 +5225,6 @@ def cerrar_conversacion(conversacion_id):
         """, (conversacion_id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -2255,17 +5257,13 @@ def cambiar_estado_conversacion(conversacion_id):
                 'message': 'Estado no válido'
             }), 400
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
         # Verificar permisos de admin
-        cursor.execute("SELECT tipo_usuario FROM usuarios WHERE id = ?", (session['usuario_id'],))
-        usuario = cursor.fetchone()
-        
-        if not usuario or usuario[0] != 'administrador':
-            conn.close()
+        if not es_administrador_sesion():
             return jsonify({'success': False, 'message': 'No tienes permisos'}), 403
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
         # Actualizar estado
         cursor.execute("""
             UPDATE conversaciones 
@@ -2275,7 +5273,6 @@ def cambiar_estado_conversacion(conversacion_id):
         """, (nuevo_estado, conversacion_id))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -2308,17 +5305,13 @@ def cambiar_prioridad_conversacion(conversacion_id):
                 'message': 'Prioridad no válida'
             }), 400
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
         # Verificar permisos de admin
-        cursor.execute("SELECT tipo_usuario FROM usuarios WHERE id = ?", (session['usuario_id'],))
-        usuario = cursor.fetchone()
-        
-        if not usuario or usuario[0] != 'administrador':
-            conn.close()
+        if not es_administrador_sesion():
             return jsonify({'success': False, 'message': 'No tienes permisos'}), 403
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
         # Actualizar prioridad
         cursor.execute("""
             UPDATE conversaciones 
@@ -2328,7 +5321,6 @@ def cambiar_prioridad_conversacion(conversacion_id):
         """, (nueva_prioridad, conversacion_id))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -2350,17 +5342,13 @@ def reabrir_conversacion(conversacion_id):
         if 'usuario_id' not in session:
             return jsonify({'success': False, 'message': 'No autorizado'}), 401
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
         # Verificar permisos de admin
-        cursor.execute("SELECT tipo_usuario FROM usuarios WHERE id = ?", (session['usuario_id'],))
-        usuario = cursor.fetchone()
-        
-        if not usuario or usuario[0] != 'administrador':
-            conn.close()
+        if not es_administrador_sesion():
             return jsonify({'success': False, 'message': 'No tienes permisos'}), 403
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
         # Reabrir conversación
         cursor.execute("""
             UPDATE conversaciones 
@@ -2371,7 +5359,6 @@ def reabrir_conversacion(conversacion_id):
         """, (conversacion_id,))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
@@ -2396,39 +5383,31 @@ def asignar_conversacion(conversacion_id):
         data = request.get_json()
         admin_asignado_id = data.get('admin_id')
         
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
         # Verificar que el admin asignado existe
-        cursor.execute("""
-            SELECT id, nombre, apellido 
-            FROM usuarios 
-            WHERE id = ? AND tipo_usuario = 'administrador'
-        """, (admin_asignado_id,))
-        
-        admin_asignado = cursor.fetchone()
+        admin_asignado = obtener_administrador(admin_asignado_id)
         
         if not admin_asignado:
-            conn.close()
             return jsonify({
                 'success': False,
                 'message': 'Administrador no encontrado'
             }), 404
         
+        conn = get_db()
+        cursor = conn.cursor()
+        
         # Asignar conversación
         cursor.execute("""
             UPDATE conversaciones 
             SET admin_id = ?,
                 fecha_ultima_actividad = CURRENT_TIMESTAMP
             WHERE id = ?
-        """, (admin_asignado_id, conversacion_id))
+        """, (admin_asignado.id, conversacion_id))
         
         conn.commit()
-        conn.close()
         
         return jsonify({
             'success': True,
-            'message': f'Conversación asignada a {admin_asignado[1]} {admin_asignado[2]}'
+            'message': f'Conversación asignada a {admin_asignado.nombre} {admin_asignado.apellido}'
         })
         
     except Exception as e:
@@ -2442,6 +5421,20 @@ def asignar_conversacion(conversacion_id):
 # ============================================
 # ENDPOINT DE DEBUG PARA VER CONVERSACIONES
 # ============================================
+def obtener_resumen_conversaciones():
+    """Todas las conversaciones con el usuario y el admin asignado, de la más reciente a la más antigua"""
+    filas = get_db().execute('''
+        SELECT c.id, c.asunto, c.tipo, c.estado, c.prioridad,
+               u.nombre || ' ' || u.apellido || ' (ID: ' || c.usuario_id || ')',
+               CASE WHEN c.admin_id THEN a.nombre || ' ' || a.apellido ELSE 'Sin asignar' END,
+               c.total_mensajes, c.fecha_creacion, c.fecha_ultima_actividad
+        FROM conversaciones c
+        JOIN usuarios u ON c.usuario_id = u.id
+        LEFT JOIN usuarios a ON c.admin_id = a.id
+        ORDER BY c.fecha_ultima_actividad DESC
+    ''').fetchall()
+    return [ResumenConversacion._make(fila) for fila in filas]
+
 @app.route('/api/debug/conversaciones', methods=['GET'])
 def debug_conversaciones():
     """Endpoint de debug para ver todas las conversaciones"""
@@ -2449,48 +5442,8 @@ def debug_conversaciones():
         return jsonify({'success': False, 'message': 'No autorizado'}), 401
     
     try:
-        conn = sqlite3.connect(DATABASE)
-        cursor = conn.cursor()
-        
-        # Ver todas las conversaciones
-        cursor.execute("""
-            SELECT c.id, c.asunto, c.tipo, c.estado, c.prioridad,
-                   c.usuario_id, u.nombre, u.apellido,
-                   c.admin_id, a.nombre, a.apellido,
-                   c.fecha_creacion, c.fecha_ultima_actividad
-            FROM conversaciones c
-            JOIN usuarios u ON c.usuario_id = u.id
-            LEFT JOIN usuarios a ON c.admin_id = a.id
-            ORDER BY c.fecha_ultima_actividad DESC
-        """)
-        
-        conversaciones = cursor.fetchall()
-        
-        # Contar mensajes por conversación
-        cursor.execute("""
-            SELECT conversacion_id, COUNT(*) as total
-            FROM mensajes_conversacion
-            GROUP BY conversacion_id
-        """)
-        
-        mensajes_count = {row[0]: row[1] for row in cursor.fetchall()}
-        
-        conn.close()
-        
-        result = []
-        for c in conversaciones:
-            result.append({
-                'id': c[0],
-                'asunto': c[1],
-                'tipo': c[2],
-                'estado': c[3],
-                'prioridad': c[4],
-                'usuario': f"{c[6]} {c[7]} (ID: {c[5]})",
-                'admin': f"{c[9]} {c[10]}" if c[8] else 'Sin asignar',
-                'total_mensajes': mensajes_count.get(c[0], 0),
-                'fecha_creacion': c[11],
-                'fecha_ultima_actividad': c[12]
-            })
+        conversaciones = obtener_resumen_conversaciones()
+        result = filas_como_dicts(ResumenConversacion._fields, conversaciones)
         
         return jsonify({
             'success': True,
@@ -2506,10 +5459,10 @@ def debug_conversaciones():
         }), 500
 
 if __name__ == '__main__':
-    init_db() 
-    actualizar_db_conversaciones() 
-    insertar_horarios_prueba()
-    crear_primer_admin() 
+    with app.app_context():
+        aplicar_migraciones()
+        insertar_horarios_prueba()
+        crear_primer_admin()
     
     if not os.path.exists('templates'):
         os.makedirs('templates')
@@ -0,0 +1,33 @@
+# Configuración de gunicorn para Liberty Transport
+#
+#     gunicorn -c gunicorn.conf.py auth_server:app
+#
+# /api/eventos-chat (SSE) mantiene la respuesta abierta y ocupa un hilo del worker durante
+# toda la conexión. Con los workers sync por defecto cada pestaña abierta bloquea un worker
+# completo y unas pocas bastan para dejar el sitio sin atender; con gthread cada worker
+# atiende hasta `threads` conexiones a la vez y las peticiones normales siguen fluyendo.
+# Suba GUNICORN_THREADS si se esperan más pestañas con el chat abierto por worker.
+#
+# Todo lo que auth_server guarda en memoria es por worker: el pool de conexiones SQLite
+# (DB_POOL_SIZE), la caché de lecturas, el pool de procesos que calcula los hashes de
+# contraseñas (CREDENCIALES_PROCESOS) y los límites de intentos de login. Con N workers esos
+# límites se multiplican por N.
+#
+# Detrás del proxy inverso la IP real del cliente se toma de X-Forwarded-For: PROXY_SALTOS
+# (por defecto 1) dice cuántos proxies de confianza hay delante; use 0 si gunicorn se expone
+# directamente, para que un cliente no pueda falsificar su IP con ese encabezado.
+
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', str(os.cpu_count() or 1)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', '32'))
+
+# En gthread el latido lo da el hilo principal, así que un stream largo no dispara el timeout
+timeout = 30
+# Los streams SSE nunca terminan solos: al reiniciar se cortan tras este margen y los
+# navegadores reconectan retomando desde Last-Event-ID
+graceful_timeout = 10
+keepalive = 5
+
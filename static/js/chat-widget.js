@@ -0,0 +1,507 @@
+// Widget de chat de soporte compartido por todas las páginas con sesión.
+//
+// Una sola pestaña por navegador (la líder) mantiene la conexión con el servidor: abre el
+// canal SSE /api/eventos-chat y reenvía cada evento a las demás pestañas por BroadcastChannel.
+// El liderazgo se toma con un Web Lock, que el navegador libera solo al cerrar la pestaña,
+// así que otra toma el relevo sin temporizadores. Sin BroadcastChannel o Web Locks cada
+// pestaña trabaja sola, como antes.
+(function () {
+    const CANAL = 'liberty-chat';
+    const CANDADO_LIDER = 'liberty-chat-lider';
+    // Respaldo si el navegador no puede sostener el canal SSE
+    const INTERVALO_NOTIFICACIONES = 30000;
+
+    let conversacionActual = null;
+    let ultimoMensajeId = null;
+    let isOpen = false;
+    let fuenteEventos = null;
+    let intervaloRespaldo = null;
+    let recargaListaPendiente = null;
+    let conversacionesCargadas = [];
+    let cursorConversaciones = null;
+    let tituloInicial = '';
+    let ultimoContador = 0;
+
+    const canal = ('BroadcastChannel' in window) ? new BroadcastChannel(CANAL) : null;
+
+    const chatToggleBtn = document.getElementById('chatToggleBtn');
+    const chatCloseBtn = document.getElementById('chatCloseBtn');
+    const chatWindow = document.getElementById('chatWindow');
+    const chatBadge = document.getElementById('chatBadge');
+    const vistaConversaciones = document.getElementById('vistaConversaciones');
+    const vistaMensajes = document.getElementById('vistaMensajes');
+    const chatInput = document.getElementById('chatInput');
+    const chatSendBtn = document.getElementById('chatSendBtn');
+    const btnVolverConversaciones = document.getElementById('btnVolverConversaciones');
+    const chatTitleText = document.getElementById('chatTitleText');
+    const chatSubtitle = document.getElementById('chatSubtitle');
+
+    function init() {
+        if (!chatToggleBtn) return;
+        tituloInicial = chatTitleText.textContent;
+
+        chatToggleBtn.addEventListener('click', toggleChat);
+        chatCloseBtn.addEventListener('click', toggleChat);
+        chatSendBtn.addEventListener('click', enviarMensaje);
+        chatInput.addEventListener('keypress', (e) => {
+            if (e.key === 'Enter') enviarMensaje();
+        });
+        btnVolverConversaciones.addEventListener('click', volverAConversaciones);
+
+        if (canal) {
+            canal.onmessage = (e) => recibirDeCanal(e.data);
+        }
+
+        // Cada pestaña pinta su contador al cargar; desde ahí solo la líder consulta
+        actualizarNotificaciones();
+        if (canal && navigator.locks) {
+            navigator.locks.request(CANDADO_LIDER, () => new Promise(() => asumirLiderazgo()));
+        } else {
+            asumirLiderazgo();
+        }
+    }
+
+    // ---------- Comunicación con el servidor (solo la pestaña líder) ----------
+
+    function asumirLiderazgo() {
+        if ('EventSource' in window) {
+            conectarEventos();
+        } else {
+            iniciarRespaldo();
+        }
+    }
+
+    function conectarEventos() {
+        fuenteEventos = new EventSource('/api/eventos-chat');
+
+        fuenteEventos.addEventListener('no_leidos', (e) => {
+            difundir({ tipo: 'no_leidos', valor: JSON.parse(e.data).mensajes_no_leidos });
+        });
+        ['mensaje', 'conversacion'].forEach(tipo => {
+            fuenteEventos.addEventListener(tipo, (e) => {
+                difundir({ tipo: 'evento', evento: tipo, datos: JSON.parse(e.data) });
+            });
+        });
+        fuenteEventos.onopen = () => detenerRespaldo();
+        fuenteEventos.onerror = () => {
+            // EventSource reintenta solo (con Last-Event-ID); si se rinde, se vuelve a consultar
+            if (fuenteEventos.readyState === EventSource.CLOSED) {
+                iniciarRespaldo();
+            }
+        };
+    }
+
+    function iniciarRespaldo() {
+        if (intervaloRespaldo) return;
+        intervaloRespaldo = setInterval(actualizarNotificaciones, INTERVALO_NOTIFICACIONES);
+    }
+
+    function detenerRespaldo() {
+        if (intervaloRespaldo) {
+            clearInterval(intervaloRespaldo);
+            intervaloRespaldo = null;
+        }
+    }
+
+    // Aplica el mensaje en esta pestaña y lo reenvía a las demás
+    function difundir(mensaje) {
+        recibirDeCanal(mensaje);
+        if (canal) canal.postMessage(mensaje);
+    }
+
+    function recibirDeCanal(mensaje) {
+        if (mensaje.tipo === 'no_leidos') {
+            const subio = mensaje.valor > ultimoContador;
+            ultimoContador = mensaje.valor;
+            pintarContador(mensaje.valor);
+            // Sin canal SSE no llegan eventos: un contador que sube también avisa de mensajes nuevos
+            if (!subio) return;
+        } else if (mensaje.tipo !== 'evento') {
+            return;
+        }
+        if (!isOpen) return;
+
+        const conversacionId = mensaje.datos ? mensaje.datos.conversacion_id : conversacionActual;
+
+        if (conversacionActual && conversacionId === conversacionActual) {
+            cargarMensajesNuevos();
+        } else if (!conversacionActual && vistaConversaciones.style.display !== 'none') {
+            programarRecargaLista();
+        }
+    }
+
+    async function actualizarNotificaciones() {
+        try {
+            const response = await fetch('/api/notificaciones-chat');
+            const data = await response.json();
+
+            if (data.success) {
+                difundir({ tipo: 'no_leidos', valor: data.mensajes_no_leidos });
+            }
+        } catch (error) {
+            console.error('Error actualizando notificaciones:', error);
+        }
+    }
+
+    function pintarContador(cantidad) {
+        if (cantidad > 0 && !isOpen) {
+            chatBadge.textContent = cantidad;
+            chatBadge.classList.add('visible');
+        } else {
+            chatBadge.classList.remove('visible');
+        }
+    }
+
+    // ---------- Interfaz del widget ----------
+
+    function toggleChat() {
+        isOpen = !isOpen;
+        chatWindow.classList.toggle('visible', isOpen);
+
+        if (isOpen) {
+            if (!conversacionActual) {
+                cargarConversaciones();
+            }
+            chatBadge.classList.remove('visible');
+        }
+    }
+
+    function programarRecargaLista() {
+        // Varios eventos seguidos se resuelven con una sola consulta
+        if (recargaListaPendiente) return;
+        recargaListaPendiente = setTimeout(() => {
+            recargaListaPendiente = null;
+            cargarConversaciones(false);
+        }, 500);
+    }
+
+    async function cargarConversaciones(mostrarCarga = true) {
+        if (mostrarCarga) {
+            vistaConversaciones.innerHTML = '<div class="mensaje-cargando"><div class="spinner"></div><p>Cargando conversaciones...</p></div>';
+        }
+
+        try {
+            const response = await fetch('/api/mis-conversaciones');
+            const data = await response.json();
+
+            if (data.success) {
+                conversacionesCargadas = data.conversaciones;
+                cursorConversaciones = data.siguiente_cursor;
+                mostrarConversaciones(conversacionesCargadas);
+            } else {
+                vistaConversaciones.innerHTML = '<div class="mensaje-error">Error al cargar conversaciones</div>';
+            }
+        } catch (error) {
+            console.error('Error:', error);
+            vistaConversaciones.innerHTML = '<div class="mensaje-error">Error de conexión</div>';
+        }
+    }
+
+    function mostrarConversaciones(conversaciones) {
+        if (conversaciones.length === 0) {
+            vistaConversaciones.innerHTML = `
+                <div class="mensaje-vacio-conversaciones">
+                    <span class="icono-conversaciones-vacias">💬</span>
+                    <h3>No hay conversaciones</h3>
+                    <p>Inicia una nueva conversación con nuestro equipo</p>
+                </div>
+                <button class="btn-nueva-conversacion" onclick="window.chatWidget.nuevaConversacion()">
+                    ➕ Nueva Conversación
+                </button>
+            `;
+            return;
+        }
+
+        let html = '<button class="btn-nueva-conversacion" onclick="window.chatWidget.nuevaConversacion()">➕ Nueva Conversación</button>';
+
+        conversaciones.forEach(conv => {
+            const fecha = new Date(conv.fecha_ultima_actividad);
+            const fechaFormateada = formatearFechaRelativa(fecha);
+            const claseNoLeida = conv.mensajes_no_leidos > 0 ? 'no-leida' : '';
+
+            html += `
+                <div class="conversacion-item ${claseNoLeida}" onclick="window.chatWidget.abrirConversacion(${Number(conv.id)})">
+                    <div class="conversacion-header">
+                        <div class="conversacion-asunto">${escaparHtml(conv.asunto)}</div>
+                        <div class="conversacion-badges">
+                            <span class="badge-conversacion badge-${escaparHtml(conv.prioridad)}">${escaparHtml(conv.prioridad)}</span>
+                            <span class="badge-conversacion badge-${escaparHtml(conv.estado)}">${escaparHtml(conv.estado.replace('_', ' '))}</span>
+                        </div>
+                    </div>
+                    <div class="conversacion-footer">
+                        <span class="conversacion-fecha">${fechaFormateada}</span>
+                        ${conv.mensajes_no_leidos > 0 ? `<span class="conversacion-no-leidos">${Number(conv.mensajes_no_leidos)}</span>` : ''}
+                    </div>
+                </div>
+            `;
+        });
+
+        if (cursorConversaciones) {
+            html += '<button class="btn-nueva-conversacion" onclick="window.chatWidget.cargarMasConversaciones(this)">Ver más</button>';
+        }
+
+        vistaConversaciones.innerHTML = html;
+    }
+
+    // La API entrega las conversaciones por páginas; las siguientes se piden con siguiente_cursor
+    async function cargarMasConversaciones(boton) {
+        boton.disabled = true;
+        try {
+            const response = await fetch(`/api/mis-conversaciones?cursor=${encodeURIComponent(cursorConversaciones)}`);
+            const data = await response.json();
+
+            if (data.success) {
+                conversacionesCargadas = conversacionesCargadas.concat(data.conversaciones);
+                cursorConversaciones = data.siguiente_cursor;
+                mostrarConversaciones(conversacionesCargadas);
+                return;
+            }
+        } catch (error) {
+            console.error('Error:', error);
+        }
+        boton.disabled = false;
+    }
+
+    async function abrirConversacion(conversacionId) {
+        conversacionActual = conversacionId;
+
+        vistaConversaciones.style.display = 'none';
+        vistaMensajes.style.display = 'flex';
+        btnVolverConversaciones.style.display = 'block';
+
+        chatTitleText.textContent = 'Conversación';
+        chatSubtitle.textContent = 'Chat en vivo';
+
+        await cargarMensajes(conversacionId);
+
+        chatInput.disabled = false;
+        chatInput.placeholder = 'Escribe tu mensaje...';
+        chatInput.focus();
+    }
+
+    async function cargarMensajes(conversacionId) {
+        vistaMensajes.innerHTML = '<div class="mensaje-cargando"><div class="spinner"></div><p>Cargando mensajes...</p></div>';
+
+        try {
+            const response = await fetch(`/api/mensajes-conversacion/${conversacionId}`);
+            const data = await response.json();
+
+            if (data.success) {
+                ultimoMensajeId = data.ultimo_id;
+                mostrarMensajes(data.mensajes);
+                actualizarNotificaciones();
+            } else {
+                vistaMensajes.innerHTML = '<div class="mensaje-error">Error al cargar mensajes</div>';
+            }
+        } catch (error) {
+            console.error('Error:', error);
+            vistaMensajes.innerHTML = '<div class="mensaje-error">Error de conexión</div>';
+        }
+    }
+
+    // Trae solo lo posterior al último mensaje mostrado y lo agrega al final
+    async function cargarMensajesNuevos() {
+        if (!conversacionActual || ultimoMensajeId === null) {
+            return conversacionActual ? cargarMensajes(conversacionActual) : undefined;
+        }
+        const conversacionId = conversacionActual;
+
+        try {
+            const response = await fetch(`/api/mensajes-conversacion/${conversacionId}?after_id=${ultimoMensajeId}`);
+            const data = await response.json();
+            if (!data.success || conversacionId !== conversacionActual || data.mensajes.length === 0) return;
+
+            if (!vistaMensajes.querySelector('.chat-message')) {
+                vistaMensajes.innerHTML = '';
+            }
+            vistaMensajes.insertAdjacentHTML('beforeend', data.mensajes.map(htmlMensaje).join(''));
+            ultimoMensajeId = data.ultimo_id;
+            scrollToBottom();
+            actualizarNotificaciones();
+            if (data.hay_mas) {
+                cargarMensajesNuevos();
+            }
+        } catch (error) {
+            console.error('Error:', error);
+        }
+    }
+
+    function htmlMensaje(mensaje) {
+        const fecha = new Date(mensaje.fecha_mensaje);
+        const horaFormateada = fecha.toLocaleTimeString('es-CO', { hour: '2-digit', minute: '2-digit' });
+        const claseUsuario = mensaje.es_mio ? 'user' : '';
+        const avatar = mensaje.es_mio ? '👤' : '💬';
+
+        return `
+            <div class="chat-message ${claseUsuario}">
+                <div class="chat-message-avatar">${avatar}</div>
+                <div class="chat-message-content">
+                    <div class="chat-message-bubble">${escaparHtml(mensaje.mensaje)}</div>
+                    <div class="chat-message-time">${horaFormateada}</div>
+                </div>
+            </div>
+        `;
+    }
+
+    function mostrarMensajes(mensajes) {
+        if (mensajes.length === 0) {
+            vistaMensajes.innerHTML = '<div class="mensaje-vacio">No hay mensajes aún</div>';
+            return;
+        }
+
+        vistaMensajes.innerHTML = mensajes.map(htmlMensaje).join('');
+        scrollToBottom();
+    }
+
+    async function enviarMensaje() {
+        const mensaje = chatInput.value.trim();
+        if (!mensaje) return;
+
+        chatInput.disabled = true;
+        chatSendBtn.disabled = true;
+
+        try {
+            let response;
+
+            if (conversacionActual) {
+                response = await fetch('/api/enviar-mensaje-conversacion', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({
+                        conversacion_id: conversacionActual,
+                        mensaje: mensaje
+                    })
+                });
+            } else {
+                response = await fetch('/api/iniciar-conversacion', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify({ mensaje: mensaje })
+                });
+            }
+
+            const data = await response.json();
+
+            if (data.success) {
+                chatInput.value = '';
+
+                if (!conversacionActual && data.conversacion_id) {
+                    await abrirConversacion(data.conversacion_id);
+                } else {
+                    await cargarMensajesNuevos();
+                }
+            } else {
+                mostrarNotificacionError(data.message || 'Error enviando mensaje');
+            }
+        } catch (error) {
+            console.error('Error:', error);
+            mostrarNotificacionError('Error de conexión');
+        } finally {
+            chatInput.disabled = false;
+            chatSendBtn.disabled = false;
+            chatInput.focus();
+        }
+    }
+
+    function nuevaConversacion() {
+        conversacionActual = null;
+        ultimoMensajeId = null;
+        vistaConversaciones.style.display = 'none';
+        vistaMensajes.style.display = 'flex';
+        btnVolverConversaciones.style.display = 'block';
+
+        chatTitleText.textContent = 'Nueva Conversación';
+        chatSubtitle.textContent = 'Escribe tu consulta';
+
+        vistaMensajes.innerHTML = `
+            <div class="mensaje-bienvenida" style="text-align: center; padding: 40px 20px; color: rgba(255,255,255,0.7);">
+                <div style="font-size: 3rem; margin-bottom: 16px;">👋</div>
+                <h3 style="color: white; margin-bottom: 8px;">¡Hola!</h3>
+                <p>Escribe tu consulta y un agente te responderá pronto</p>
+            </div>
+        `;
+
+        chatInput.disabled = false;
+        chatInput.placeholder = 'Escribe tu consulta...';
+        chatInput.focus();
+    }
+
+    function volverAConversaciones() {
+        conversacionActual = null;
+        ultimoMensajeId = null;
+        vistaMensajes.style.display = 'none';
+        vistaConversaciones.style.display = 'block';
+        btnVolverConversaciones.style.display = 'none';
+
+        chatTitleText.textContent = tituloInicial;
+        chatSubtitle.textContent = '⚡ En línea';
+
+        chatInput.disabled = true;
+        chatInput.value = '';
+        chatInput.placeholder = 'Selecciona una conversación...';
+
+        cargarConversaciones();
+    }
+
+    function scrollToBottom() {
+        setTimeout(() => {
+            vistaMensajes.scrollTop = vistaMensajes.scrollHeight;
+        }, 100);
+    }
+
+    function escaparHtml(texto) {
+        return String(texto ?? '').replace(/[&<>"']/g, c => ({
+            '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+        }[c]));
+    }
+
+    function formatearFechaRelativa(fecha) {
+        const ahora = new Date();
+        const diff = ahora - fecha;
+        const minutos = Math.floor(diff / 60000);
+        const horas = Math.floor(diff / 3600000);
+        const dias = Math.floor(diff / 86400000);
+
+        if (minutos < 1) return 'Ahora';
+        if (minutos < 60) return `Hace ${minutos}m`;
+        if (horas < 24) return `Hace ${horas}h`;
+        if (dias < 7) return `Hace ${dias}d`;
+        return fecha.toLocaleDateString('es-CO');
+    }
+
+    function mostrarNotificacionError(mensaje) {
+        const notif = document.createElement('div');
+        notif.style.cssText = `
+            position: fixed;
+            top: 100px;
+            right: 20px;
+            background: #ef4444;
+            color: white;
+            padding: 16px 24px;
+            border-radius: 12px;
+            box-shadow: 0 8px 25px rgba(0,0,0,0.3);
+            z-index: 10001;
+            animation: slideIn 0.3s ease;
+        `;
+        notif.textContent = mensaje;
+        document.body.appendChild(notif);
+
+        setTimeout(() => {
+            notif.style.opacity = '0';
+            setTimeout(() => notif.remove(), 300);
+        }, 3000);
+    }
+
+    window.chatWidget = {
+        abrirConversacion: abrirConversacion,
+        cargarMasConversaciones: cargarMasConversaciones,
+        nuevaConversacion: nuevaConversacion,
+        volverAConversaciones: volverAConversaciones
+    };
+
+    if (document.readyState === 'loading') {
+        document.addEventListener('DOMContentLoaded', init);
+    } else {
+        init();
+    }
+})();
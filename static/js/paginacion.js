@@ -0,0 +1,46 @@
+// Lectura de listados paginados por cursor (?limit=, ?cursor= y siguiente_cursor).
+//
+// Sin parámetros la API entrega solo la primera página. Las listas que se muestran piden una
+// página y ofrecen "Cargar más"; lo que necesita el conjunto completo (selectores, contadores
+// de un usuario) recorre las páginas con `todas`.
+(function () {
+    // Igual a LIMITE_PAGINA_MAX en el servidor: menos idas y vueltas al recorrer todo
+    const LIMITE_MAXIMO = 200;
+
+    function conParametros(url, parametros) {
+        const direccion = new URL(url, window.location.origin);
+        Object.entries(parametros).forEach(([clave, valor]) => {
+            if (valor !== null && valor !== undefined) direccion.searchParams.set(clave, valor);
+        });
+        return direccion.pathname + direccion.search;
+    }
+
+    // Una página del listado: { datos, elementos, siguienteCursor }
+    async function pagina(url, clave, cursor = null, limite = null) {
+        const response = await fetch(conParametros(url, { cursor: cursor, limit: limite }));
+        const datos = await response.json();
+        return {
+            datos: datos,
+            elementos: datos.success ? (datos[clave] || []) : [],
+            siguienteCursor: datos.success ? datos.siguiente_cursor : null
+        };
+    }
+
+    // Todas las páginas concatenadas; devuelve la respuesta de la primera con la lista completa
+    async function todas(url, clave) {
+        const primera = await pagina(url, clave, null, LIMITE_MAXIMO);
+        if (!primera.datos.success) return primera.datos;
+
+        const elementos = primera.elementos.slice();
+        let cursor = primera.siguienteCursor;
+        while (cursor) {
+            const siguiente = await pagina(url, clave, cursor, LIMITE_MAXIMO);
+            if (!siguiente.datos.success) return siguiente.datos;
+            elementos.push(...siguiente.elementos);
+            cursor = siguiente.siguienteCursor;
+        }
+        return { ...primera.datos, [clave]: elementos, siguiente_cursor: null };
+    }
+
+    window.paginacion = { pagina: pagina, todas: todas };
+})();